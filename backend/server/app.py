@@ -1,26 +1,84 @@
 # backend/server/app.py
-import os, secrets, json
+import os, re, secrets, hmac, json, threading, contextlib, functools, hashlib, queue, time, math, tempfile, traceback, socket, struct, gzip, io, zipfile, heapq, fcntl, pstats
+import http.client
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone, timedelta
-from flask import Flask, request, jsonify, make_response, g, abort
+from flask import Flask, request, jsonify, make_response, g, abort, has_app_context, has_request_context, Response, stream_with_context, send_file
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
 from flask_socketio import SocketIO, emit
+from werkzeug.datastructures import FileStorage
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import Integer, String, Text, text
+from sqlalchemy import Integer, String, Table, Text, text, event, insert, select, func, and_, inspect as sa_inspect
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.orm import validates, joinedload, selectinload
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.engine import Engine
 from sqlalchemy.dialects.sqlite import JSON as SQLITE_JSON
 from typing import Optional
+from abc import ABC, abstractmethod
+from urllib.parse import urlsplit
 
-try:
-    from PIL import Image
-except Exception:  # Pillow not installed
-    Image = None
 
 DB_URL = os.environ.get("OFFLINE_DB_URL", "sqlite:///offline.db")
 SECRET = os.environ.get("OFFLINE_SECRET", "dev-secret")
 PORT = int(os.environ.get("PORT", "5001"))
 
+# ---------- Shards (per-user SQLite files) ----------
+# EXPERIMENTAL: keep OFFLINE_SHARDS=1 (the default) in production until a
+# multi-core benchmark shows a gain (see below).
+# SQLite takes one writer per file, so each user's chats, messages, summaries,
+# OCR extractions and notifications live in one of SHARD_COUNT files and
+# writers of different users don't queue on the same lock. users, sessions,
+# credits, profiles, uploads and sales requests stay in the main DB. Shard 0
+# *is* the main DB, so OFFLINE_SHARDS=1 (the default) is the unsharded layout.
+# bench/shards.py measures the effect. The results in bench/shards.json, taken
+# on one CPU, show none: the writers are CPU-bound there, so a gain needs
+# several cores (or commits slow enough to overlap) and is unverified so far.
+# users.shard records placement (user id % SHARD_COUNT at signup);
+# `python app.py rebalance` moves users whose placement no longer matches.
+# Routing happens in the session: ORM queries and Core statements on a sharded
+# table go to g.shard (the request user's shard, or shard_scope()); raw text()
+# SQL passes its shard explicitly or runs inside a pinned shard_scope().
+SHARD_COUNT = max(1, int(os.environ.get("OFFLINE_SHARDS", "1")))
+SHARD_URL = os.environ.get("OFFLINE_SHARD_URL") or (
+    DB_URL[:-3] + "-shard{n}.db" if DB_URL.endswith(".db") else DB_URL + "-shard{n}")
+SHARDED_TABLES = frozenset({"chats", "messages", "chat_summaries", "ocr_bill_extractions",
+                            "ocr_bank_extractions", "notifications"})
+
+
+def _bind_table(mapper, clause):
+    if mapper is not None:
+        return sa_inspect(mapper).local_table
+    if isinstance(clause, Table):
+        return clause
+    if isinstance(clause, UpdateBase) and isinstance(clause.table, Table):
+        return clause.table
+    for f in getattr(clause, "get_final_froms", lambda: ())():
+        if isinstance(f, Table) and f.name in SHARDED_TABLES:
+            return f
+    return None
+
+
+class ShardedSession(FlaskSession):
+    """Sends statements on sharded tables to the current shard (all statements while pinned)."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and SHARD_COUNT > 1 and has_app_context():
+            if g.get("shard_pin") is not None:
+                return shard_engine(g.shard_pin)
+            table = _bind_table(mapper, clause)
+            if table is not None and table.name in SHARDED_TABLES:
+                return shard_engine(current_shard())
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = DB_URL
+app.config["SQLALCHEMY_BINDS"] = {f"shard{n}": SHARD_URL.format(n=n) for n in range(1, SHARD_COUNT)}
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SECRET_KEY"] = SECRET
 
@@ -28,14 +86,129 @@ CORS(
     app,
     resources={r"/*": {"origins": "*"}},
     supports_credentials=False,
-    methods=["GET", "POST", "PATCH", "DELETE", "OPTIONS"],
+    methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["Upload-Offset", "Idempotent-Replayed"],
 )
 
-db = SQLAlchemy(app)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
+db = SQLAlchemy(app, session_options={"class_": ShardedSession})
+# serve.py runs workers under eventlet; the dev entry point below keeps threading
+ASYNC_MODE = os.environ.get("OFFLINE_ASYNC_MODE", "threading")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE)
+
+
+class _TpoolExecutor:
+    """submit() -> Future, run on eventlet's pool of real OS threads (at most max_workers at once)."""
+
+    def __init__(self, max_workers: int):
+        import eventlet.semaphore
+        self._sem = eventlet.semaphore.Semaphore(max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+        import eventlet
+        from eventlet import tpool
+        fut = Future()
+
+        def run():
+            with self._sem:
+                if not fut.set_running_or_notify_cancel():
+                    return
+                try:
+                    fut.set_result(tpool.execute(fn, *args, **kwargs))
+                except BaseException as e:
+                    fut.set_exception(e)
+        eventlet.spawn_n(run)
+        return fut
+
+
+def cpu_pool(max_workers: int, name: str):
+    """
+    Executor for CPU-bound work (image decoding, model calls). Under eventlet
+    monkey-patching a ThreadPoolExecutor's threads are green: the work would
+    run on the worker's event loop and stall every request, so real threads
+    from eventlet.tpool are used instead.
+    """
+    if ASYNC_MODE == "eventlet":
+        return _TpoolExecutor(max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _record):
+    # WAL lets readers in other workers proceed during a write; busy_timeout
+    # makes concurrent writers wait instead of failing with "database is locked"
+    if type(dbapi_conn).__module__.startswith("sqlite3"):
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA busy_timeout=5000")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.close()
+
+
+# ---------- Shard routing ----------
+def shard_engine(n: Optional[int] = None):
+    n = current_shard() if n is None else n
+    if n == 0:
+        return db.engines[None]
+    try:
+        return db.engines[f"shard{n}"]
+    except KeyError:
+        raise RuntimeError(f"shard {n} is not configured (OFFLINE_SHARDS={SHARD_COUNT})") from None
+
+
+def current_shard() -> int:
+    n = g.get("shard") if has_app_context() else None
+    if n is None:
+        if SHARD_COUNT == 1:
+            return 0
+        raise RuntimeError("no shard selected for a sharded table (see shard_scope)")
+    return n
+
+
+def place_user(user_id: int) -> int:
+    """Shard a new user is created on."""
+    return user_id % SHARD_COUNT
+
+
+def _shard_detach():
+    # ids are per file, so rows of two shards can share an identity; flush and
+    # drop the sharded instances before the session starts reading another shard
+    if SHARD_COUNT == 1:
+        return
+    db.session.flush()
+    for obj in list(db.session.identity_map.values()):
+        if obj.__table__.name in SHARDED_TABLES:
+            db.session.expunge(obj)
+
+
+@contextlib.contextmanager
+def shard_scope(n: int, pin: bool = False):
+    """Route sharded tables to shard `n` for the block; `pin` sends every statement there."""
+    prev = (g.get("shard"), g.get("shard_pin"))
+    _shard_detach()
+    g.shard, g.shard_pin = n, (n if pin else None)
+    try:
+        yield
+        _shard_detach()
+    finally:
+        g.shard, g.shard_pin = prev
+
+
+def for_each_shard(fn, pin: bool = True):
+    """fn() once per shard (pinned by default); numeric results summed, None if all returned None."""
+    total = None
+    for n in range(SHARD_COUNT):
+        with shard_scope(n, pin=pin):
+            r = fn()
+        if r is not None:
+            total = (total or 0) + r
+    return total
+
 
 # ---------- Models ----------
+# Relationships are view-only read paths (writes keep setting ids directly)
+# and only join tables in the same DB file: users/profiles/user_credits in
+# the main DB, chats/messages/chat_summaries on the user's shard.
 class User(db.Model):
     __tablename__ = "users"
     id = db.Column(Integer, primary_key=True)
@@ -43,12 +216,16 @@ class User(db.Model):
     name = db.Column(String, nullable=False)
     password_hash = db.Column(String, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    shard = db.Column(Integer, nullable=False, default=0)  # where this user's chats/messages/... live
+    shard_moving = db.Column(Integer, nullable=True)  # target shard while move_user() copies them
+
+    profile = db.relationship("Profile", primaryjoin="User.id == foreign(Profile.id)", viewonly=True, uselist=False)
+    credit = db.relationship("UserCredit", primaryjoin="User.id == foreign(UserCredit.id)", viewonly=True, uselist=False)
 
     def to_dict(self, include_profile=False):
         d = {"id": self.id, "email": self.email, "name": self.name}
         if include_profile:
-            prof = db.session.get(Profile, self.id)
-            d["profile"] = prof.to_dict() if prof else None
+            d["profile"] = self.profile.to_dict() if self.profile else None
         return d
 
 
@@ -95,16 +272,107 @@ class Chat(db.Model):
     messages_count = db.Column(Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # cold storage: messages moved to a compressed segment file (see archive_chat)
+    archived_at = db.Column(db.DateTime, nullable=True)
+    archive_file = db.Column(String, nullable=True)
+    archive_count = db.Column(Integer, nullable=True)
+
+    messages = db.relationship("Message", back_populates="chat", order_by="Message.id", viewonly=True)
+    latest_message = db.relationship(
+        "Message", viewonly=True, uselist=False,
+        primaryjoin=lambda: and_(Chat.id == Message.chat_id, Message.id == select(func.max(Message.id))
+                                 .where(Message.chat_id == Chat.id).correlate_except(Message).scalar_subquery()))
+    summary = db.relationship("ChatSummary", primaryjoin="Chat.id == foreign(ChatSummary.id)",
+                              viewonly=True, uselist=False)
+
+
+# The API's message `content` is {"role", "text", "version", "meta", ...}. The
+# first three are real columns; content_json keeps only the rest.
+MESSAGE_TYPED = ("role", "text", "version")
+
+
+class MessageRest(TypeDecorator):
+    """content_json minus the typed keys; the usual {"meta": {}} is stored as ''."""
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or value == {"meta": {}}:
+            return ""
+        return json.dumps(value)
+
+    def process_result_value(self, value, dialect):
+        if not value:
+            return {"meta": {}}  # no JSON decode for the common case
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return {}
+        return value if isinstance(value, dict) else {}
+
+
+def split_content(content) -> dict:
+    """API `content` -> the typed keys it carries plus {"content_json": leftover}."""
+    if isinstance(content, str):
+        try:
+            content = json.loads(content)
+        except ValueError:
+            content = {"text": content}
+    if not isinstance(content, dict):
+        content = {} if content is None else {"text": str(content)}
+    out = {k: content[k] for k in MESSAGE_TYPED if k in content}
+    out["content_json"] = {k: v for k, v in content.items() if k not in MESSAGE_TYPED}
+    return out
+
+
+def message_values(row: dict) -> dict:
+    """Column values for a Core insert from a row holding full content (API input,
+    legacy archive segments) or already-split columns; every typed key is present."""
+    out = split_content(row.get("content_json"))
+    for k in MESSAGE_TYPED:
+        if k not in out:
+            out[k] = row.get(k)
+    return out
+
+
+def message_content(role, text_, version, rest) -> dict:
+    content = {k: v for k, v in (("role", role), ("text", text_), ("version", version)) if v is not None}
+    content.update(rest or {})
+    return content
 
 
 class Message(db.Model):
     __tablename__ = "messages"
+    __table_args__ = {"sqlite_autoincrement": True}  # ids are never reused: archived chats keep theirs
     id = db.Column(Integer, primary_key=True)
     chat_id = db.Column(Integer, db.ForeignKey("chats.id"), nullable=False)
     user_id = db.Column(Integer, db.ForeignKey("users.id"), nullable=True)
-    content_json = db.Column(SQLITE_JSON, nullable=False)
+    role = db.Column(String, nullable=True)
+    text = db.Column(Text, nullable=True)
+    version = db.Column(String, nullable=True)
+    content_json = db.Column(MessageRest, nullable=False, default=lambda: {"meta": {}})
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    chat = db.relationship("Chat", back_populates="messages", viewonly=True)
+
+    @validates("content_json")
+    def _split_content(self, _key, value):
+        # callers may still assign a full content dict; lift the typed keys out
+        parts = split_content(value)
+        for k in MESSAGE_TYPED:
+            if k in parts:
+                setattr(self, k, parts[k])
+        return parts["content_json"]
+
+
+class ChatSummary(db.Model):
+    """Rolling summary of turns that fell out of the chat's context window."""
+    __tablename__ = "chat_summaries"
+    id = db.Column(Integer, primary_key=True)  # == chats.id
+    summary = db.Column(Text, nullable=True)
+    upto_message_id = db.Column(Integer, default=0)  # last message folded into summary
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 
 # ---------- OCR (new columns used by frontend) ----------
 class OCRBillExtract(db.Model):
@@ -136,6 +404,7 @@ class Notification(db.Model):
     title = db.Column(String, nullable=False)
     body = db.Column(Text, nullable=True)
     read_at = db.Column(db.DateTime, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
@@ -161,121 +430,680 @@ class SalesRequest(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
-# ---------- Vision: Flower (YOLO-style dummy) ----------
-@app.post("/vision/flower/detect")
-def flower_detect():
-    current_user_required()
-    f = request.files.get("file")
-    w, h = 640, 480
+class Upload(db.Model):
+    """A resumable upload; bytes live in UPLOAD_DIR/<id>.part."""
+    __tablename__ = "uploads"
+    id = db.Column(String, primary_key=True)
+    user_id = db.Column(Integer, db.ForeignKey("users.id"), nullable=False)
+    filename = db.Column(String, nullable=True)
+    content_type = db.Column(String, nullable=True)
+    size = db.Column(Integer, nullable=True)  # declared total, if the client sent one
+    received = db.Column(Integer, default=0)
+    sha256 = db.Column(String, nullable=True)  # set on finalize
+    completed_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class IdempotencyKey(db.Model):
+    """First response to a request sent with an Idempotency-Key header; status is NULL while it runs."""
+    __tablename__ = "idempotency_keys"
+    user_id = db.Column(Integer, primary_key=True)
+    key = db.Column(String, primary_key=True)
+    fingerprint = db.Column(String, nullable=False)  # method, path and JSON body of the first request
+    status = db.Column(Integer, nullable=True)
+    body = db.Column(Text, nullable=True)
+    mimetype = db.Column(String, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class Blob(db.Model):
+    """A stored file, addressed by the SHA-256 of its bytes (see blob_put)."""
+    __tablename__ = "blobs"
+    sha256 = db.Column(String, primary_key=True)
+    size = db.Column(Integer, nullable=False)
+    content_type = db.Column(String, nullable=True)
+    stored_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # last put; GC grace starts here
+
+
+class BlobOwner(db.Model):
+    """A user who stored (and may read) a blob; the same bytes can have several."""
+    __tablename__ = "blob_owners"
+    sha256 = db.Column(String, primary_key=True)
+    user_id = db.Column(Integer, primary_key=True, index=True)
+
+
+class UsageEvent(db.Model):
+    """One outcome of a credit charge path (append-only; folded into usage_rollups)."""
+    __tablename__ = "usage_events"
+    __table_args__ = {"sqlite_autoincrement": True}  # ids are never reused: the rollup watermark relies on it
+    id = db.Column(Integer, primary_key=True)
+    at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    user_id = db.Column(Integer, nullable=False)
+    plan = db.Column(String, nullable=True)
+    kind = db.Column(String, nullable=False)      # "chat" | "ocr_bill" | "ocr_bank"
+    version = db.Column(String, nullable=True)    # chat version
+    outcome = db.Column(String, nullable=False)   # "charged" | "refunded" | "insufficient"
+    units = db.Column(Integer, nullable=False, default=0)  # credits; negative for refunds
+
+
+class UsageRollup(db.Model):
+    """Event count and credit total per (grain, bucket, plan, kind, version, outcome)."""
+    __tablename__ = "usage_rollups"
+    grain = db.Column(String, primary_key=True)    # "hour" | "day"
+    bucket = db.Column(String, primary_key=True)   # "YYYY-MM-DD HH:00" | "YYYY-MM-DD" (UTC)
+    plan = db.Column(String, primary_key=True)
+    kind = db.Column(String, primary_key=True)
+    version = db.Column(String, primary_key=True)  # "" for OCR
+    outcome = db.Column(String, primary_key=True)
+    events = db.Column(Integer, nullable=False, default=0)
+    units = db.Column(Integer, nullable=False, default=0)
+
+
+# ---------- Uploads (resumable, chunked, spooled to disk) ----------
+# POST /uploads opens a session, PUT /uploads/<id>?offset=N appends one raw
+# chunk (streamed straight to UPLOAD_DIR, never buffered in memory), GET
+# reports the offset to resume from, POST /uploads/<id>/finalize seals it.
+# SHA-256 is updated as chunks arrive; a worker that didn't see the previous
+# chunk re-hashes the prefix once. Vision/OCR routes accept `upload_id` in
+# place of a multipart `file` (see request_file). Sessions expire after
+# UPLOAD_TTL_HOURS without activity (the "uploads" maintenance job).
+UPLOAD_DIR = os.environ.get("OFFLINE_UPLOAD_DIR") or os.path.join(app.instance_path, "uploads")
+UPLOAD_MAX_BYTES = int(os.environ.get("OFFLINE_UPLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_CHUNK = 1024 * 1024  # suggested chunk size
+UPLOAD_MAX_CHUNK = 16 * 1024 * 1024
+UPLOAD_TTL_HOURS = int(os.environ.get("OFFLINE_UPLOAD_TTL_HOURS", "24"))
+
+_upload_hashers = OrderedDict()  # upload id -> (bytes hashed, sha256 object)
+_upload_hash_lock = threading.Lock()
+
+
+def _json_abort(status: int, **body):
+    abort(make_response(jsonify(body), status))
+
+
+def _upload_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_DIR, f"{upload_id}.part")
+
+
+def _upload_get(upload_id: str) -> "Upload":
+    u = current_user_required()
+    up = db.session.get(Upload, upload_id)
+    if up is None or up.user_id != u.id:
+        _json_abort(404, error="upload_not_found")
+    return up
+
+
+def _upload_status(up: "Upload") -> dict:
+    return {
+        "id": up.id, "filename": up.filename, "content_type": up.content_type, "size": up.size,
+        "offset": up.received or 0, "complete": up.completed_at is not None, "sha256": up.sha256,
+        "chunk_size": UPLOAD_CHUNK,
+        "expires_at": ((up.updated_at or up.created_at) + timedelta(hours=UPLOAD_TTL_HOURS)).isoformat(),
+    }
+
+
+def _upload_hasher(upload_id: str, pos: int):
+    """SHA-256 state after the first `pos` bytes, from cache or by re-reading the prefix."""
+    with _upload_hash_lock:
+        cached = _upload_hashers.pop(upload_id, None)
+    if cached is not None and cached[0] == pos:
+        return cached[1]
+    METRICS.inc("upload_rehash_total")
+    h, left = hashlib.sha256(), pos
+    with open(_upload_path(upload_id), "rb") as fh:
+        while left > 0:
+            buf = fh.read(min(left, UPLOAD_CHUNK))
+            if not buf:
+                break
+            h.update(buf)
+            left -= len(buf)
+    return h
+
+
+def _upload_hasher_keep(upload_id: str, pos: int, h):
+    with _upload_hash_lock:
+        _upload_hashers[upload_id] = (pos, h)
+        while len(_upload_hashers) > 256:
+            _upload_hashers.popitem(last=False)
+
+
+def request_file(field: str = "file"):
+    """This request's file: multipart `field`, or a finalized upload named by `upload_id`."""
+    f = request.files.get(field)
+    if f is not None:
+        return f
+    upload_id = (request.form.get("upload_id") or request.args.get("upload_id")
+                 or (request.get_json(silent=True) or {}).get("upload_id"))
+    if not upload_id:
+        return None
+    up = _upload_get(str(upload_id))
+    if up.completed_at is None:
+        _json_abort(409, error="upload_incomplete", offset=up.received or 0)
+    fh = open(_upload_path(up.id), "rb")
+    g.setdefault("upload_files", []).append(fh)
+    return FileStorage(stream=fh, filename=up.filename, content_type=up.content_type)
+
+
+@app.teardown_request
+def upload_files_close(_exc=None):
+    for fh in g.pop("upload_files", ()):
+        fh.close()
+
+
+@app.post("/uploads")
+def upload_create():
+    """Body: {"filename", "content_type", "size"} (size optional but enables checks)."""
+    u = current_user_required()
+    data = request.get_json(silent=True) or {}
+    size = data.get("size")
+    if size is not None:
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            return jsonify({"error": "bad_size"}), 400
+        if size < 0 or size > UPLOAD_MAX_BYTES:
+            return jsonify({"error": "too_large", "max_bytes": UPLOAD_MAX_BYTES}), 413
+    up = Upload(id=secrets.token_urlsafe(16), user_id=u.id, filename=data.get("filename"),
+                content_type=data.get("content_type"), size=size, received=0)
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    open(_upload_path(up.id), "wb").close()
+    db.session.add(up)
+    db.session.commit()
+    return jsonify(_upload_status(up)), 201
+
+
+@app.get("/uploads/<upload_id>")
+def upload_status(upload_id):
+    return jsonify(_upload_status(_upload_get(upload_id)))
+
+
+@app.put("/uploads/<upload_id>")
+def upload_chunk(upload_id):
+    """Raw chunk body written at ?offset= (or the Upload-Offset header)."""
+    up = _upload_get(upload_id)
+    if up.completed_at is not None:
+        return jsonify({"error": "upload_complete"}), 409
+    try:
+        offset = int(request.args.get("offset", request.headers.get("Upload-Offset", "")))
+    except ValueError:
+        return jsonify({"error": "bad_offset"}), 400
+    length = request.content_length
+    if length is None:
+        return jsonify({"error": "length_required"}), 411
+    if length > UPLOAD_MAX_CHUNK:
+        return jsonify({"error": "chunk_too_large", "max_chunk": UPLOAD_MAX_CHUNK}), 413
+    limit = up.size if up.size is not None else UPLOAD_MAX_BYTES
+    with open(_upload_path(up.id), "ab") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)  # one writer per upload across workers
+        current = os.fstat(fh.fileno()).st_size
+        if offset + length <= current:
+            return jsonify(dict(_upload_status(up), offset=current))  # retried chunk we already have
+        if offset != current:
+            return jsonify({"error": "offset_mismatch", "offset": current}), 409
+        if current + length > limit:
+            return jsonify({"error": "too_large", "max_bytes": limit}), 413
+        h = _upload_hasher(up.id, current)
+        n = 0
+        while True:
+            buf = request.stream.read(64 * 1024)
+            if not buf:
+                break
+            fh.write(buf)
+            h.update(buf)
+            n += len(buf)
+        fh.flush()
+        # a cut-off chunk still leaves a valid prefix; the client resumes from `offset`
+        _upload_hasher_keep(up.id, current + n, h)
+    up.received = current + n
+    up.updated_at = datetime.utcnow()
+    db.session.commit()
+    METRICS.inc("upload_bytes_total", n)
+    resp = jsonify(_upload_status(up))
+    resp.headers["Upload-Offset"] = str(up.received)
+    return resp
+
+
+@app.post("/uploads/<upload_id>/finalize")
+def upload_finalize(upload_id):
+    """Body: {"sha256": "<hex>"} (optional) -> seals the upload; 422 if the hash differs."""
+    up = _upload_get(upload_id)
+    if up.completed_at is not None:
+        return jsonify(_upload_status(up))
+    size = os.path.getsize(_upload_path(up.id))
+    if up.size is not None and size != up.size:
+        return jsonify({"error": "upload_incomplete", "offset": size, "size": up.size}), 409
+    digest = _upload_hasher(up.id, size).hexdigest()
+    expected = str((request.get_json(silent=True) or {}).get("sha256") or "").lower()
+    if expected and expected != digest:
+        return jsonify({"error": "hash_mismatch", "sha256": digest}), 422
+    with _upload_hash_lock:
+        _upload_hashers.pop(up.id, None)
+    up.size = up.received = size
+    up.sha256 = digest
+    up.completed_at = up.updated_at = datetime.utcnow()
+    db.session.commit()
+    return jsonify(_upload_status(up))
+
+
+@app.delete("/uploads/<upload_id>")
+def upload_delete(upload_id):
+    up = _upload_get(upload_id)
+    db.session.delete(up)
+    db.session.commit()
+    try:
+        os.remove(_upload_path(upload_id))
+    except OSError:
+        pass
+    return jsonify({"ok": True})
+
+
+# ---------- Blob store (content-addressed files: OCR sources, avatars) ----------
+# Each distinct file is stored once, named by its SHA-256, under BLOB_DIR and
+# served from GET /blobs/<sha256>. A URL never changes content, so responses
+# use the hash as ETag (If-None-Match is answered before touching the disk),
+# support Range, and are cacheable for a year. send_file hands the open file
+# to the server's wsgi.file_wrapper (sendfile where the server supports it).
+# Reading one takes ownership: the user who stored the bytes (blob_owners)
+# asks with their bearer token, or follows the URL blob_url() gave them,
+# which carries ?u=<user id>&sig=<HMAC of user and hash> so <img> tags work
+# without headers. Anyone else gets 404, even with the hash.
+# ?w=<px> returns a thumbnail (width snapped to THUMB_SIZES), rendered on
+# first request in THUMB_POOL and kept in a byte-bounded LRU; files Pillow
+# can't read (PDF statements, or no Pillow) are served as-is. Blobs no OCR
+# row or avatar points at are removed by the "blobs" maintenance job.
+# The stored content type is whatever the uploader declared, so only
+# BLOB_INLINE_TYPES are served inline under it; anything else (HTML, SVG, ...)
+# goes out as an octet-stream attachment, always with nosniff, so an upload
+# can never run script on the API origin.
+BLOB_DIR = os.environ.get("OFFLINE_BLOB_DIR") or os.path.join(app.instance_path, "blobs")
+BLOB_MAX_AGE = 365 * 24 * 3600
+BLOB_GRACE_HOURS = int(os.environ.get("OFFLINE_BLOB_GRACE_HOURS", "24"))
+BLOB_REF_RE = re.compile(r"/blobs/([0-9a-f]{64})")
+BLOB_IMAGE_TYPES = ("image/png", "image/jpeg", "image/gif", "image/webp")
+BLOB_INLINE_TYPES = BLOB_IMAGE_TYPES + ("application/pdf",)
+THUMB_SIZES = (64, 128, 256, 512)
+THUMB_CACHE_BYTES = int(os.environ.get("OFFLINE_THUMB_CACHE_MB", "64")) * 1024 * 1024
+THUMB_POOL = cpu_pool(int(os.environ.get("OFFLINE_THUMB_WORKERS", "2")), "thumb")
+
+_thumb_cache = OrderedDict()  # (sha256, width) -> (bytes, mimetype), or None if not an image
+_thumb_cache_bytes = 0
+_thumb_pending = {}  # (sha256, width) -> Future of the render in progress
+_thumb_lock = threading.Lock()
+
+
+def _blob_path(sha: str) -> str:
+    return os.path.join(BLOB_DIR, sha[:2], sha)
+
+
+def _blob_sig(user_id: int, sha: str) -> str:
+    return hmac.new(SECRET.encode(), f"blob:{user_id}:{sha}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def blob_url(sha: str, user_id: int) -> str:
+    """Signed URL for `user_id` (an owner) to read the blob without a bearer token."""
+    return f"{request.host_url.rstrip('/')}/blobs/{sha}?u={user_id}&sig={_blob_sig(user_id, sha)}"
+
+
+def blob_put(f, content_type: Optional[str] = None, owner: Optional[int] = None) -> str:
+    """Store a file (FileStorage or binary file object) by content; returns its SHA-256."""
+    stream = getattr(f, "stream", f)
+    tmp_dir = os.path.join(BLOB_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    h, size = hashlib.sha256(), 0
+    fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                buf = stream.read(UPLOAD_CHUNK)
+                if not buf:
+                    break
+                out.write(buf)
+                h.update(buf)
+                size += len(buf)
+        sha = h.hexdigest()
+        path = _blob_path(sha)
+        METRICS.inc("blob_puts_total", outcome="dedup" if os.path.exists(path) else "new")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)  # same bytes either way; replacing also undoes a concurrent GC unlink
+        tmp = None
+    finally:
+        if tmp is not None:
+            os.remove(tmp)
+    with contextlib.suppress(Exception):
+        stream.seek(0)  # the caller may still want to read it
+    now = datetime.utcnow()
+    t = Blob.__table__
+    db.session.execute(insert(t).prefix_with("OR IGNORE").values(
+        sha256=sha, size=size, content_type=content_type or getattr(f, "mimetype", None) or None, stored_at=now))
+    db.session.execute(t.update().where(t.c.sha256 == sha).values(stored_at=now))
+    if owner is not None:
+        db.session.execute(insert(BlobOwner.__table__).prefix_with("OR IGNORE").values(sha256=sha, user_id=owner))
+    db.session.commit()
+    return sha
+
+
+def _blob_reader(sha: str) -> Optional[int]:
+    """The requesting user if they own `sha` (signed URL first, then bearer), else None."""
+    uid = request.args.get("u", type=int)
+    if uid is None or not hmac.compare_digest(request.args.get("sig", ""), _blob_sig(uid, sha)):
+        uid = g.user.id if g.get("user") is not None else None
+    if uid is None or db.session.get(BlobOwner, (sha, uid)) is None:
+        return None
+    return uid
+
+
+def _thumb_render(path: str, width: int):
+    Image = pil_image()
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as im:
+            im.thumbnail((width, width))
+            out = io.BytesIO()
+            if im.mode in ("RGBA", "LA", "P"):
+                im.save(out, "PNG", optimize=True)
+                return out.getvalue(), "image/png"
+            im.convert("RGB").save(out, "JPEG", quality=82)
+            return out.getvalue(), "image/jpeg"
+    except Exception:  # not an image Pillow can read
+        return None
+
+
+def _thumbnail(sha: str, width: int):
+    """(bytes, mimetype) of the thumbnail, or None; concurrent requests share one render."""
+    global _thumb_cache_bytes
+    key = (sha, width)
+    with _thumb_lock:
+        if key in _thumb_cache:
+            _thumb_cache.move_to_end(key)
+            METRICS.inc("thumb_cache_total", outcome="hit")
+            return _thumb_cache[key]
+        fut = _thumb_pending.get(key)
+        if fut is None:
+            METRICS.inc("thumb_cache_total", outcome="miss")
+            fut = _thumb_pending[key] = THUMB_POOL.submit(_thumb_render, _blob_path(sha), width)
+    result = fut.result()
+    with _thumb_lock:
+        if _thumb_pending.pop(key, None) is not None:  # first waiter back caches it
+            _thumb_cache[key] = result
+            _thumb_cache_bytes += len(result[0]) if result else 64
+            while _thumb_cache_bytes > THUMB_CACHE_BYTES and _thumb_cache:
+                _, old = _thumb_cache.popitem(last=False)
+                _thumb_cache_bytes -= len(old[0]) if old else 64
+    return result
+
+
+def _blob_cacheable(resp, etag: str):
+    resp.set_etag(etag)
+    resp.headers["X-Content-Type-Options"] = "nosniff"
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    resp.cache_control.max_age = BLOB_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp
+
+
+@app.get("/blobs/<sha256>")
+def blob_get(sha256):
+    """?w=<px> for a thumbnail."""
+    if not re.fullmatch(r"[0-9a-f]{64}", sha256) or _blob_reader(sha256) is None:
+        return jsonify({"error": "not_found"}), 404
+    width = request.args.get("w", type=int)
+    if width:
+        width = next((s for s in THUMB_SIZES if s >= width), THUMB_SIZES[-1])
+    etag = f"{sha256}-{width}" if width else sha256
+    if request.if_none_match.contains(etag):  # content-addressed: a matching tag is always current
+        return _blob_cacheable(Response(status=304), etag)
+    path = _blob_path(sha256)
+    b = db.session.get(Blob, sha256)
+    if b is None or not os.path.exists(path):
+        return jsonify({"error": "not_found"}), 404
+    if width:
+        thumb = _thumbnail(sha256, width)
+        if thumb is not None:
+            resp = _blob_cacheable(Response(thumb[0], mimetype=thumb[1]), etag)
+            return resp.make_conditional(request.environ, accept_ranges=True, complete_length=len(thumb[0]))
+    inline = (b.content_type or "").lower() in BLOB_INLINE_TYPES
+    resp = send_file(path, mimetype=b.content_type.lower() if inline else "application/octet-stream",
+                     as_attachment=not inline, download_name=sha256, conditional=True,
+                     etag=etag, last_modified=b.stored_at, max_age=BLOB_MAX_AGE)
+    return _blob_cacheable(resp, etag)
+
+
+# ---------- Vision: shared helpers ----------
+def _image_size(f, default=(640, 480)):
+    """(width, height) of an uploaded image, or `default` if it can't be read."""
     try:
-        if f is not None and Image is not None:
-            im = Image.open(f.stream)
-            w, h = im.size
+        if f is not None and pil_image() is not None:
+            return pil_image().open(f.stream).size
     except Exception:
         pass
-    boxes = [
-        {"label": "Rose", "conf": 0.95, "xyxy": [int(0.05 * w), int(0.15 * h), int(0.45 * w), int(0.70 * h)], "color": "#ef4444"},
-        {"label": "Tulip","conf": 0.88, "xyxy": [int(0.55 * w), int(0.25 * h), int(0.90 * w), int(0.70 * h)], "color": "#22c55e"},
-        {"label": "Sunflower","conf": 0.82, "xyxy": [int(0.62 * w), int(0.06 * h), int(0.95 * w), int(0.24 * h)], "color": "#06b6d4"},
+    return default
+
+
+# ---------- Vision: detection post-processing (NMS) ----------
+# Detectors emit raw candidates (normalized xyxy, score, class index); this
+# stage filters by `conf`, runs class-wise NMS at `iou`, keeps the top
+# `max_det` and scales to the image size, as NumPy array ops when NumPy is
+# installed (pure-Python fallback otherwise). Request params: ?conf=&iou=
+# &max_det=&format=boxes|columnar. "columnar" returns parallel arrays instead
+# of one dict per box, for clients that handle thousands of boxes.
+DET_CONF = float(os.environ.get("OFFLINE_DET_CONF", "0.25"))
+DET_IOU = float(os.environ.get("OFFLINE_DET_IOU", "0.45"))
+DET_MAX = int(os.environ.get("OFFLINE_DET_MAX", "300"))
+
+
+def _numpy():
+    try:
+        import numpy
+    except Exception:  # optional dependency
+        return None
+    return numpy
+
+
+def detection_params() -> dict:
+    """conf / iou / max_det / format from the query string or form, clamped; bad values -> defaults."""
+    def num(name, cast, default, lo, hi):
+        try:
+            return min(hi, max(lo, cast(request.values.get(name, default))))
+        except (TypeError, ValueError):
+            return default
+    fmt = (request.values.get("format") or "boxes").lower()
+    return {"conf": num("conf", float, DET_CONF, 0.0, 1.0), "iou": num("iou", float, DET_IOU, 0.0, 1.0),
+            "max_det": num("max_det", int, DET_MAX, 1, 10_000),
+            "format": fmt if fmt in ("boxes", "columnar") else "boxes"}
+
+
+def nms_postprocess(boxes, scores, classes, conf=DET_CONF, iou=DET_IOU, max_det=DET_MAX, size=(1, 1)):
+    """
+    Candidates -> (xyxy, scores, classes) of the kept boxes, best first.
+    `boxes` are normalized xyxy; `size` = (width, height) to scale them to.
+    """
+    np = _numpy()
+    if np is None:
+        return _nms_python(boxes, scores, classes, conf, iou, max_det, size)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).ravel()
+    classes = np.asarray(classes, dtype=np.int64).ravel()
+
+    keep = scores >= conf
+    boxes, scores, classes = boxes[keep], scores[keep], classes[keep]
+    order = np.argsort(-scores, kind="stable")
+    boxes, scores, classes = boxes[order], scores[order], classes[order]
+
+    # class-wise NMS in a single pass: shift each class into its own coordinate range
+    shifted = boxes + classes[:, None] * (boxes.max(initial=0.0) + 1.0)
+    x1, y1, x2, y2 = shifted.T
+    areas = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    alive = np.ones(len(shifted), dtype=bool)
+    kept = []
+    for i in range(len(shifted)):
+        if not alive[i]:
+            continue
+        kept.append(i)
+        if len(kept) >= max_det:
+            break
+        rest = np.nonzero(alive[i + 1:])[0] + i + 1
+        iw = np.clip(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0, None)
+        ih = np.clip(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0, None)
+        inter = iw * ih
+        alive[rest[inter / (areas[i] + areas[rest] - inter + 1e-12) > iou]] = False
+
+    kept = np.asarray(kept, dtype=np.int64)
+    w, h = size
+    xyxy = boxes[kept] * np.array([w, h, w, h], dtype=np.float64)
+    xyxy = np.clip(xyxy, 0, [w, h, w, h]).astype(np.int64)
+    return xyxy.tolist(), scores[kept].tolist(), classes[kept].tolist()
+
+
+def _nms_python(boxes, scores, classes, conf, iou, max_det, size):
+    cands = sorted(((s, int(c), tuple(b)) for b, s, c in zip(boxes, scores, classes) if s >= conf),
+                   key=lambda t: -t[0])
+    area = lambda b: max(0.0, b[2] - b[0]) * max(0.0, b[3] - b[1])
+    kept = []
+    for s, c, b in cands:
+        if len(kept) >= max_det:
+            break
+        ok = True
+        for _s, kc, kb in kept:
+            if kc != c:
+                continue
+            inter = max(0.0, min(b[2], kb[2]) - max(b[0], kb[0])) * max(0.0, min(b[3], kb[3]) - max(b[1], kb[1]))
+            if inter / (area(b) + area(kb) - inter + 1e-12) > iou:
+                ok = False
+                break
+        if ok:
+            kept.append((s, c, b))
+    w, h = size
+    xyxy = [[int(min(max(v * m, 0), m)) for v, m in zip(b, (w, h, w, h))] for _s, _c, b in kept]
+    return xyxy, [s for s, _c, _b in kept], [c for _s, c, _b in kept]
+
+
+def detection_result(raw, classes, width: int, height: int, params: Optional[dict] = None) -> dict:
+    """
+    Detector response from raw candidates [(x1, y1, x2, y2, score, cls), ...]
+    (normalized coords) and `classes` [(label, color), ...].
+    """
+    p = params or {"conf": DET_CONF, "iou": DET_IOU, "max_det": DET_MAX, "format": "boxes"}
+    xyxy, scores, cls = nms_postprocess([r[:4] for r in raw], [r[4] for r in raw], [r[5] for r in raw],
+                                        p["conf"], p["iou"], p["max_det"], (width, height))
+    out = {"image": {"width": width, "height": height}}
+    if p["format"] == "columnar":
+        out["names"] = [label for label, _color in classes]
+        out["colors"] = [color for _label, color in classes]
+        out["boxes"] = {"xyxy": [v for b in xyxy for v in b], "conf": [round(s, 4) for s in scores], "cls": cls}
+        out["count"] = len(cls)
+    else:
+        out["boxes"] = [{"label": classes[c][0], "conf": round(s, 4), "xyxy": b, "color": classes[c][1]}
+                        for b, s, c in zip(xyxy, scores, cls)]
+    return out
+
+
+# ---------- Vision: Flower (YOLO-style dummy) ----------
+FLOWER_CLASSES = (("Rose", "#ef4444"), ("Tulip", "#22c55e"), ("Sunflower", "#06b6d4"))
+
+
+def _flower_detect(f, params=None):
+    w, h = _image_size(f)
+    raw = [  # x1, y1, x2, y2 (normalized), score, class
+        (0.05, 0.15, 0.45, 0.70, 0.95, 0),
+        (0.55, 0.25, 0.90, 0.70, 0.88, 1),
+        (0.62, 0.06, 0.95, 0.24, 0.82, 2),
     ]
-    return jsonify({"image": {"width": w, "height": h}, "boxes": boxes})
+    return detection_result(raw, FLOWER_CLASSES, w, h, params)
+
+
+@app.post("/vision/flower/detect")
+def flower_detect():
+    current_user_required()
+    return jsonify(_flower_detect(request_file(), detection_params()))
 
 
 # ---------- Vision: Person (YOLO-style dummy) ----------
+PERSON_CLASSES = (("Person", "#3b82f6"), ("Person", "#10b981"), ("Face", "#f59e0b"), ("Upper Body", "#ef4444"))
+
+
+def _person_detect(f, params=None):
+    w, h = _image_size(f)
+    raw = [
+        (0.06, 0.12, 0.42, 0.86, 0.97, 0),
+        (0.55, 0.18, 0.92, 0.88, 0.94, 1),
+        (0.16, 0.18, 0.28, 0.34, 0.91, 2),
+        (0.62, 0.36, 0.88, 0.70, 0.88, 3),
+    ]
+    return detection_result(raw, PERSON_CLASSES, w, h, params)
+
+
 @app.post("/vision/person/detect")
 def person_detect():
     current_user_required()
-    f = request.files.get("file")
-    w, h = 640, 480
-    try:
-        if f is not None and Image is not None:
-            im = Image.open(f.stream)
-            w, h = im.size
-    except Exception:
-        pass
-    boxes = [
-        {"label": "Person","conf": 0.97, "xyxy": [int(0.06 * w), int(0.12 * h), int(0.42 * w), int(0.86 * h)], "color": "#3b82f6"},
-        {"label": "Person","conf": 0.94, "xyxy": [int(0.55 * w), int(0.18 * h), int(0.92 * w), int(0.88 * h)], "color": "#10b981"},
-        {"label": "Face","conf": 0.91, "xyxy": [int(0.16 * w), int(0.18 * h), int(0.28 * w), int(0.34 * h)], "color": "#f59e0b"},
-        {"label": "Upper Body","conf": 0.88, "xyxy": [int(0.62 * w), int(0.36 * h), int(0.88 * w), int(0.70 * h)], "color": "#ef4444"},
-    ]
-    return jsonify({"image": {"width": w, "height": h}, "boxes": boxes})
+    return jsonify(_person_detect(request_file(), detection_params()))
 
 
 # ---------- Vision: Pet (YOLO-style dummy) ----------
+PET_CLASSES = (("Dog", "#10b981"), ("Cat", "#f59e0b"), ("Collar", "#3b82f6"))
+
+
+def _pet_detect(f, params=None):
+    w, h = _image_size(f)
+    raw = [
+        (0.08, 0.45, 0.52, 0.92, 0.96, 0),
+        (0.60, 0.30, 0.92, 0.78, 0.92, 1),
+        (0.22, 0.70, 0.36, 0.78, 0.85, 2),
+    ]
+    return detection_result(raw, PET_CLASSES, w, h, params)
+
+
 @app.post("/vision/pet/detect")
 def pet_detect():
     current_user_required()
-    f = request.files.get("file")
-    w, h = 640, 480
-    try:
-        if f is not None and Image is not None:
-            im = Image.open(f.stream)
-            w, h = im.size
-    except Exception:
-        pass
-    boxes = [
-        {"label": "Dog","conf": 0.96, "xyxy": [int(0.08 * w), int(0.45 * h), int(0.52 * w), int(0.92 * h)], "color": "#10b981"},
-        {"label": "Cat","conf": 0.92, "xyxy": [int(0.60 * w), int(0.30 * h), int(0.92 * w), int(0.78 * h)], "color": "#f59e0b"},
-        {"label": "Collar","conf": 0.85, "xyxy": [int(0.22 * w), int(0.70 * h), int(0.36 * w), int(0.78 * h)], "color": "#3b82f6"},
-    ]
-    return jsonify({"image": {"width": w, "height": h}, "boxes": boxes})
+    return jsonify(_pet_detect(request_file(), detection_params()))
 
 
 # ---------- Vision: Vehicle (YOLO-style dummy) ----------
+VEHICLE_CLASSES = (("Vehicle: Car", "#ef4444"), ("Vehicle: Truck", "#06b6d4"), ("Wheel", "#22c55e"),
+                   ("Headlight", "#f59e0b"))
+
+
+def _vehicle_detect(f, params=None):
+    w, h = _image_size(f)
+    raw = [
+        (0.06, 0.40, 0.60, 0.88, 0.97, 0),
+        (0.62, 0.32, 0.94, 0.82, 0.90, 1),
+        (0.20, 0.78, 0.30, 0.90, 0.86, 2),
+        (0.50, 0.52, 0.58, 0.60, 0.83, 3),
+    ]
+    return detection_result(raw, VEHICLE_CLASSES, w, h, params)
+
+
 @app.post("/vision/vehicle/detect")
 def vehicle_detect():
     current_user_required()
-    f = request.files.get("file")
-    w, h = 640, 480
-    try:
-        if f is not None and Image is not None:
-            im = Image.open(f.stream)
-            w, h = im.size
-    except Exception:
-        pass
-    boxes = [
-        {"label": "Vehicle: Car","conf": 0.97, "xyxy": [int(0.06 * w), int(0.40 * h), int(0.60 * w), int(0.88 * h)], "color": "#ef4444"},
-        {"label": "Vehicle: Truck","conf": 0.90, "xyxy": [int(0.62 * w), int(0.32 * h), int(0.94 * w), int(0.82 * h)], "color": "#06b6d4"},
-        {"label": "Wheel","conf": 0.86, "xyxy": [int(0.20 * w), int(0.78 * h), int(0.30 * w), int(0.90 * h)], "color": "#22c55e"},
-        {"label": "Headlight","conf": 0.83, "xyxy": [int(0.50 * w), int(0.52 * h), int(0.58 * w), int(0.60 * h)], "color": "#f59e0b"},
-    ]
-    return jsonify({"image": {"width": w, "height": h}, "boxes": boxes})
+    return jsonify(_vehicle_detect(request_file(), detection_params()))
 
 
 # ---------- Vision: Food Classification (mock) ----------
-@app.post("/vision/food/classify")
-def vision_food_classify():
-    current_user_required()
-    width, height = 640, 480
-    try:
-        f = request.files.get("file")
-        if f and Image is not None:
-            img = Image.open(f.stream); width, height = img.size
-    except Exception:
-        pass
+def _food_classify(f):
+    width, height = _image_size(f)
     classes = [
         {"label": "Italian Cuisine", "confidence": 0.95},
         {"label": "Pasta", "confidence": 0.88},
         {"label": "Tomato Sauce", "confidence": 0.82},
     ]
-    return jsonify({"image": {"width": width, "height": height}, "classes": classes})
+    return {"image": {"width": width, "height": height}, "classes": classes}
 
 
-# ---------- Vision: person Classification (mock) ----------
-@app.post("/vision/person/classify")
-def vision_person_classify():
+@app.post("/vision/food/classify")
+def vision_food_classify():
     current_user_required()
-    import time
+    return jsonify(_food_classify(request_file()))
+
+
+# ---------- Vision: person Classification (mock) ----------
+def _person_classify(f):
     t0 = time.time()
-    width, height = 640, 480
-    try:
-        f = request.files.get("file")
-        if f and Image is not None:
-            img = Image.open(f.stream)
-            width, height = img.size
-    except Exception:
-        pass
+    width, height = _image_size(f)
     classes = [
         {"label": "Person Detected", "confidence": 0.98},
         {"label": "Frontal Face", "confidence": 0.93},
@@ -283,58 +1111,48 @@ def vision_person_classify():
         {"label": "Wearing Glasses", "confidence": 0.67},
         {"label": "Upper Body Visible", "confidence": 0.81},
     ]
-    payload = {
+    return {
         "image": {"width": width, "height": height},
         "classes": classes,
         "model": {"name": "mock-person-v1", "version": "1.0.0"},
         "meta": {"elapsed_ms": int((time.time() - t0) * 1000)},
     }
-    return jsonify(payload), 200
 
 
-# ---------- Vision: Pet Classification (mock) ----------
-@app.post("/vision/pet/classify")
-def vision_pet_classify():
+@app.post("/vision/person/classify")
+def vision_person_classify():
     current_user_required()
-    import time
+    return jsonify(_person_classify(request_file())), 200
+
+
+# ---------- Vision: Pet Classification (mock) ----------
+def _pet_classify(f):
     t0 = time.time()
-    width, height = 640, 480
-    try:
-        f = request.files.get("file")
-        if f and Image is not None:
-            img = Image.open(f.stream)
-            width, height = img.size
-    except Exception:
-        pass
+    width, height = _image_size(f)
     classes = [
         {"label": "Pet Detected", "confidence": 0.98},
         {"label": "Animal: Dog", "confidence": 0.94},
         {"label": "Animal: Cat", "confidence": 0.86},
         {"label": "Wearing Collar", "confidence": 0.72},
     ]
-    payload = {
+    return {
         "image": {"width": width, "height": height},
         "classes": classes,
         "model": {"name": "mock-pet-v1", "version": "1.0.0"},
         "meta": {"elapsed_ms": int((time.time() - t0) * 1000)},
     }
-    return jsonify(payload), 200
 
 
-# ---------- Vision: Vehicle Classification (mock) ----------
-@app.post("/vision/vehicle/classify")
-def vision_vehicle_classify():
+@app.post("/vision/pet/classify")
+def vision_pet_classify():
     current_user_required()
-    import time
+    return jsonify(_pet_classify(request_file())), 200
+
+
+# ---------- Vision: Vehicle Classification (mock) ----------
+def _vehicle_classify(f):
     t0 = time.time()
-    width, height = 640, 480
-    try:
-        f = request.files.get("file")
-        if f and Image is not None:
-            img = Image.open(f.stream)
-            width, height = img.size
-    except Exception:
-        pass
+    width, height = _image_size(f)
     classes = [
         {"label": "Vehicle Detected", "confidence": 0.98},
         {"label": "Type: Car",        "confidence": 0.92},
@@ -342,13 +1160,633 @@ def vision_vehicle_classify():
         {"label": "View: Side",       "confidence": 0.76},
         {"label": "Color: Red",       "confidence": 0.64},
     ]
-    payload = {
+    return {
         "image": {"width": width, "height": height},
         "classes": classes,
         "model": {"name": "mock-vehicle-v1", "version": "1.0.0"},
         "meta": {"elapsed_ms": int((time.time() - t0) * 1000)},
     }
-    return jsonify(payload), 200
+
+
+@app.post("/vision/vehicle/classify")
+def vision_vehicle_classify():
+    current_user_required()
+    return jsonify(_vehicle_classify(request_file())), 200
+
+
+# ---------- Vision: batch (many images, NDJSON results as they finish) ----------
+# POST /vision/<kind>/<task>/batch with several multipart `file`/`files`
+# parts and/or upload_ids (form field, comma-separated, or a JSON list).
+# Images run concurrently on VISION_POOL; each finished image is written as
+# one NDJSON line {"index", "name", "ok", "result"|"error"} in completion
+# order, and a failed image never fails the batch. The last line is
+# {"done": true, "count", "failed", "elapsed_ms"}.
+VISION_TASKS = {
+    ("flower", "detect"): _flower_detect, ("person", "detect"): _person_detect,
+    ("pet", "detect"): _pet_detect, ("vehicle", "detect"): _vehicle_detect,
+    ("food", "classify"): _food_classify, ("person", "classify"): _person_classify,
+    ("pet", "classify"): _pet_classify, ("vehicle", "classify"): _vehicle_classify,
+}
+VISION_BATCH_MAX = int(os.environ.get("OFFLINE_VISION_BATCH_MAX", "500"))
+VISION_WORKERS = int(os.environ.get("OFFLINE_VISION_WORKERS", str(min(8, os.cpu_count() or 2))))
+VISION_POOL = cpu_pool(VISION_WORKERS, "vision")
+
+
+def _batch_inputs():
+    """[(name, opener, error)] per image, in request order; opener() is a context manager."""
+    items = []
+    for f in request.files.getlist("file") + request.files.getlist("files"):
+        items.append((f.filename, (lambda f=f: contextlib.nullcontext(f)), None))
+    raw = request.form.getlist("upload_ids") or request.form.getlist("upload_id")
+    if not raw:
+        body = request.get_json(silent=True) or {}
+        raw = body.get("upload_ids") or []
+    ids = [i.strip() for v in raw for i in (v.split(",") if isinstance(v, str) else [str(v)]) if i.strip()]
+    ups = {up.id: up for up in Upload.query.filter(Upload.id.in_(ids), Upload.user_id == g.user.id)} if ids else {}
+    for upload_id in ids:
+        up = ups.get(upload_id)
+        if up is None:
+            items.append((upload_id, None, "upload_not_found"))
+        elif up.completed_at is None:
+            items.append((upload_id, None, "upload_incomplete"))
+        else:
+            path, name, ctype = _upload_path(up.id), up.filename, up.content_type
+            items.append((upload_id, (lambda p=path, n=name, t=ctype: contextlib.closing(
+                FileStorage(stream=open(p, "rb"), filename=n, content_type=t))), None))
+    return items
+
+
+def _batch_run(fn, opener):
+    with opener() as f:  # closes upload files we opened; multipart parts belong to the request
+        return fn(f)
+
+
+@app.post("/vision/<kind>/<task>/batch")
+def vision_batch(kind, task):
+    current_user_required()
+    fn = VISION_TASKS.get((kind, task))
+    if fn is None:
+        return jsonify({"error": "unknown_model"}), 404
+    if task == "detect":
+        fn = functools.partial(fn, params=detection_params())
+    items = _batch_inputs()
+    if not items:
+        return jsonify({"error": "no_images"}), 400
+    if len(items) > VISION_BATCH_MAX:
+        return jsonify({"error": "too_many_images", "max": VISION_BATCH_MAX}), 413
+
+    def generate():
+        t0 = time.perf_counter()
+        futures, failed = {}, 0
+        for i, (name, opener, err) in enumerate(items):
+            if err is not None:
+                failed += 1
+                yield json.dumps({"index": i, "name": name, "ok": False, "error": err}) + "\n"
+            else:
+                futures[VISION_POOL.submit(_batch_run, fn, opener)] = (i, name)
+        for fut in as_completed(futures):
+            i, name = futures[fut]
+            try:
+                line = {"index": i, "name": name, "ok": True, "result": fut.result()}
+            except Exception as e:
+                failed += 1
+                line = {"index": i, "name": name, "ok": False, "error": type(e).__name__}
+            yield json.dumps(line) + "\n"
+        METRICS.inc("vision_batch_images_total", len(items), model=f"{kind}/{task}")
+        yield json.dumps({"done": True, "count": len(items), "failed": failed,
+                          "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1)}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+# ---------- Metrics (Prometheus text format) ----------
+# Registered first so timings include admission control. Everything is plain
+# dict updates under one lock: cheap enough to leave on in production.
+METRICS_TOKEN = os.environ.get("OFFLINE_METRICS_TOKEN")  # if set, required as X-Metrics-Token
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SQL_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class _Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> float
+        self.gauges = {}      # (name, labels) -> float
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.bounds = {}      # histogram name -> bucket upper bounds
+        self.help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1.0, **labels):
+        k = self._key(name, labels)
+        with self.lock:
+            self.counters[k] = self.counters.get(k, 0.0) + value
+
+    def gauge_add(self, name, value, **labels):
+        k = self._key(name, labels)
+        with self.lock:
+            self.gauges[k] = self.gauges.get(k, 0.0) + value
+
+    def observe(self, name, value, bounds=LATENCY_BUCKETS, **labels):
+        k = self._key(name, labels)
+        with self.lock:
+            h = self.histograms.get(k)
+            if h is None:
+                self.bounds.setdefault(name, bounds)
+                h = self.histograms[k] = [0] * (len(bounds) + 2)
+            for i, b in enumerate(self.bounds[name]):
+                if value <= b:
+                    h[i] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+
+    def describe(self, name, kind, text_):
+        self.help[name] = (kind, text_)
+
+    def render(self) -> str:
+        def fmt(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+        with self.lock:
+            counters = dict(self.counters); gauges = dict(self.gauges)
+            hists = {k: list(v) for k, v in self.histograms.items()}
+        out, seen = [], set()
+
+        def header(name, default_kind):
+            if name in seen:
+                return
+            seen.add(name)
+            kind, help_ = self.help.get(name, (default_kind, name))
+            out.append(f"# HELP {name} {help_}")
+            out.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), v in sorted(counters.items()):
+            header(name, "counter")
+            out.append(f"{name}{fmt(labels)} {v:g}")
+        for (name, labels), v in sorted(gauges.items()):
+            header(name, "gauge")
+            out.append(f"{name}{fmt(labels)} {v:g}")
+        for (name, labels), h in sorted(hists.items()):
+            header(name, "histogram")
+            acc = 0
+            for b, n in zip(self.bounds[name], h):
+                acc += n
+                out.append(f"{name}_bucket{fmt(labels, [('le', f'{b:g}')])} {acc}")
+            out.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {h[-1]}")
+            out.append(f"{name}_sum{fmt(labels)} {h[-2]:g}")
+            out.append(f"{name}_count{fmt(labels)} {h[-1]}")
+        return "\n".join(out) + "\n"
+
+
+METRICS = _Metrics()
+REQUESTS_SEEN = 0
+METRICS.describe("http_requests_total", "counter", "HTTP requests by route template, method and status")
+METRICS.describe("http_request_duration_seconds", "histogram", "HTTP request latency by route template")
+METRICS.describe("http_requests_in_flight", "gauge", "HTTP requests currently being served")
+METRICS.describe("sql_statements_per_request", "histogram", "SQL statements issued per HTTP request")
+METRICS.describe("sql_statements_total", "counter", "SQL statements by route template")
+METRICS.describe("sql_seconds_total", "counter", "Time spent executing SQL by route template")
+METRICS.describe("socket_connections_total", "counter", "Socket.IO connections accepted")
+METRICS.describe("socket_connected", "gauge", "Socket.IO clients currently connected")
+METRICS.describe("socket_emits_total", "counter", "Socket.IO events emitted")
+METRICS.describe("credit_charges_total", "counter", "Credit charge outcomes by kind")
+METRICS.describe("idempotency_requests_total", "counter", "Requests carrying an Idempotency-Key, by outcome")
+METRICS.describe("blob_puts_total", "counter", "Files written to the blob store (new or deduplicated)")
+METRICS.describe("thumb_cache_total", "counter", "Thumbnail lookups by cache outcome")
+METRICS.describe("conditional_requests_total", "counter", "Validated GETs answered 304 vs full body")
+METRICS.describe("compressed_responses_total", "counter", "Responses compressed, by Content-Encoding")
+METRICS.describe("compressed_bytes_saved_total", "counter", "Bytes saved by response compression")
+
+
+def _route_label() -> str:
+    rule = request.url_rule
+    return rule.rule if rule is not None else "<unmatched>"
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _sql_before(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("_t0", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _sql_after(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get("_t0")
+    if not stack:
+        return
+    elapsed = time.perf_counter() - stack.pop()
+    if has_request_context() and "metrics_t0" in g:
+        g.sql_count = g.get("sql_count", 0) + 1
+        g.sql_time = g.get("sql_time", 0.0) + elapsed
+        prof = g.get("debug_profile")
+        if prof is not None:
+            profile_record_sql(prof, statement, elapsed)
+
+
+@app.before_request
+def metrics_start():
+    global REQUESTS_SEEN
+    REQUESTS_SEEN += 1  # traffic signal for the maintenance scheduler
+    if SERVE_WORKERS > 1:
+        traffic_flush()
+    g.metrics_t0 = time.perf_counter()
+    g.metrics_route = _route_label()
+    METRICS.gauge_add("http_requests_in_flight", 1, route=g.metrics_route)
+
+
+@app.after_request
+def metrics_status(resp):
+    g.metrics_status = resp.status_code
+    return resp
+
+
+@app.teardown_request
+def metrics_finish(_exc=None):
+    t0 = g.pop("metrics_t0", None)
+    if t0 is None:
+        return
+    route = g.metrics_route
+    elapsed = time.perf_counter() - t0
+    status = g.get("metrics_status", 500)
+    METRICS.gauge_add("http_requests_in_flight", -1, route=route)
+    METRICS.inc("http_requests_total", route=route, method=request.method, status=status)
+    METRICS.observe("http_request_duration_seconds", elapsed, route=route)
+    n = g.get("sql_count", 0)
+    METRICS.observe("sql_statements_per_request", n, bounds=SQL_COUNT_BUCKETS, route=route)
+    if n:
+        METRICS.inc("sql_statements_total", n, route=route)
+        METRICS.inc("sql_seconds_total", g.get("sql_time", 0.0), route=route)
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get("X-Metrics-Token") != METRICS_TOKEN:
+        abort(403)
+    # per process: under serve.py each scrape answers from whichever worker
+    # accepted it, so scrapers should sum over the worker_info pid label
+    lines = [METRICS.render(),
+             "# HELP worker_info The worker process that answered this scrape\n# TYPE worker_info gauge\n",
+             f'worker_info{{pid="{os.getpid()}",workers="{SERVE_WORKERS}"}} 1\n']
+    adm = admission_stats()
+    lines.append("# HELP admission_inflight Requests in flight per route group\n# TYPE admission_inflight gauge\n")
+    lines += [f'admission_inflight{{group="{k}"}} {v}\n' for k, v in adm["inflight"].items()]
+    lines.append("# HELP admission_rejections_total Admission decisions per route group\n# TYPE admission_rejections_total counter\n")
+    for grp, st in adm["groups"].items():
+        lines += [f'admission_rejections_total{{group="{grp}",reason="{r}"}} {st[r]}\n'
+                  for r in ("rate_limited", "over_capacity", "credit_hint")]
+    resp = make_response("".join(lines))
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return resp
+
+
+# ---------- Admission control (rate limits / concurrency caps) ----------
+# Runs before attach_user, so a rejected request costs no DB work at all.
+# Buckets are keyed by user once attach_user has verified the token, and by
+# client address before that (anonymous, or a token not yet seen: keying by
+# the raw token would hand a fresh burst to every random token), and sized
+# by plan tier. At ADMISSION_MAX_BUCKETS, idle buckets are dropped first,
+# then the least recently used tenth, so memory stays bounded.
+ADMISSION_ENABLED = os.environ.get("OFFLINE_ADMISSION", "1") != "0"
+# All of this state is per process. Under serve.py (OFFLINE_WORKERS=N) the
+# concurrency caps here and the LLM semaphores are split across workers, so
+# the configured numbers stay server-wide totals. Rate buckets are not split:
+# keep-alive pins a client to one worker, so a per-worker bucket is close to
+# per-client, and a client spreading across workers gets at most N times it.
+SERVE_WORKERS = max(1, int(os.environ.get("OFFLINE_WORKERS", "1")))
+
+
+def per_worker(n: int) -> int:
+    """A server-wide limit -> this worker's share (at least 1)."""
+    return max(1, -(-n // SERVE_WORKERS))
+
+
+# (refill tokens/sec, burst) per plan and route group; None = unlimited
+ADMISSION_RATES = {
+    "anon":     {"chat": (0.2, 3),  "ocr": (0.1, 2), "vision": (0.5, 5),  "db": (2, 20),   "upload": (1, 5)},
+    "free":     {"chat": (0.5, 5),  "ocr": (0.2, 3), "vision": (1, 10),   "db": (10, 40),  "upload": (4, 40)},
+    "plus":     {"chat": (2, 20),   "ocr": (1, 10),  "vision": (4, 40),   "db": (40, 160), "upload": (8, 80)},
+    "business": {"chat": (4, 40),   "ocr": (2, 20),  "vision": (8, 80),   "db": (80, 320), "upload": (16, 160)},
+    "admin":    {"chat": None,      "ocr": None,     "vision": None,      "db": None,      "upload": None},
+}
+ADMISSION_CONCURRENCY = {
+    "chat": per_worker(int(os.environ.get("OFFLINE_MAX_INFLIGHT_CHAT", "64"))),
+    "ocr": per_worker(int(os.environ.get("OFFLINE_MAX_INFLIGHT_OCR", "8"))),
+    "vision": per_worker(int(os.environ.get("OFFLINE_MAX_INFLIGHT_VISION", "16"))),
+    "db": per_worker(int(os.environ.get("OFFLINE_MAX_INFLIGHT_DB", "128"))),
+    "upload": per_worker(int(os.environ.get("OFFLINE_MAX_INFLIGHT_UPLOAD", "32"))),
+}
+ADMISSION_MAX_BUCKETS = 50_000
+CREDIT_HINT_TTL = 30.0  # seconds an INSUFFICIENT_CREDITS answer is reused without DB
+
+
+def route_group(path: str) -> Optional[str]:
+    if path.startswith("/functions/"):
+        return "chat"
+    if path.startswith("/vision/ocr/"):
+        return "ocr"
+    if path.startswith("/vision/"):
+        return "vision"
+    if path.startswith("/uploads"):
+        return "upload"
+    if path.startswith("/db/") or path in ("/export", "/import", "/sync"):
+        return "db"
+    return None
+
+
+class _AdmissionState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}     # (principal, group) -> [tokens, last_ts]
+        self.principals = {}  # bearer token -> {"key": "u:<id>", "plan": str}
+        self.credit_hints = {}  # (principal, kind) -> (remaining, payload, expires)
+        self.inflight = {grp: 0 for grp in ADMISSION_CONCURRENCY}
+        self.stats = {grp: {"admitted": 0, "rate_limited": 0, "over_capacity": 0, "credit_hint": 0}
+                      for grp in ADMISSION_CONCURRENCY}
+
+    def take(self, key, rate, burst, now):
+        """Token bucket: returns 0 if admitted, else seconds until a token is available."""
+        b = self.buckets.get(key)
+        if b is None:
+            if len(self.buckets) >= ADMISSION_MAX_BUCKETS:
+                self._prune(now)
+            b = self.buckets[key] = [float(burst), now]
+        tokens = min(float(burst), b[0] + (now - b[1]) * rate)
+        b[1] = now
+        if tokens >= 1.0:
+            b[0] = tokens - 1.0
+            return 0.0
+        b[0] = tokens
+        return (1.0 - tokens) / rate
+
+    def _prune(self, now):
+        # drop buckets idle long enough to have refilled completely
+        for k in [k for k, b in self.buckets.items() if now - b[1] > 300]:
+            del self.buckets[k]
+        if len(self.buckets) >= ADMISSION_MAX_BUCKETS:
+            for k in heapq.nsmallest(ADMISSION_MAX_BUCKETS // 10 or 1, self.buckets,
+                                     key=lambda k: self.buckets[k][1]):
+                del self.buckets[k]
+
+
+_admission = _AdmissionState()
+
+
+def _bearer_token() -> str:
+    return request.headers.get("Authorization", "").replace("Bearer ", "")
+
+
+def _principal():
+    tok = _bearer_token()
+    if not tok:
+        return "ip:" + (request.remote_addr or "?"), "anon"
+    p = _admission.principals.get(tok)
+    if p is None:  # unverified until attach_user has looked it up
+        return "ip:" + (request.remote_addr or "?"), "free"
+    return p["key"], p["plan"]
+
+
+def admission_learn(user_id: int, plan: Optional[str] = None):
+    """Remember token -> (user, plan) so later requests are keyed without DB."""
+    tok = _bearer_token()
+    if not tok:
+        return
+    with _admission.lock:
+        p = _admission.principals.get(tok)
+        if p is None:
+            if len(_admission.principals) >= ADMISSION_MAX_BUCKETS:
+                _admission.principals.clear()
+            p = _admission.principals[tok] = {"key": f"u:{user_id}", "plan": "free"}
+        if plan:
+            p["plan"] = plan.lower()
+
+
+def admission_forget_token(tok: str):
+    with _admission.lock:
+        _admission.principals.pop(tok, None)
+
+
+def credit_hint_store(kind: str, remaining: int, payload: dict):
+    """Cache an INSUFFICIENT_CREDITS decision so retries are answered before DB work."""
+    key, _ = _principal()
+    with _admission.lock:
+        _admission.credit_hints[(key, kind)] = (remaining, payload, time.monotonic() + CREDIT_HINT_TTL)
+
+
+def credit_hint_clear(user_id: int):
+    with _admission.lock:
+        for k in [k for k in _admission.credit_hints if k[0] == f"u:{user_id}"]:
+            del _admission.credit_hints[k]
+
+
+def _credit_hint_reject(group: str, key: str, now: float):
+    if group == "chat":
+        body = request.get_json(silent=True) or {}
+        kind, cost = "chat", CHAT_COST.get((body.get("version") or "V2").upper(), 2)
+    elif group == "ocr":
+        kind, cost = ("bill" if request.path.endswith("/bill") else "bank"), 1
+    else:
+        return None
+    hint = _admission.credit_hints.get((key, kind))
+    if hint is None:
+        return None
+    remaining, payload, expires = hint
+    if now > expires:
+        _admission.credit_hints.pop((key, kind), None)
+        return None
+    if remaining >= cost:
+        return None
+    msg = "Not enough credits" if kind == "chat" else "Not enough OCR credits"
+    return jsonify({"errorCode": "INSUFFICIENT_CREDITS", "message": msg, "data": {"credits": payload}})
+
+
+def _too_many(retry_after: float, reason: str):
+    resp = jsonify({"error": "rate_limited", "reason": reason})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return resp
+
+
+@app.before_request
+def admission_control():
+    if not ADMISSION_ENABLED or request.method == "OPTIONS":
+        return None
+    group = route_group(request.path)
+    if group is None:
+        return None
+    now = time.monotonic()
+    key, plan = _principal()
+    rule = ADMISSION_RATES.get(plan, ADMISSION_RATES["free"])[group]
+    with _admission.lock:
+        st = _admission.stats[group]
+        if rule is not None:
+            wait = _admission.take((key, group), rule[0], rule[1], now)
+            if wait > 0:
+                st["rate_limited"] += 1
+                return _too_many(wait, "rate")
+        if _admission.inflight[group] >= ADMISSION_CONCURRENCY[group]:
+            st["over_capacity"] += 1
+            return _too_many(1, "capacity")
+        hinted = _credit_hint_reject(group, key, now)
+        if hinted is not None:
+            st["credit_hint"] += 1
+            return hinted
+        _admission.inflight[group] += 1
+        st["admitted"] += 1
+    g.admission_group = group
+    return None
+
+
+@app.teardown_request
+def admission_release(_exc=None):
+    group = g.pop("admission_group", None)
+    if group is not None:
+        with _admission.lock:
+            _admission.inflight[group] -= 1
+
+
+def admission_stats():
+    with _admission.lock:
+        return {
+            "enabled": ADMISSION_ENABLED,
+            "inflight": dict(_admission.inflight),
+            "capacity": dict(ADMISSION_CONCURRENCY),
+            "groups": {k: dict(v) for k, v in _admission.stats.items()},
+            "buckets": len(_admission.buckets),
+            "principals": len(_admission.principals),
+            "credit_hints": len(_admission.credit_hints),
+        }
+
+
+# ---------- Realtime change bus ----------
+# emit_db_change() publishes through CHANGE_BUS. The default LocalBus emits to
+# this process's sockets only. With several workers (serve.py), OFFLINE_BUS=
+# "unix:<path>" relays every event through the master's hub so sockets
+# connected to any worker receive it. control() relays in-process state
+# changes the same way (context cache invalidations): the other workers run
+# BUS_CONTROL[name](payload). A worker whose hub connection drops may have
+# missed some, so on reconnect every handler runs with payload None ("drop
+# everything").
+BUS_CONTROL = {}  # name -> fn(payload or None)
+
+
+class LocalBus:
+    name = "local"
+
+    def start(self):
+        pass
+
+    def publish(self, event_name: str, payload: dict):
+        socketio.emit(event_name, payload)
+
+    def control(self, name: str, payload):
+        pass  # one process: the caller already applied it
+
+    def stats(self):
+        return {"bus": self.name}
+
+
+class UnixHubBus(LocalBus):
+    """Length-prefixed JSON frames over a UNIX stream socket to the serve.py hub."""
+    name = "unix"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sock = None
+        self.lock = threading.Lock()
+        self.started = False
+        self.sent = self.received = self.dropped = 0
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            socketio.start_background_task(self._reader)
+
+    def _connect(self):
+        s_ = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s_.connect(self.path)
+        return s_
+
+    def publish(self, event_name, payload):
+        socketio.emit(event_name, payload)  # local sockets first, no hop
+        self._send({"e": event_name, "p": payload, "w": os.getpid()})
+
+    def control(self, name, payload):
+        self._send({"c": name, "p": payload, "w": os.getpid()})
+
+    def _send(self, msg: dict):
+        frame = json.dumps(msg, default=str).encode()
+        with self.lock:
+            for _ in range(2):  # a stale connection gets one reconnect
+                try:
+                    if self.sock is None:
+                        self.sock = self._connect()
+                    self.sock.sendall(struct.pack("!I", len(frame)) + frame)
+                    self.sent += 1
+                    return
+                except OSError:
+                    if self.sock is not None:
+                        self.sock.close()
+                    self.sock = None
+            self.dropped += 1
+
+    def _reader(self):
+        # separate inbound connection so publish() never contends with reads
+        while True:
+            try:
+                conn = self._connect()
+            except OSError:
+                socketio.sleep(0.5)
+                continue
+            try:
+                hello = json.dumps({"sub": os.getpid()}).encode()
+                conn.sendall(struct.pack("!I", len(hello)) + hello)
+                for fn in BUS_CONTROL.values():
+                    fn(None)
+                while True:
+                    head = _recv_exact(conn, 4)
+                    msg = json.loads(_recv_exact(conn, struct.unpack("!I", head)[0]))
+                    if msg.get("w") == os.getpid():
+                        continue  # already emitted locally
+                    self.received += 1
+                    if "c" in msg:
+                        fn = BUS_CONTROL.get(msg["c"])
+                        if fn is not None:
+                            fn(msg["p"])
+                    else:
+                        socketio.emit(msg["e"], msg["p"])
+            except (OSError, ValueError):
+                conn.close()
+                socketio.sleep(0.5)
+
+    def stats(self):
+        return {"bus": self.name, "path": self.path, "sent": self.sent,
+                "received": self.received, "dropped": self.dropped}
+
+
+def _recv_exact(conn, n: int) -> bytes:
+    buf = b""
+    while len(buf) < n:
+        chunk = conn.recv(n - len(buf))
+        if not chunk:
+            raise OSError("bus connection closed")
+        buf += chunk
+    return buf
+
+
+def make_bus(spec: str):
+    if spec.startswith("unix:"):
+        return UnixHubBus(spec[len("unix:"):])
+    return LocalBus()
+
+
+CHANGE_BUS = make_bus(os.environ.get("OFFLINE_BUS", "local"))
 
 
 # ---------- Helpers ----------
@@ -357,17 +1795,48 @@ def now_ym():
     return f"{dt.year:04d}-{dt.month:02d}"
 
 
-def current_user():
-    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+def pil_image():
+    """Pillow's Image module, imported on first use (None if Pillow isn't installed)."""
+    global _PIL_IMAGE
+    if _PIL_IMAGE is False:
+        try:
+            from PIL import Image as _Image
+        except Exception:  # Pillow not installed
+            _Image = None
+        _PIL_IMAGE = _Image
+    return _PIL_IMAGE
+
+
+_PIL_IMAGE = False  # not imported yet
+
+
+SESSION_TTL_DAYS = int(os.environ.get("OFFLINE_SESSION_TTL_DAYS", "30"))
+
+
+def user_for_token(token: str):
     if not token:
         return None
     sess = Session.query.filter_by(token=token).first()
+    if sess and sess.created_at and sess.created_at < datetime.utcnow() - timedelta(days=SESSION_TTL_DAYS):
+        return None  # expired; purged by the "sessions" maintenance job
     return db.session.get(User, sess.user_id) if sess else None
 
 
+def current_user():
+    return user_for_token(request.headers.get("Authorization", "").replace("Bearer ", ""))
+
+
 @app.before_request
 def attach_user():
     g.user = current_user()
+    if g.user is not None:
+        g.shard = g.user.shard or 0
+        admission_learn(g.user.id)
+        if g.user.shard_moving is not None and request.method not in ("GET", "HEAD", "OPTIONS"):
+            # rows are being copied to another shard; a write now would be lost
+            resp = jsonify({"error": "shard_moving"})
+            resp.headers["Retry-After"] = "5"
+            return resp, 503
 
 
 def current_user_required():
@@ -382,16 +1851,12 @@ def ser(o):
         if hasattr(v, "isoformat"):
             d[k] = v.isoformat()
 
-    # messages content
+    # messages: typed columns + leftover -> the API's "content" (role also top-level)
     if "content_json" in d:
-        cj = d.pop("content_json")
-        try:
-            cj = cj if isinstance(cj, dict) else json.loads(cj or "{}")
-        except Exception:
-            cj = {"text": str(cj)}
-        d["content"] = cj
-        if isinstance(cj, dict) and "role" in cj and "role" not in d:
-            d["role"] = cj["role"]
+        role = d.pop("role", None)
+        d["content"] = message_content(role, d.pop("text", None), d.pop("version", None), d.pop("content_json"))
+        if role is not None:
+            d["role"] = role
 
     # OCR unified keys
     if "data_json" in d:
@@ -415,6 +1880,12 @@ def ser(o):
     return d
 
 
+def emit_db_change(event_type: str, table: str, new=None, old=None):
+    """Broadcast a Supabase-style realtime row change to connected sockets."""
+    METRICS.inc("socket_emits_total", event="db_change", table=table)
+    CHANGE_BUS.publish("db_change", {"eventType": event_type, "schema": "public", "table": table, "new": new, "old": old})
+
+
 def model_columns(Model):
     return {c.name for c in Model.__table__.columns}
 
@@ -435,8 +1906,9 @@ def sanitize_row(Model, row: dict):
     if "filename" in row and "filename" not in cols and "file_name" in cols:
         row["file_name"] = row.pop("filename")
 
-    # never allow overriding user_id
-    row.pop("user_id", None)
+    # never allow overriding user_id (or a user's shard placement)
+    for k in ("user_id", "shard", "shard_moving"):
+        row.pop(k, None)
 
     return {k: v for k, v in row.items() if k in cols}
 
@@ -445,9 +1917,10 @@ def sanitize_row(Model, row: dict):
 def add_cors_headers(resp):
     origin = request.headers.get("Origin")
     resp.headers["Access-Control-Allow-Origin"] = origin or "*"
-    resp.headers["Vary"] = "Origin"
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-    resp.headers["Access-Control-Allow-Methods"] = "GET, POST, PATCH, DELETE, OPTIONS"
+    resp.vary.add("Origin")
+    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, Idempotency-Key, Upload-Offset"
+    resp.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, PATCH, DELETE, OPTIONS"
+    resp.headers["Access-Control-Expose-Headers"] = "Upload-Offset, Idempotent-Replayed"
     return resp
 
 
@@ -456,53 +1929,663 @@ def cors_preflight(_p):
     return make_response("", 204)
 
 
-# ---------- Auto-migrate ----------
+# ---------- Idempotency keys ----------
+# A POST sent with "Idempotency-Key: <token>" (chat, OCR, /db inserts) runs
+# once per (user, key). The first request claims the key in idempotency_keys
+# (main DB, so every worker sees it); a retry gets the stored response back
+# with "Idempotent-Replayed: true". A duplicate arriving while the first is
+# still running waits for its result (an Event in this worker, polling the
+# row from another) instead of running again, and gets 409 + Retry-After if
+# that takes longer than IDEM_WAIT. Reusing a key for a different request is
+# 422. 5xx responses and exceptions release the key so a retry really retries.
+# Keys expire after IDEM_TTL_HOURS; the "idempotency" maintenance job deletes
+# expired ones and evicts the oldest beyond IDEM_MAX_KEYS.
+IDEM_TTL_HOURS = int(os.environ.get("OFFLINE_IDEMPOTENCY_TTL_HOURS", "24"))
+IDEM_MAX_KEYS = int(os.environ.get("OFFLINE_IDEMPOTENCY_MAX_KEYS", "100000"))
+IDEM_WAIT = float(os.environ.get("OFFLINE_IDEMPOTENCY_WAIT", "90"))
+IDEM_LEASE = float(os.environ.get("OFFLINE_IDEMPOTENCY_LEASE", "300"))  # an older unfinished claim was abandoned
+IDEM_POLL = 0.05
+
+_idem_inflight = {}  # (user_id, key) -> Event set when this worker's first request finishes
+_idem_lock = threading.Lock()
+
+
+def _idem_fingerprint() -> str:
+    h = hashlib.sha256(f"{request.method} {request.full_path}".encode())
+    if request.is_json:
+        h.update(request.get_data(cache=True))
+    else:  # multipart boundaries differ per send; compare fields, then each file's name and bytes
+        h.update(json.dumps(sorted(request.form.items(multi=True))).encode())
+        for k, f in sorted(request.files.items(multi=True), key=lambda kv: (kv[0], kv[1].filename or "")):
+            fh = hashlib.sha256()
+            for buf in iter(lambda: f.stream.read(64 * 1024), b""):
+                fh.update(buf)
+            f.stream.seek(0)
+            h.update(json.dumps([k, f.filename, fh.hexdigest()]).encode())
+    return h.hexdigest()
+
+
+def _idem_claim(uid: int, key: str, fp: str) -> bool:
+    """Insert the in-progress row; False if someone already holds the key."""
+    t = IdempotencyKey.__table__
+    now = datetime.utcnow()
+    db.session.execute(t.delete().where(
+        t.c.user_id == uid, t.c.key == key,
+        (t.c.created_at < now - timedelta(hours=IDEM_TTL_HOURS))
+        | (t.c.status.is_(None) & (t.c.created_at < now - timedelta(seconds=IDEM_LEASE)))))
+    res = db.session.execute(insert(t).prefix_with("OR IGNORE").values(
+        user_id=uid, key=key, fingerprint=fp, created_at=now))
+    db.session.commit()
+    return res.rowcount == 1
+
+
+def _idem_release(uid: int, key: str):
+    t = IdempotencyKey.__table__
+    db.session.execute(t.delete().where(t.c.user_id == uid, t.c.key == key, t.c.status.is_(None)))
+    db.session.commit()
+
+
+def _idem_wait(uid: int, key: str, fp: str):
+    """The key's row once it's finished, or mismatched, or IDEM_WAIT ran out; None if it was released."""
+    t = IdempotencyKey.__table__
+    deadline = time.monotonic() + IDEM_WAIT
+    with _idem_lock:
+        ev = _idem_inflight.get((uid, key))
+    while True:
+        row = db.session.execute(select(t).where(t.c.user_id == uid, t.c.key == key)).first()
+        db.session.commit()  # end the read so the next poll sees new commits
+        remaining = deadline - time.monotonic()
+        if row is None or row.status is not None or row.fingerprint != fp or remaining <= 0:
+            return row
+        if ev is not None:
+            ev.wait(min(remaining, 1.0))
+        else:
+            time.sleep(IDEM_POLL)
+
+
+def _idem_run(fn, args, kwargs, uid: int, key: str):
+    ev = threading.Event()
+    with _idem_lock:
+        _idem_inflight[(uid, key)] = ev
+    try:
+        try:
+            resp = app.make_response(fn(*args, **kwargs))
+        except BaseException:
+            db.session.rollback()
+            _idem_release(uid, key)
+            raise
+        if resp.status_code >= 500 or resp.is_streamed:
+            _idem_release(uid, key)
+        else:
+            t = IdempotencyKey.__table__
+            db.session.execute(t.update().where(t.c.user_id == uid, t.c.key == key).values(
+                status=resp.status_code, body=resp.get_data(as_text=True), mimetype=resp.mimetype))
+            db.session.commit()
+        return resp
+    finally:
+        with _idem_lock:
+            _idem_inflight.pop((uid, key), None)
+        ev.set()
+
+
+def idempotent(fn):
+    """Honor an Idempotency-Key header on a POST handler (see above)."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = (request.headers.get("Idempotency-Key") or "").strip()
+        if not key or g.get("user") is None:
+            return fn(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({"error": "bad_idempotency_key"}), 400
+        uid, fp = g.user.id, _idem_fingerprint()
+        for _ in range(2):  # the first request may fail and release the key while we wait
+            if _idem_claim(uid, key, fp):
+                METRICS.inc("idempotency_requests_total", outcome="executed")
+                return _idem_run(fn, args, kwargs, uid, key)
+            row = _idem_wait(uid, key, fp)
+            if row is None:
+                continue
+            if row.fingerprint != fp:
+                METRICS.inc("idempotency_requests_total", outcome="mismatch")
+                return jsonify({"error": "idempotency_key_reused"}), 422
+            if row.status is not None:
+                METRICS.inc("idempotency_requests_total", outcome="replayed")
+                resp = Response(row.body, status=row.status, mimetype=row.mimetype)
+                resp.headers["Idempotent-Replayed"] = "true"
+                return resp
+            break
+        METRICS.inc("idempotency_requests_total", outcome="in_flight")
+        resp = jsonify({"error": "idempotency_in_flight"})
+        resp.headers["Retry-After"] = "1"
+        return resp, 409
+    return wrapper
+
+
+# ---------- Conditional GET + response compression ----------
+# Read-heavy GETs get a weak ETag (and Last-Modified where it's exact)
+# computed *before* the view runs, from the user's newest change_log entry
+# on their shard and on the main DB (every write to chats, messages,
+# notifications, OCR, credits and profiles logs one via trigger), plus their
+# users row and the query string. A matching If-None-Match (or, without one,
+# If-Modified-Since) is answered 304 without running the view. If pruning
+# left the user no entries, the log's horizon stands in (it is >= anything
+# pruned); Last-Modified is then omitted, as it is when the newest entry is
+# less than two seconds old (change_log.at has one-second resolution).
+# Separately, every response above COMPRESS_MIN_BYTES with a text/JSON type
+# is gzip- or brotli-encoded per Accept-Encoding (brotli only if the
+# `brotli` package is installed); streamed and file responses are left as-is.
+COMPRESS_MIN_BYTES = int(os.environ.get("OFFLINE_COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.environ.get("OFFLINE_COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get("OFFLINE_COMPRESS_BROTLI_QUALITY", "5"))
+COMPRESS_TYPES = ("application/json", "application/javascript", "image/svg+xml")
+
+
+def _brotli():
+    try:
+        import brotli
+    except Exception:  # optional dependency
+        return None
+    return brotli
+
+
+def _log_mark(bind, user_id: int):
+    """(seq, at) of the user's newest change_log entry in one DB file, or (horizon, None)."""
+    row = db.session.execute(
+        text("SELECT seq, at FROM change_log WHERE user_id = :uid ORDER BY seq DESC LIMIT 1"),
+        {"uid": user_id}, bind_arguments={"bind": bind}).first()
+    if row is not None:
+        return row[0], datetime.strptime(row[1], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    return db.session.execute(text("SELECT seq FROM change_log_horizon WHERE id = 1"),
+                              bind_arguments={"bind": bind}).scalar() or 0, None
+
+
+def user_validators(last_modified: bool = True):
+    """(etag, last_modified or None) for the request user's data as of now; None if anonymous."""
+    u = g.get("user")
+    if u is None:
+        return None
+    shard = u.shard or 0
+    # no commit here: it would expire g.user and make the view reload it
+    marks = [_log_mark(shard_engine(shard), u.id)]
+    if shard != 0:
+        marks.append(_log_mark(db.engine, u.id))
+    h = hashlib.blake2b(digest_size=10)
+    h.update(json.dumps([u.id, u.email, u.name, shard, [m[0] for m in marks], request.full_path]).encode())
+    lm = None
+    if last_modified and all(m[1] is not None for m in marks):
+        lm = max(m[1] for m in marks)
+        if (datetime.now(timezone.utc) - lm).total_seconds() < 2:
+            lm = None
+    return h.hexdigest(), lm
+
+
+def conditional(validators, private: bool = True):
+    """
+    Decorator: validators(**view_kwargs) -> (etag, last_modified) or None.
+    Answers 304 before running the view when the client's copy is current.
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            v = validators(**kwargs)
+            if v is None:
+                return fn(*args, **kwargs)
+            etag, last_modified = v
+            if request.if_none_match:
+                fresh = request.if_none_match.contains_weak(etag)
+            else:
+                ims = request.if_modified_since
+                fresh = last_modified is not None and ims is not None and last_modified <= ims
+            if fresh:
+                METRICS.inc("conditional_requests_total", outcome="not_modified")
+                resp = Response(status=304)
+            else:
+                METRICS.inc("conditional_requests_total", outcome="full")
+                resp = app.make_response(fn(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+            resp.set_etag(etag, weak=True)
+            if last_modified is not None:
+                resp.last_modified = last_modified
+            resp.cache_control.no_cache = True
+            if private:
+                resp.cache_control.private = True
+                resp.vary.add("Authorization")
+            return resp
+        return wrapper
+    return deco
+
+
+@app.after_request
+def compress_response(resp):
+    if (resp.direct_passthrough or resp.is_streamed or resp.status_code < 200 or resp.status_code in (204, 304)
+            or "Content-Encoding" in resp.headers):
+        return resp
+    mimetype = resp.mimetype or ""
+    if not (mimetype.startswith("text/") or mimetype in COMPRESS_TYPES):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    if (resp.content_length or 0) < COMPRESS_MIN_BYTES:
+        return resp
+    accept = request.accept_encodings
+    brotli = _brotli() if accept["br"] else None
+    if brotli is not None and accept["br"] >= accept["gzip"]:
+        encoding, data = "br", brotli.compress(resp.get_data(), quality=COMPRESS_BROTLI_QUALITY)
+    elif accept["gzip"]:
+        encoding, data = "gzip", gzip.compress(resp.get_data(), compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+    else:
+        return resp
+    METRICS.inc("compressed_responses_total", encoding=encoding)
+    METRICS.inc("compressed_bytes_saved_total", resp.content_length - len(data))
+    resp.set_data(data)
+    resp.headers["Content-Encoding"] = encoding
+    etag, weak = resp.get_etag()
+    if etag and not weak:  # a different representation of the same bytes
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+# ---------- Debug profiler / N+1 detector (admin-only, per request) ----------
+# Send "X-Debug-Profile: sql" (statement log + N+1 check) or
+# "X-Debug-Profile: cprofile" (also a cProfile dump) as an admin. A summary is
+# returned in X-Debug-* headers; the full report is at /admin/profile/<id>.
+PROFILE_N1_THRESHOLD = int(os.environ.get("OFFLINE_PROFILE_N1_THRESHOLD", "3"))
+PROFILE_MAX_REPORTS = 50
+PROFILE_DIR = os.environ.get("OFFLINE_PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "offline-profiles")
+_profile_reports = OrderedDict()  # id -> report dict
+_profile_lock = threading.Lock()
+_SQL_IN_LIST = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+def _sql_shape(statement: str) -> str:
+    """Normalize a statement so the same query with different params compares equal."""
+    s_ = _SQL_IN_LIST.sub("(?…)", statement)
+    s_ = _SQL_LITERAL.sub("?", s_)
+    return " ".join(s_.split())
+
+
+def _sql_origin():
+    """Innermost app.py frames that led to the statement (skipping this module's hooks)."""
+    frames = [f for f in traceback.extract_stack()[:-3] if f.filename == __file__]
+    return [f"{f.name}:{f.lineno}" for f in frames[-3:]]
+
+
+def profile_record_sql(prof: dict, statement: str, elapsed: float):
+    prof["sql"].append({
+        "ms": round(elapsed * 1000, 3),
+        "shape": _sql_shape(statement),
+        "origin": _sql_origin(),
+    })
+
+
+@app.before_request
+def profile_start():
+    mode = (request.headers.get("X-Debug-Profile") or "").strip().lower()
+    if not mode or g.user is None:
+        return None
+    uc = db.session.get(UserCredit, g.user.id)
+    if not uc or (uc.plan or "free").lower() != "admin":
+        return None  # silently ignored for non-admins
+    prof = {"id": secrets.token_hex(8), "mode": mode, "route": _route_label(),
+            "method": request.method, "path": request.full_path, "sql": [],
+            "t0": time.perf_counter(), "profiler": None}
+    if "cprofile" in mode:
+        import cProfile
+        prof["profiler"] = cProfile.Profile()
+        prof["profiler"].enable()
+    g.debug_profile = prof
+    return None
+
+
+def _profile_finish(prof: dict, status: int) -> dict:
+    if prof["profiler"] is not None:
+        prof["profiler"].disable()
+    shapes = {}
+    for q in prof["sql"]:
+        agg = shapes.setdefault(q["shape"], {"shape": q["shape"], "count": 0, "ms": 0.0, "origins": set()})
+        agg["count"] += 1
+        agg["ms"] += q["ms"]
+        agg["origins"].add(" < ".join(reversed(q["origin"])))
+    n1 = sorted((a for a in shapes.values() if a["count"] >= PROFILE_N1_THRESHOLD),
+                key=lambda a: a["count"], reverse=True)
+    report = {
+        "id": prof["id"], "route": prof["route"], "method": prof["method"], "path": prof["path"],
+        "status": status, "created_at": datetime.utcnow().isoformat(),
+        "elapsed_ms": round((time.perf_counter() - prof["t0"]) * 1000, 3),
+        "sql_count": len(prof["sql"]),
+        "sql_ms": round(sum(q["ms"] for q in prof["sql"]), 3),
+        "n_plus_one": [dict(a, ms=round(a["ms"], 3), origins=sorted(a["origins"])) for a in n1],
+        "statements": prof["sql"],
+        "cprofile": None,
+    }
+    if prof["profiler"] is not None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{prof['id']}.prof")
+        prof["profiler"].dump_stats(path)  # load with snakeviz / flameprof / pstats
+        buf = io.StringIO()
+        pstats.Stats(prof["profiler"], stream=buf).sort_stats("cumulative").print_stats(25)
+        report["cprofile"] = {"file": path, "top": buf.getvalue()}
+    with _profile_lock:
+        _profile_reports[prof["id"]] = report
+        while len(_profile_reports) > PROFILE_MAX_REPORTS:
+            _, old = _profile_reports.popitem(last=False)
+            if old.get("cprofile"):
+                try:
+                    os.remove(old["cprofile"]["file"])
+                except OSError:
+                    pass
+    return report
+
+
+@app.after_request
+def profile_headers(resp):
+    prof = g.pop("debug_profile", None)
+    if prof is None:
+        return resp
+    report = _profile_finish(prof, resp.status_code)
+    resp.headers["X-Debug-Report"] = report["id"]
+    resp.headers["X-Debug-SQL-Count"] = str(report["sql_count"])
+    resp.headers["X-Debug-SQL-Time-Ms"] = str(report["sql_ms"])
+    resp.headers["X-Debug-N1"] = "; ".join(
+        f"{a['count']}x {a['shape'][:120]}" for a in report["n_plus_one"][:3]) or "none"
+    return resp
+
+
+@app.teardown_request
+def profile_teardown(_exc=None):
+    prof = g.pop("debug_profile", None)
+    if prof is not None:  # handler raised before after_request ran
+        _profile_finish(prof, 500)
+
+
+# ---------- Schema migrations ----------
+# Ordered, idempotent steps recorded in schema_version. On an up-to-date DB
+# migrate() is two tiny statements, so boot cost no longer grows with the
+# list. Append new steps at the end; never renumber or edit applied ones.
+MIGRATIONS = []  # [(version, name, fn)]
+
+
+def migration(version: int, name: str):
+    def deco(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return deco
+
+
 def column_exists(table: str, column: str) -> bool:
     rows = db.session.execute(text(f"PRAGMA table_info({table})")).mappings().all()
     return any(r["name"] == column for r in rows)
 
 
-def auto_migrate():
-    # messages.content_json
-    if column_exists("messages", "id") and not column_exists("messages", "content_json"):
-        db.session.execute(text("ALTER TABLE messages ADD COLUMN content_json TEXT"))
-        db.session.commit()
+def _add_column(table: str, column: str, ddl: str):
+    if column_exists(table, "id") and not column_exists(table, column):
+        db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+@migration(1, "create base tables")
+def _m001_create_all():
+    db.metadata.create_all(db.session.get_bind())
+
+
+@migration(2, "messages.content_json")
+def _m002_messages_content_json():
+    _add_column("messages", "content_json", "TEXT")
+
 
+@migration(3, "modern OCR columns")
+def _m003_ocr_columns():
     # ensure modern OCR columns exist & copy legacy metadata_json -> data_json if needed
     for t in ("ocr_bill_extractions", "ocr_bank_extractions"):
-        if column_exists(t, "id"):
-            if not column_exists(t, "filename"):
-                db.session.execute(text(f"ALTER TABLE {t} ADD COLUMN filename TEXT"))
-            if not column_exists(t, "file_url"):
-                db.session.execute(text(f"ALTER TABLE {t} ADD COLUMN file_url TEXT"))
-            if not column_exists(t, "approved"):
-                db.session.execute(text(f"ALTER TABLE {t} ADD COLUMN approved INTEGER DEFAULT 0"))
-            if not column_exists(t, "data_json"):
-                db.session.execute(text(f"ALTER TABLE {t} ADD COLUMN data_json TEXT"))
-            if column_exists(t, "metadata_json"):
-                db.session.execute(text(f"UPDATE {t} SET data_json = COALESCE(data_json, metadata_json)"))
+        _add_column(t, "filename", "TEXT")
+        _add_column(t, "file_url", "TEXT")
+        _add_column(t, "approved", "INTEGER DEFAULT 0")
+        _add_column(t, "data_json", "TEXT")
+        if column_exists(t, "metadata_json"):
+            db.session.execute(text(f"UPDATE {t} SET data_json = COALESCE(data_json, metadata_json)"))
+
+
+@migration(4, "credit plan + monthly counters")
+def _m004_credit_fields():
+    _add_column("user_credits", "plan", "TEXT DEFAULT 'free'")
+    _add_column("user_credits", "chat_used", "INTEGER DEFAULT 0")
+    _add_column("user_credits", "ocr_bill_used", "INTEGER DEFAULT 0")
+    _add_column("user_credits", "ocr_bank_used", "INTEGER DEFAULT 0")
+    _add_column("user_credits", "last_reset_at", "TEXT")
+
+
+@migration(5, "per-user credit overrides")
+def _m005_credit_overrides():
+    _add_column("user_credits", "chat_limit", "INTEGER")
+    _add_column("user_credits", "ocr_bill_limit", "INTEGER")
+    _add_column("user_credits", "ocr_bank_limit", "INTEGER")
+
+
+@migration(6, "notifications.archived_at")
+def _m006_notifications_archived_at():
+    _add_column("notifications", "archived_at", "DATETIME")
+
+
+@migration(7, "messages (chat_id, id) index + chat_summaries")
+def _m007_chat_context():
+    # reverse scans of a chat's newest messages (context loader, listings)
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_chat_id_id ON messages (chat_id, id)"))
+    ChatSummary.__table__.create(db.session.get_bind(), checkfirst=True)
+
+
+@migration(8, "FTS5 search index")
+def _m008_search_index():
+    ensure_search_index()
+
+
+@migration(9, "chats cold-storage stub columns")
+def _m009_chat_archive():
+    _add_column("chats", "archived_at", "DATETIME")
+    _add_column("chats", "archive_file", "TEXT")
+    _add_column("chats", "archive_count", "INTEGER")
+
+
+@migration(10, "auto_vacuum=incremental")
+def _m010_incremental_vacuum():
+    # auto_vacuum only takes effect after a VACUUM, which rewrites the whole
+    # file; do it here only while the DB is small, otherwise leave it to an
+    # operator (the vacuum job reports "skipped" until then).
+    size = db.session.execute(text("PRAGMA page_count")).scalar() * \
+        db.session.execute(text("PRAGMA page_size")).scalar()
+    db.session.commit()
+    if size > 64 * 1024 * 1024:
+        return
+    with db.session.get_bind().connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+
+
+@migration(11, "messages: typed role/text/version columns")
+def _m011_message_columns():
+    for col in MESSAGE_TYPED:
+        _add_column("messages", col, "TEXT")
+    # the FTS triggers move from json_extract(content_json) to the text column;
+    # dropped first so the backfill below doesn't rewrite every index entry
+    for name in ("messages_fts_ai", "messages_fts_au"):
+        db.session.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+    db.session.commit()
+
+    # json_extract raises on invalid JSON, so every path is guarded by is_obj
+    is_obj = "json_valid(content_json) AND json_type(content_json) = 'object'"
+    rest = "json_remove(content_json, '$.role', '$.text', '$.version')"
+    split_sql = f"""
+        UPDATE messages SET
+          role = CASE WHEN {is_obj} THEN json_extract(content_json, '$.role') END,
+          version = CASE WHEN {is_obj} THEN json_extract(content_json, '$.version') END,
+          text = CASE WHEN {is_obj} THEN json_extract(content_json, '$.text')
+                      WHEN json_valid(content_json) THEN json_extract(content_json, '$')
+                      ELSE content_json END,
+          content_json = CASE WHEN NOT ({is_obj}) THEN '{{}}'
+                              WHEN {rest} = '{{"meta":{{}}}}' THEN ''
+                              ELSE {rest} END
+        WHERE id > :lo AND id <= :hi AND content_json != '' AND role IS NULL AND text IS NULL AND version IS NULL
+    """
+    max_id = db.session.execute(text("SELECT COALESCE(MAX(id), 0) FROM messages")).scalar()
+    lo, batch = 0, 5000
+    while lo < max_id:  # one id range per transaction
+        db.session.execute(text(split_sql), {"lo": lo, "hi": lo + batch})
         db.session.commit()
+        lo += batch
+    for stmt in SEARCH_MESSAGE_TRIGGERS:
+        db.session.execute(text(stmt))
+
+
+@migration(12, "change_log + sync triggers")
+def _m012_change_log():
+    for stmt in CHANGELOG_DDL:
+        db.session.execute(text(stmt))
+
+
+@migration(13, "uploads")
+def _m013_uploads():
+    Upload.__table__.create(db.session.get_bind(), checkfirst=True)
+
+
+@migration(14, "users.shard placement")
+def _m014_user_shard():
+    _add_column("users", "shard", "INTEGER NOT NULL DEFAULT 0")
+    _add_column("users", "shard_moving", "INTEGER")
+
+
+@migration(15, "idempotency_keys")
+def _m015_idempotency_keys():
+    IdempotencyKey.__table__.create(db.session.get_bind(), checkfirst=True)
+
+
+@migration(16, "blobs")
+def _m016_blobs():
+    Blob.__table__.create(db.session.get_bind(), checkfirst=True)
+
+
+@migration(17, "usage ledger + rollups")
+def _m017_usage():
+    bind = db.session.get_bind()
+    UsageEvent.__table__.create(bind, checkfirst=True)
+    UsageRollup.__table__.create(bind, checkfirst=True)
+    for stmt in USAGE_DDL:
+        db.session.execute(text(stmt))
 
-    # new credit fields
-    if not column_exists("user_credits", "plan"):
-        db.session.execute(text("ALTER TABLE user_credits ADD COLUMN plan TEXT DEFAULT 'free'"))
-    if not column_exists("user_credits", "chat_used"):
-        db.session.execute(text("ALTER TABLE user_credits ADD COLUMN chat_used INTEGER DEFAULT 0"))
-    if not column_exists("user_credits", "ocr_bill_used"):
-        db.session.execute(text("ALTER TABLE user_credits ADD COLUMN ocr_bill_used INTEGER DEFAULT 0"))
-    if not column_exists("user_credits", "ocr_bank_used"):
-        db.session.execute(text("ALTER TABLE user_credits ADD COLUMN ocr_bank_used INTEGER DEFAULT 0"))
-    if not column_exists("user_credits", "last_reset_at"):
-        db.session.execute(text("ALTER TABLE user_credits ADD COLUMN last_reset_at TEXT"))
-
-    # NEW: per-user override limits
-    if not column_exists("user_credits", "chat_limit"):
-        db.session.execute(text("ALTER TABLE user_credits ADD COLUMN chat_limit INTEGER"))
-    if not column_exists("user_credits", "ocr_bill_limit"):
-        db.session.execute(text("ALTER TABLE user_credits ADD COLUMN ocr_bill_limit INTEGER"))
-    if not column_exists("user_credits", "ocr_bank_limit"):
-        db.session.execute(text("ALTER TABLE user_credits ADD COLUMN ocr_bank_limit INTEGER"))
+
+@migration(18, "chat aggregate triggers + (user_id, updated_at) index")
+def _m018_chat_aggregates():
+    for stmt in CHAT_AGG_DDL:
+        db.session.execute(text(stmt))
+    db.session.commit()
+    max_id = db.session.execute(text("SELECT COALESCE(MAX(id), 0) FROM chats")).scalar()
+    lo, batch = 0, 5000
+    while lo < max_id:  # one id range per transaction
+        db.session.execute(text(CHAT_AGG_BACKFILL), {"lo": lo, "hi": lo + batch})
+        db.session.commit()
+        lo += batch
+
+
+@migration(19, "messages AUTOINCREMENT")
+def _m019_messages_autoincrement():
+    # Rebuilds messages so ids are never reused (archived chats keep theirs).
+    # SQLite can't add AUTOINCREMENT in place: copy into a new table, swap it
+    # in, and re-create the indexes and triggers exactly as they were. Ids are
+    # kept, so messages_fts and change_log rows still point at the right rows.
+    # One transaction: on a large DB, run it in a quiet window.
+    old_sql = db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages'")).scalar() or ""
+    if "AUTOINCREMENT" not in old_sql.upper():
+        deps = db.session.execute(text(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = 'messages' AND type IN ('index', 'trigger') "
+            "AND sql IS NOT NULL")).scalars().all()
+        have = {r["name"] for r in db.session.execute(text("PRAGMA table_info(messages)")).mappings()}
+        cols = ", ".join(c.name for c in Message.__table__.columns if c.name in have)
+        ddl = str(CreateTable(Message.__table__).compile(dialect=db.session.get_bind().dialect))
+        db.session.execute(text(ddl.replace("CREATE TABLE messages ", "CREATE TABLE messages_rebuild ", 1)))
+        db.session.execute(text(f"INSERT INTO messages_rebuild ({cols}) SELECT {cols} FROM messages"))
+        db.session.execute(text("DROP TABLE messages"))
+        db.session.execute(text("ALTER TABLE messages_rebuild RENAME TO messages"))
+        for stmt in deps:
+            db.session.execute(text(stmt))
+    # the counter must also clear every id still held by an archive segment
+    top = db.session.execute(text("SELECT COALESCE(MAX(id), 0) FROM messages")).scalar()
+    for (rel,) in db.session.execute(text("SELECT archive_file FROM chats WHERE archive_file IS NOT NULL")).all():
+        with contextlib.suppress(OSError, ValueError):
+            top = max([top] + [r.get("id") or 0 for r in _segment_rows(rel)])
+    db.session.execute(text("DELETE FROM sqlite_sequence WHERE name = 'messages'"))
+    db.session.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', :s)"), {"s": top})
+
+
+@migration(20, "FTS owner tokens")
+def _m020_search_owner():
+    for name in ("messages_fts_ai", "messages_fts_ad", "messages_fts_au",
+                 "chats_fts_ai", "chats_fts_ad", "chats_fts_au"):
+        db.session.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+    db.session.execute(text("DROP TABLE IF EXISTS messages_fts"))
+    db.session.execute(text("DROP TABLE IF EXISTS chats_fts"))
+    for stmt in SEARCH_OWNER_DDL:
+        db.session.execute(text(stmt))
+    db.session.commit()
+    search_backfill()
+
+
+@migration(21, "blob owners + signed blob URLs")
+def _m021_blob_owners():
+    # Blobs stored before reads were checked: each OCR row (in this file) and
+    # avatar (main DB only) names the user who owns its blob. Owner rows always
+    # go to the main DB; stored URLs are signed so previews keep loading.
+    BlobOwner.__table__.create(db.session.get_bind(), checkfirst=True)
+    owned = []
+    for table, owner_col, url_col in (("ocr_bill_extractions", "user_id", "file_url"),
+                                      ("ocr_bank_extractions", "user_id", "file_url"),
+                                      ("profiles", "id", "avatar_url")):
+        rows = db.session.execute(text(
+            f"SELECT id, {owner_col}, {url_col} FROM {table} WHERE {url_col} LIKE '%/blobs/%'")).all()
+        for row_id, uid, url in rows:
+            m = BLOB_REF_RE.search(url)
+            if uid is None or m is None:
+                continue
+            owned.append({"sha256": m.group(1), "user_id": uid})
+            if "?" not in url:
+                db.session.execute(text(f"UPDATE {table} SET {url_col} = :url WHERE id = :id"),
+                                   {"url": f"{url}?u={uid}&sig={_blob_sig(uid, m.group(1))}", "id": row_id})
+    if owned:
+        db.session.execute(insert(BlobOwner.__table__).prefix_with("OR IGNORE"), owned,
+                           bind_arguments={"bind": db.engine})
+
+
+def migrate():
+    """Apply pending migrations to the main DB and every shard file; returns how many ran."""
+    ran = 0
+    for n in range(SHARD_COUNT):
+        # shard files get the full schema (central tables stay empty there) so
+        # the same steps, triggers and FTS tables apply everywhere
+        with shard_scope(n, pin=True):
+            ran += _migrate_pinned()
+    return ran
+
+
+def _migrate_pinned():
+    db.session.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version "
+        "(version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TEXT NOT NULL)"
+    ))
+    current = db.session.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
     db.session.commit()
+    if current >= MIGRATIONS[-1][0]:
+        return 0
+    ran = 0
+    for version, name, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version <= current:
+            continue
+        fn()
+        db.session.execute(
+            text("INSERT OR IGNORE INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+            {"v": version, "n": name, "t": datetime.utcnow().isoformat()},
+        )
+        db.session.commit()
+        ran += 1
+    return ran
 
 
 # ---------- Plans / limits ----------
@@ -562,15 +2645,143 @@ def credits_payload(row: UserCredit):
         "last_reset_at": row.last_reset_at,
     }
 
+def load_account(user_id: int) -> "User":
+    """User with profile and credits in one query (the me/profile/plan view)."""
+    return db.session.execute(
+        select(User).options(joinedload(User.profile), joinedload(User.credit)).where(User.id == user_id)
+    ).unique().scalar_one()
+
+
 def load_or_create_credits(user_id: int, plan_default="free") -> UserCredit:
     row = db.session.get(UserCredit, user_id)
     if not row:
         row = UserCredit(id=user_id, plan=plan_default, last_reset_at=now_ym())
         db.session.add(row); db.session.commit()
     reset_month_if_needed(row)
+    if has_request_context():
+        admission_learn(user_id, row.plan)
     return row
 
 
+# ---------- Usage ledger + rollups (admin analytics) ----------
+# The charge paths append one usage_events row per outcome (charged,
+# refunded, insufficient) in the same transaction as the credit update, so
+# the ledger costs one insert and survives reset_month_if_needed. The "usage"
+# maintenance job folds new events into hourly and daily usage_rollups past a
+# watermark (advanced with a conditional UPDATE in the same transaction, so
+# a fold happens exactly once even if two runs overlap). /admin/usage reads
+# only the rollups: cost grows with buckets, not events. Events older than
+# USAGE_RETENTION_DAYS (once folded) and hourly buckets older than
+# USAGE_HOURLY_DAYS are pruned; daily buckets are kept.
+USAGE_RETENTION_DAYS = int(os.environ.get("OFFLINE_USAGE_RETENTION_DAYS", "90"))
+USAGE_HOURLY_DAYS = int(os.environ.get("OFFLINE_USAGE_HOURLY_DAYS", "31"))
+USAGE_FOLD_CHUNK = 5000
+USAGE_DIMS = ("plan", "kind", "version", "outcome")
+# grain -> SQL for the bucket label of usage_events.at
+USAGE_GRAINS = {"hour": "substr(at, 1, 14) || '00'", "day": "substr(at, 1, 10)"}
+USAGE_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_usage_events_at ON usage_events (at)",
+    "CREATE TABLE IF NOT EXISTS usage_rollup_state (id INTEGER PRIMARY KEY CHECK (id = 1), event_id INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO usage_rollup_state (id, event_id) VALUES (1, 0)",
+]
+
+
+def usage_record(kind: str, outcome: str, units: int, plan: Optional[str], version: Optional[str] = None):
+    """Add a ledger row to the current transaction (the caller's commit writes it)."""
+    db.session.execute(insert(UsageEvent.__table__).values(
+        at=datetime.utcnow(), user_id=g.user.id, plan=(plan or "free").lower(), kind=kind,
+        version=version, outcome=outcome, units=units))
+
+
+def usage_fold() -> int:
+    """Fold events past the watermark into the rollups; returns how many were folded."""
+    deadline = time.monotonic() + MAINT_BUDGET
+    folded = 0
+    while time.monotonic() < deadline:
+        lo = db.session.execute(text("SELECT event_id FROM usage_rollup_state WHERE id = 1")).scalar() or 0
+        hi, n = db.session.execute(text(
+            "SELECT MAX(id), COUNT(*) FROM (SELECT id FROM usage_events WHERE id > :lo ORDER BY id LIMIT :n)"),
+            {"lo": lo, "n": USAGE_FOLD_CHUNK}).one()
+        if not n:
+            db.session.commit()
+            break
+        claimed = db.session.execute(text(
+            "UPDATE usage_rollup_state SET event_id = :hi WHERE id = 1 AND event_id = :lo"),
+            {"lo": lo, "hi": hi}).rowcount
+        if not claimed:  # another run folded this range first
+            db.session.rollback()
+            continue
+        for grain, bucket in USAGE_GRAINS.items():
+            db.session.execute(text(
+                f"INSERT INTO usage_rollups (grain, bucket, plan, kind, version, outcome, events, units) "
+                f"SELECT '{grain}', {bucket}, COALESCE(plan, ''), kind, COALESCE(version, ''), outcome, "
+                f"COUNT(*), COALESCE(SUM(units), 0) FROM usage_events WHERE id > :lo AND id <= :hi "
+                f"GROUP BY 2, 3, 4, 5, 6 "
+                f"ON CONFLICT (grain, bucket, plan, kind, version, outcome) "
+                f"DO UPDATE SET events = events + excluded.events, units = units + excluded.units"),
+                {"lo": lo, "hi": hi})
+        db.session.commit()
+        folded += n
+        if n < USAGE_FOLD_CHUNK:
+            break
+        time.sleep(MAINT_PAUSE)
+    return folded
+
+
+def usage_prune() -> int:
+    watermark = db.session.execute(text("SELECT event_id FROM usage_rollup_state WHERE id = 1")).scalar() or 0
+    db.session.commit()
+    cutoff = datetime.utcnow() - timedelta(days=USAGE_RETENTION_DAYS)
+    n = _chunked_delete("SELECT id FROM usage_events WHERE id <= :wm AND at < :cutoff LIMIT :n",
+                        "usage_events", {"wm": watermark, "cutoff": cutoff})
+    hourly_cutoff = (datetime.utcnow() - timedelta(days=USAGE_HOURLY_DAYS)).strftime("%Y-%m-%d %H:00")
+    n += _chunked_delete("SELECT rowid FROM usage_rollups WHERE grain = 'hour' AND bucket < :b LIMIT :n",
+                         "usage_rollups", {"b": hourly_cutoff})
+    return n
+
+
+@app.get("/admin/usage")
+def admin_usage():
+    """
+    ?grain=day|hour&from=&to=&by=plan,kind&plan=&kind=&version=&outcome=
+    -> {"rows": [{"bucket", <by dims>, "events", "units"}], "as_of", "pending_events"}
+    from/to are bucket labels or prefixes (UTC); default: last 30 days / 48 hours.
+    """
+    _require_admin()
+    grain = request.args.get("grain", "day")
+    if grain not in USAGE_GRAINS:
+        return jsonify({"error": "bad_grain", "grains": list(USAGE_GRAINS)}), 400
+    by = [d for d in (request.args.get("by") or "").split(",") if d]
+    if any(d not in USAGE_DIMS for d in by):
+        return jsonify({"error": "bad_dimension", "dims": list(USAGE_DIMS)}), 400
+    now = datetime.utcnow()
+    if grain == "day":
+        lo_default, hi_default = (now - timedelta(days=30)).strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d")
+    else:
+        lo_default, hi_default = (now - timedelta(hours=48)).strftime("%Y-%m-%d %H:00"), now.strftime("%Y-%m-%d %H:00")
+    lo = request.args.get("from") or lo_default
+    hi = (request.args.get("to") or hi_default) + "\uffff"  # "to" is inclusive, prefixes included
+    where, params = ["grain = :grain", "bucket >= :lo", "bucket <= :hi"], {"grain": grain, "lo": lo, "hi": hi}
+    for d in USAGE_DIMS:
+        if request.args.get(d) is not None:
+            where.append(f"{d} = :{d}")
+            params[d] = request.args[d]
+    cols = "".join(f", {d}" for d in by)
+    rows = db.session.execute(text(
+        f"SELECT bucket{cols}, SUM(events), SUM(units) FROM usage_rollups WHERE {' AND '.join(where)} "
+        f"GROUP BY bucket{cols} ORDER BY bucket{cols}"), params).all()
+    watermark = db.session.execute(text("SELECT event_id FROM usage_rollup_state WHERE id = 1")).scalar() or 0
+    as_of = db.session.execute(select(UsageEvent.at).where(UsageEvent.id == watermark)).scalar()
+    head = db.session.execute(text(
+        "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'usage_events'), 0)")).scalar()
+    return jsonify({
+        "grain": grain, "from": lo, "to": request.args.get("to") or hi_default, "by": by,
+        "rows": [dict(zip(["bucket", *by, "events", "units"], r)) for r in rows],
+        "as_of": as_of.isoformat() if as_of else None,  # newest event included in the rollups
+        "pending_events": max(0, head - watermark),
+    })
+
+
 # ---------- Seed ----------
 def _ensure_user(
     email: str,
@@ -583,6 +2794,7 @@ def _ensure_user(
     if not u:
         u = User(email=email, name=name, password_hash=generate_password_hash(password))
         db.session.add(u); db.session.commit()
+        u.shard = place_user(u.id)
 
     prof = db.session.get(Profile, u.id)
     if not prof:
@@ -607,10 +2819,10 @@ def _ensure_user(
             uc.chat_used = 0; uc.ocr_bill_used = 0; uc.ocr_bank_used = 0; uc.last_reset_at = now_ym()
         uc.updated_at = datetime.utcnow()
 
-    if not Chat.query.filter_by(user_id=u.id).first():
-        db.session.add(Chat(user_id=u.id, title=first_chat_title))
-
-    db.session.commit()
+    with shard_scope(u.shard):
+        if not Chat.query.filter_by(user_id=u.id).first():
+            db.session.add(Chat(user_id=u.id, title=first_chat_title))
+        db.session.commit()
     return u
 
 def _seed_notifications_for_user(user_id: int):
@@ -653,8 +2865,9 @@ def _seed_notifications_for_user(user_id: int):
 def notifications_count():
     """Return total and unread counts for the current user."""
     current_user_required()
-    total = Notification.query.filter_by(user_id=g.user.id).count()
-    unread = Notification.query.filter_by(user_id=g.user.id, read_at=None).count()
+    q = Notification.query.filter_by(user_id=g.user.id, archived_at=None)
+    total = q.count()
+    unread = q.filter(Notification.read_at.is_(None)).count()
     return jsonify({"total": total, "unread": unread})
 
 def _require_admin():
@@ -701,13 +2914,50 @@ def admin_notify():
         return jsonify({"ok": True, "created": 0})
 
     now = datetime.utcnow()
+    by_shard = {}
     for u in targets:
-        db.session.add(Notification(user_id=u.id, title=title, body=body, created_at=now))
-    db.session.commit()
+        by_shard.setdefault(u.shard or 0, []).append(
+            {"user_id": u.id, "title": title, "body": body, "created_at": now})
+    for n, rows in by_shard.items():
+        with shard_scope(n):
+            db.session.execute(insert(Notification.__table__), rows)
+            db.session.commit()
     return jsonify({"ok": True, "created": len(targets)})
 
 
 
+@app.get("/admin/limits")
+def admin_limits():
+    """Admission-control counters (admin-only)."""
+    _require_admin()
+    return jsonify(admission_stats())
+
+
+@app.get("/admin/profile")
+def admin_profile_list():
+    """Recent debug-profile reports (newest first, summaries only)."""
+    _require_admin()
+    with _profile_lock:
+        reports = list(_profile_reports.values())[::-1]
+    keys = ("id", "route", "method", "path", "status", "created_at", "elapsed_ms", "sql_count", "sql_ms")
+    return jsonify({"rows": [dict({k: r[k] for k in keys}, n_plus_one=len(r["n_plus_one"])) for r in reports]})
+
+
+@app.get("/admin/profile/<rid>")
+def admin_profile_get(rid):
+    _require_admin()
+    with _profile_lock:
+        report = _profile_reports.get(rid)
+    if report is None:
+        return jsonify({"error": "not_found"}), 404
+    if request.args.get("format") == "prof":
+        if not report.get("cprofile"):
+            return jsonify({"error": "no_cprofile"}), 404
+        return send_file(report["cprofile"]["file"], mimetype="application/octet-stream",
+                         as_attachment=True, download_name=f"{rid}.prof")
+    return jsonify(report)
+
+
 def ensure_baseline_notifications(user_id: int):
     """
     Guarantee a 'Welcome!' exists for the user, and add a couple of
@@ -746,9 +2996,8 @@ def ensure_baseline_notifications(user_id: int):
         db.session.commit()
 
 
-def seed():
-    db.create_all()
-    auto_migrate()
+def seed_demo():
+    """Demo accounts + sample notifications. Explicit: `python app.py seed-demo`."""
     # Admin (unlimited)
     admin = _ensure_user("admin@example.com", "Admin", password="admin123", plan="admin", first_chat_title="Welcome")
     # Free
@@ -760,7 +3009,14 @@ def seed():
 
     # Seed a few notifications for each demo user
     for u in (admin, free, plus, biz):
-        _seed_notifications_for_user(u.id)
+        with shard_scope(u.shard):
+            _seed_notifications_for_user(u.id)
+
+
+def seed():
+    """Schema migrations + demo data (kept for scripts that expect one call)."""
+    migrate()
+    seed_demo()
 
 
 # ---------- Health ----------
@@ -770,18 +3026,23 @@ def health():
 
 
 # ---------- Plan catalog (for UI cards) ----------
+PLAN_CATALOG = {
+    "plans": {
+        "free":     {"chat": 100,  "bill": 3,   "bank": 3},
+        "plus":     {"chat": 1000, "bill": 100, "bank": 100},
+        "business": {"chat": None, "bill": None, "bank": None},
+    }
+}
+PLAN_CATALOG_ETAG = hashlib.blake2b(json.dumps(PLAN_CATALOG, sort_keys=True).encode(), digest_size=10).hexdigest()
+
+
 @app.get("/plans")
+@conditional(lambda: (PLAN_CATALOG_ETAG, None), private=False)
 def plans_catalog():
     """
     Master plan catalog for the UI. Business is contract-based (None).
     """
-    return jsonify({
-        "plans": {
-            "free":     {"chat": 100,  "bill": 3,   "bank": 3},
-            "plus":     {"chat": 1000, "bill": 100, "bank": 100},
-            "business": {"chat": None, "bill": None, "bank": None},
-        }
-    })
+    return jsonify(PLAN_CATALOG)
 
 
 # ---------- Auth ----------
@@ -797,10 +3058,12 @@ def signup():
         return jsonify({"error": "email_in_use"}), 409
     u = User(email=email, name=name, password_hash=generate_password_hash(pw))
     db.session.add(u); db.session.commit()
+    u.shard = place_user(u.id)
     db.session.add(Profile(id=u.id, full_name=u.name))
     db.session.add(UserCredit(id=u.id, plan="free", last_reset_at=now_ym()))
     db.session.commit()
-    ensure_baseline_notifications(u.id)
+    with shard_scope(u.shard):
+        ensure_baseline_notifications(u.id)
     tok = secrets.token_hex(24)
     db.session.add(Session(token=tok, user_id=u.id)); db.session.commit()
     return jsonify({"user": u.to_dict(include_profile=True), "session": {"access_token": tok}})
@@ -818,6 +3081,7 @@ def login():
     return jsonify({"token": tok, "user": u.to_dict(include_profile=True)})
 
 @app.get("/auth/me")
+@conditional(lambda: user_validators(last_modified=False))
 def me():
     u = g.user
     return jsonify({"user": None if not u else u.to_dict(include_profile=True)})
@@ -827,6 +3091,7 @@ def logout():
     tok = request.headers.get("Authorization", "").replace("Bearer ", "")
     Session.query.filter_by(token=tok).delete()
     db.session.commit()
+    admission_forget_token(tok)
     return jsonify({"ok": True})
 
 # NEW: change password
@@ -847,59 +3112,409 @@ def change_password():
 
 # ---------- Profile ----------
 @app.get("/me")
+@conditional(lambda: user_validators(last_modified=False))
 def get_me():
-    u = current_user_required()
+    u = load_account(current_user_required().id)
     d = u.to_dict(include_profile=True)
     uc = load_or_create_credits(u.id)
     d["plan"] = uc.plan or "free"
     return jsonify(d)
 
-@app.put("/me")
-def update_me():
-    u = current_user_required()
-    data = request.get_json() or {}
-    u.name = data.get("name", u.name)
-    prof = db.session.get(Profile, u.id) or Profile(id=u.id)
-    prof.full_name = data.get("full_name", prof.full_name)
-    prof.avatar_url = data.get("avatar_url", prof.avatar_url)
-    db.session.add(prof); db.session.commit()
-    return jsonify(u.to_dict(include_profile=True))
+@app.put("/me")
+def update_me():
+    u = current_user_required()
+    data = request.get_json() or {}
+    u.name = data.get("name", u.name)
+    prof = db.session.get(Profile, u.id) or Profile(id=u.id)
+    prof.full_name = data.get("full_name", prof.full_name)
+    prof.avatar_url = data.get("avatar_url", prof.avatar_url)
+    db.session.add(prof); db.session.commit()
+    return jsonify(u.to_dict(include_profile=True))
+
+@app.post("/me/avatar")
+def me_avatar():
+    """multipart `file` (or `upload_id`) -> stored in the blob store; profile.avatar_url points at it."""
+    u = current_user_required()
+    f = request_file()
+    if f is None:
+        return jsonify({"error": "no_file"}), 400
+    if (f.mimetype or "").lower() not in BLOB_IMAGE_TYPES:  # no SVG: it is a script container
+        return jsonify({"error": "not_an_image"}), 415
+    sha = blob_put(f, owner=u.id)
+    prof = db.session.get(Profile, u.id) or Profile(id=u.id)
+    prof.avatar_url = blob_url(sha, u.id)
+    db.session.add(prof); db.session.commit()
+    return jsonify(u.to_dict(include_profile=True))
+
+# Aliases for UI flexibility
+@app.get("/me/profile")
+def me_profile_get():
+    return get_me()
+
+@app.patch("/me/profile")
+def me_profile_patch():
+    return update_me()
+
+
+# ---------- Credits ----------
+@app.post("/rpc/get_credits")
+def rpc_get_credits():
+    current_user_required()
+    row = load_or_create_credits(g.user.id)
+    db.session.commit()
+    payload = credits_payload(row)
+    # keep a simple numeric for legacy clients; use a large number for contract-based
+    rem = payload["chat"]["remaining"]
+    payload["remaining_simple"] = (rem if isinstance(rem, int) else 10_000_000)
+    return jsonify({"data": {"credits": payload}})
+
+
+# ---------- Chat function ----------
+def _ensure_user_message_inserted(u, chat_id: int, text: str, version: str):
+    c = db.session.get(Chat, int(chat_id))
+    if not c or c.user_id != u.id:
+        abort(404)
+    if c.archived_at is not None:
+        rehydrate_chat(c)
+    m = Message(chat_id=int(chat_id), user_id=u.id, role="user", text=text, version=version)
+    db.session.add(m); db.session.commit()
+    emit_db_change("INSERT", "messages", new=ser(m))
+    return m
+
+# ---------- Chat context (token-budgeted history window) ----------
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("OFFLINE_CONTEXT_TOKENS", "3000"))
+CONTEXT_SUMMARY_TOKENS = int(os.environ.get("OFFLINE_CONTEXT_SUMMARY_TOKENS", "400"))
+CONTEXT_CACHE_SIZE = int(os.environ.get("OFFLINE_CONTEXT_CACHE", "512"))
+CONTEXT_SCAN_PAGE = 32
+
+_context_cache = OrderedDict()  # (shard, chat_id) -> {"upto", "last_id", "window"}
+_context_lock = threading.Lock()
+
+
+def estimate_tokens(s: str) -> int:
+    # ~4 chars per token plus a small per-message overhead; good enough for budgeting
+    return len(s or "") // 4 + 4
+
+
+def _context_turn(m: "Message"):
+    txt = str(m.text or "")
+    return {"id": m.id, "role": m.role or "user", "text": txt, "tokens": estimate_tokens(txt)}
+
+
+def summarize_turns(summary: Optional[str], turns: list) -> str:
+    """
+    Default (extractive) summarizer: one clipped line per turn, keeping only the
+    newest lines that fit CONTEXT_SUMMARY_TOKENS. Swap CONTEXT_SUMMARIZER for a
+    model-backed one; it gets the same (previous summary, evicted turns) input.
+    """
+    lines = (summary or "").splitlines()
+    lines += [f"{t['role']}: {' '.join(t['text'].split())[:160]}" for t in turns]
+    keep, used = [], 0
+    for line in reversed(lines):
+        used += estimate_tokens(line)
+        if used > CONTEXT_SUMMARY_TOKENS:
+            break
+        keep.append(line)
+    return "\n".join(reversed(keep))
+
+
+CONTEXT_SUMMARIZER = summarize_turns
+
+
+def _context_drop(payload):
+    """payload None clears everything, else {"shard", "ids"}."""
+    with _context_lock:
+        if payload is None:
+            _context_cache.clear()
+        else:
+            for cid in payload["ids"]:
+                _context_cache.pop((payload["shard"], int(cid)), None)
+
+
+BUS_CONTROL["context_invalidate"] = _context_drop
+
+
+def context_cache_invalidate(chat_ids=None):
+    """Drop cached windows here and, through the bus, in every other worker."""
+    payload = None if chat_ids is None else {"shard": current_shard(), "ids": [int(c) for c in chat_ids]}
+    _context_drop(payload)
+    CHANGE_BUS.control("context_invalidate", payload)
+
+
+def load_chat_context(chat: "Chat", budget: Optional[int] = None):
+    """
+    Newest turns of `chat` that fit the token budget, plus a rolling summary of
+    everything older. Only reads what the window needs:
+      - cached window: forward scan of messages newer than the last one seen
+      - cold: reverse scan over (chat_id, id) until the budget is full
+    Evicted turns are folded into ChatSummary; the caller commits.
+    """
+    budget = (budget or CONTEXT_TOKEN_BUDGET) - CONTEXT_SUMMARY_TOKENS
+    srow = db.session.get(ChatSummary, chat.id)
+    upto = (srow.upto_message_id or 0) if srow else 0
+    key = (current_shard(), chat.id)
+
+    with _context_lock:
+        cached = _context_cache.get(key)
+        if cached is not None:
+            _context_cache.move_to_end(key)
+
+    evicted = []
+    if cached is not None and cached["upto"] == upto:
+        window = list(cached["window"])
+        newer = (Message.query.filter(Message.chat_id == chat.id, Message.id > cached["last_id"])
+                 .order_by(Message.id.asc()).all())
+        window += [_context_turn(m) for m in newer]
+    else:
+        window, used, before, full = [], 0, None, False
+        while not full:
+            q = Message.query.filter(Message.chat_id == chat.id, Message.id > upto)
+            if before is not None:
+                q = q.filter(Message.id < before)
+            page = q.order_by(Message.id.desc()).limit(CONTEXT_SCAN_PAGE).all()
+            for m in page:
+                t = _context_turn(m)
+                if window and used + t["tokens"] > budget:
+                    full = True
+                    break
+                window.append(t); used += t["tokens"]
+            if len(page) < CONTEXT_SCAN_PAGE:
+                break
+            before = page[-1].id
+        window.reverse()
+        if full and window:
+            # unsummarized turns just below the window; older ones would be
+            # clipped out of the summary anyway, so read only one page of them
+            older = (Message.query.filter(Message.chat_id == chat.id, Message.id > upto,
+                                          Message.id < window[0]["id"])
+                     .order_by(Message.id.desc()).limit(CONTEXT_SCAN_PAGE).all())
+            evicted = [_context_turn(m) for m in reversed(older)]
+
+    total = sum(t["tokens"] for t in window)
+    while len(window) > 1 and total > budget:
+        t = window.pop(0)
+        total -= t["tokens"]
+        evicted.append(t)
+
+    if evicted:
+        if srow is None:
+            srow = ChatSummary(id=chat.id, upto_message_id=0)
+            db.session.add(srow)
+        srow.summary = CONTEXT_SUMMARIZER(srow.summary, evicted)
+        srow.upto_message_id = evicted[-1]["id"]
+        srow.updated_at = datetime.utcnow()
+        upto = srow.upto_message_id
+
+    last_id = window[-1]["id"] if window else upto
+    with _context_lock:
+        _context_cache[key] = {"upto": upto, "last_id": last_id, "window": window}
+        _context_cache.move_to_end(key)
+        while len(_context_cache) > CONTEXT_CACHE_SIZE:
+            _context_cache.popitem(last=False)
+
+    summary = srow.summary if srow else None
+    return {
+        "summary": summary,
+        "messages": [{"role": t["role"], "content": t["text"]} for t in window],
+        "tokens": total + (estimate_tokens(summary) if summary else 0),
+    }
+
+
+# ---------- LLM providers (per chat version) ----------
+# Each CHAT_COST version routes to a backend configured by env:
+#   OFFLINE_LLM_V1_URL=http://127.0.0.1:8080/v1   (OpenAI-compatible server)
+#   OFFLINE_LLM_V1_MODEL=llama-3-8b-instruct       (optional)
+#   OFFLINE_LLM_V1_CONCURRENCY=8                   (max in-flight calls, server-wide)
+# Versions without a URL use the in-process stub.
+LLM_TIMEOUT = float(os.environ.get("OFFLINE_LLM_TIMEOUT", "60"))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("OFFLINE_LLM_QUEUE_TIMEOUT", "10"))
+LLM_PLAN_CONCURRENCY = {"free": 4, "plus": 16, "business": 32, "admin": 64}
+
+
+class LLMError(Exception):
+    code, status = "MODEL_UNAVAILABLE", 502
+
+
+class LLMTimeout(LLMError):
+    code, status = "MODEL_TIMEOUT", 504
+
+
+class LLMBusy(LLMError):
+    code, status = "MODEL_BUSY", 503
+
+
+class _HTTPPool:
+    """Small keep-alive connection pool for one host (http.client, no extra deps)."""
+
+    def __init__(self, base_url: str, size: int):
+        u = urlsplit(base_url)
+        self.https = u.scheme == "https"
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or (443 if self.https else 80)
+        self.prefix = u.path.rstrip("/")
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _new(self, timeout):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=timeout)
+
+    def request(self, method: str, path: str, body: bytes, headers: dict, timeout: float):
+        try:
+            conn, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            conn, reused = self._new(timeout), False
+        try:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, self.prefix + path, body=body, headers=headers)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                if not reused:
+                    raise
+                # server closed an idle keep-alive connection: retry once on a fresh one
+                conn.close()
+                conn = self._new(timeout)
+                conn.request(method, self.prefix + path, body=body, headers=headers)
+                resp = conn.getresponse()
+            data = resp.read()
+        except BaseException:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+        return resp.status, data
+
+
+class LLMProvider(ABC):
+    name = "base"
+
+    @abstractmethod
+    def complete(self, messages: list, version: str, timeout: float) -> str:
+        """Reply text for an OpenAI-style message list; raises LLMError subclasses."""
+
+
+class StubProvider(LLMProvider):
+    """In-process provider for tests/offline demos; keeps the historical reply text."""
+    name = "stub"
+
+    def complete(self, messages, version, timeout):
+        return f"Temporary reply message from {version}"
+
+
+class OpenAICompatProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self, base_url: str, model: str, api_key: Optional[str], pool_size: int):
+        self.model = model
+        self.api_key = api_key
+        self.pool = _HTTPPool(base_url, pool_size)
+
+    def complete(self, messages, version, timeout):
+        body = json.dumps({"model": self.model, "messages": messages, "stream": False}).encode()
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        try:
+            status, data = self.pool.request("POST", "/chat/completions", body, headers, timeout)
+        except TimeoutError as e:
+            raise LLMTimeout(str(e))
+        except OSError as e:
+            raise LLMError(str(e))
+        if status != 200:
+            raise LLMError(f"upstream HTTP {status}")
+        try:
+            return json.loads(data)["choices"][0]["message"]["content"] or ""
+        except Exception:
+            raise LLMError("bad upstream payload")
+
+
+def _build_providers():
+    out = {}
+    for v in CHAT_COST:
+        url = os.environ.get(f"OFFLINE_LLM_{v}_URL")
+        conc = per_worker(int(os.environ.get(f"OFFLINE_LLM_{v}_CONCURRENCY", "8")))
+        if url:
+            prov = OpenAICompatProvider(url, os.environ.get(f"OFFLINE_LLM_{v}_MODEL", v.lower()),
+                                        os.environ.get(f"OFFLINE_LLM_{v}_API_KEY"), conc)
+        else:
+            prov = StubProvider()
+        out[v] = {"provider": prov, "sem": threading.BoundedSemaphore(conc)}
+    return out
 
-# Aliases for UI flexibility
-@app.get("/me/profile")
-def me_profile_get():
-    return get_me()
 
-@app.patch("/me/profile")
-def me_profile_patch():
-    return update_me()
+LLM_PROVIDERS = _build_providers()
+_llm_plan_sems = {p: threading.BoundedSemaphore(per_worker(n)) for p, n in LLM_PLAN_CONCURRENCY.items()}
+_llm_inflight = {}  # prompt key -> {"done": Event, "reply", "error"}
+_llm_inflight_lock = threading.Lock()
 
 
-# ---------- Credits ----------
-@app.post("/rpc/get_credits")
-def rpc_get_credits():
-    current_user_required()
-    row = load_or_create_credits(g.user.id)
-    db.session.commit()
-    payload = credits_payload(row)
-    # keep a simple numeric for legacy clients; use a large number for contract-based
-    rem = payload["chat"]["remaining"]
-    payload["remaining_simple"] = (rem if isinstance(rem, int) else 10_000_000)
-    return jsonify({"data": {"credits": payload}})
+def _llm_messages(ctx: dict) -> list:
+    msgs = []
+    if ctx.get("summary"):
+        msgs.append({"role": "system", "content": "Summary of the earlier conversation:\n" + ctx["summary"]})
+    return msgs + ctx["messages"]
 
 
-# ---------- Chat function ----------
-def _ensure_user_message_inserted(u, chat_id: int, text: str, version: str):
-    c = db.session.get(Chat, int(chat_id))
-    if not c or c.user_id != u.id:
-        abort(404)
-    m = Message(chat_id=int(chat_id), user_id=u.id,
-                content_json={"role":"user","text":text,"version":version,"meta":{}})
-    db.session.add(m); db.session.commit()
-    socketio.emit("db_change", {"eventType":"INSERT","schema":"public","table":"messages","new":ser(m),"old":None})
-    return m
+def _llm_call(version: str, plan: str, messages: list) -> str:
+    entry = LLM_PROVIDERS[version]
+    plan_sem = _llm_plan_sems.get(plan) or _llm_plan_sems["free"]
+    if not plan_sem.acquire(timeout=LLM_QUEUE_TIMEOUT):
+        raise LLMBusy("plan concurrency limit")
+    try:
+        if not entry["sem"].acquire(timeout=LLM_QUEUE_TIMEOUT):
+            raise LLMBusy(f"{version} concurrency limit")
+        try:
+            return entry["provider"].complete(messages, version, LLM_TIMEOUT)
+        finally:
+            entry["sem"].release()
+    finally:
+        plan_sem.release()
+
+
+def llm_complete(version: str, plan: str, ctx: dict) -> str:
+    """
+    Route a chat turn to the version's provider under the per-version and
+    per-plan semaphores. Identical prompts already in flight on the same plan
+    share one call (a follower never rides on another plan's semaphore).
+    """
+    messages = _llm_messages(ctx)
+    plan = (plan or "free").lower()
+    key = hashlib.sha1(json.dumps([version, plan, messages], sort_keys=True).encode()).hexdigest()
+    with _llm_inflight_lock:
+        slot = _llm_inflight.get(key)
+        leader = slot is None
+        if leader:
+            slot = _llm_inflight[key] = {"done": threading.Event(), "reply": None, "error": None}
+    if not leader:
+        if not slot["done"].wait(LLM_TIMEOUT + LLM_QUEUE_TIMEOUT):
+            raise LLMTimeout("coalesced call timed out")
+        if slot["error"] is not None:
+            raise slot["error"]
+        return slot["reply"]
+    try:
+        slot["reply"] = _llm_call(version, plan, messages)
+        return slot["reply"]
+    except LLMError as e:
+        slot["error"] = e
+        raise
+    except Exception as e:
+        slot["error"] = LLMError(str(e))
+        raise slot["error"]
+    finally:
+        with _llm_inflight_lock:
+            _llm_inflight.pop(key, None)
+        slot["done"].set()
+
 
 @app.post("/functions/v1/<name>")
+@idempotent
 def functions_invoke(name):
     current_user_required()
     body = request.get_json(silent=True) or {}
@@ -909,57 +3524,89 @@ def functions_invoke(name):
     version = (body.get("version") or "V2").upper()
     cost = CHAT_COST.get(version, 2)
 
+    label = "V1" if version=="V1" else "V3" if version=="V3" else "V2"
+
+    chat_id = body.get("chat_id")
+    text = body.get("text") or body.get("user_text") or ""
+    c = None
+    if chat_id:
+        c = db.session.get(Chat, int(chat_id))
+        if not c or c.user_id != g.user.id:
+            abort(404)
+        if c.archived_at is not None:
+            rehydrate_chat(c)
+
     row = load_or_create_credits(g.user.id)
     lim = effective_limits(row)
     reset_month_if_needed(row)
     db.session.commit()
 
+    # Reserve credits up front with a conditional UPDATE so concurrent turns
+    # can't overspend; refunded below if the model call fails.
+    q = UserCredit.query.filter(UserCredit.id == g.user.id)
     # If chat limit is None => contract-based (no cap here)
     if lim["chat"] is not None:
-        remaining = max(0, int(lim["chat"]) - (row.chat_used or 0))
-        if remaining < cost:
-            return jsonify({
-                "errorCode": "INSUFFICIENT_CREDITS",
-                "message": "Not enough credits",
-                "data": {"credits": credits_payload(row)}
-            }), 200
-
-    chat_id = body.get("chat_id")
-    text = body.get("text") or body.get("user_text") or ""
-    if not chat_id:
+        q = q.filter(db.func.coalesce(UserCredit.chat_used, 0) + cost <= int(lim["chat"]))
+    reserved = q.update(
+        {UserCredit.chat_used: db.func.coalesce(UserCredit.chat_used, 0) + cost,
+         UserCredit.updated_at: datetime.utcnow()},
+        synchronize_session=False,
+    )
+    usage_record("chat", "charged" if reserved else "insufficient", cost if reserved else 0, row.plan, label)
+    db.session.commit()
+    db.session.refresh(row)
+    METRICS.inc("credit_charges_total", kind="chat", outcome="charged" if reserved else "insufficient")
+    if not reserved:
+        payload = credits_payload(row)
+        credit_hint_store("chat", payload["chat"]["remaining"] or 0, payload)
+        return jsonify({
+            "errorCode": "INSUFFICIENT_CREDITS",
+            "message": "Not enough credits",
+            "data": {"credits": payload}
+        }), 200
+
+    if c is None:
         c = Chat(user_id=g.user.id, title="New Chat")
         db.session.add(c); db.session.commit()
         chat_id = c.id
-    else:
-        c = db.session.get(Chat, int(chat_id))
-        if not c or c.user_id != g.user.id:
-            abort(404)
 
     if text:
         _ensure_user_message_inserted(g.user, int(chat_id), text, version)
+    ctx = load_chat_context(c)
+    db.session.commit()  # never hold the SQLite write lock across the model call
 
-    label = "V1" if version=="V1" else "V3" if version=="V3" else "V2"
-    reply = f"Temporary reply message from {label}"
-
-    m = Message(chat_id=int(chat_id), user_id=g.user.id,
-                content_json={"role":"assistant","text":reply,"version":version,"meta":{}})
+    try:
+        reply = llm_complete(label, row.plan, ctx)
+    except LLMError as e:
+        METRICS.inc("credit_charges_total", kind="chat", outcome="refunded")
+        UserCredit.query.filter(UserCredit.id == g.user.id).update(
+            {UserCredit.chat_used: db.func.max(0, db.func.coalesce(UserCredit.chat_used, 0) - cost)},
+            synchronize_session=False,
+        )
+        usage_record("chat", "refunded", -cost, row.plan, label)
+        db.session.commit()
+        db.session.refresh(row)
+        return jsonify({
+            "errorCode": e.code,
+            "error": e.code.lower(),
+            "message": "Model backend failed; credits were refunded",
+            "data": {"chat_id": chat_id, "credits": credits_payload(row)},
+        }), e.status
+
+    m = Message(chat_id=int(chat_id), user_id=g.user.id, role="assistant", text=reply, version=version)
     db.session.add(m)
-    c.last_message = reply
-    c.messages_count = (c.messages_count or 0) + 1
-    c.updated_at = datetime.utcnow()
-
-    row.chat_used = (row.chat_used or 0) + cost
-    row.updated_at = datetime.utcnow()
     db.session.commit()
 
-    socketio.emit("db_change", {"eventType":"INSERT","schema":"public","table":"messages","new":ser(m),"old":None})
+    emit_db_change("INSERT", "messages", new=ser(m))
 
     return jsonify({
         "data": {
             "choices": [{"message": {"role": "assistant", "content": reply}}],
             "chat_id": chat_id,
             "assistant": ser(m),
-            "credits": credits_payload(row)
+            "credits": credits_payload(row),
+            "context": {"messages": len(ctx["messages"]), "tokens": ctx["tokens"],
+                        "summarized": bool(ctx["summary"])},
         }
     })
 
@@ -980,23 +3627,39 @@ def _ocr_charge_and_payload(kind: str):
     if limit is not None:
         remaining = max(0, int(limit) - used)
         if remaining <= 0:
+            METRICS.inc("credit_charges_total", kind=f"ocr_{kind}", outcome="insufficient")
+            usage_record(f"ocr_{kind}", "insufficient", 0, row.plan)
+            db.session.commit()
+            payload = credits_payload(row)
+            credit_hint_store(kind, 0, payload)
             return None, jsonify({
                 "errorCode": "INSUFFICIENT_CREDITS",
                 "message": "Not enough OCR credits",
-                "data": {"credits": credits_payload(row)}
+                "data": {"credits": payload}
             }), 200
 
     setattr(row, used_attr, used + 1)
     row.updated_at = datetime.utcnow()
+    usage_record(f"ocr_{kind}", "charged", 1, row.plan)
     db.session.commit()
+    METRICS.inc("credit_charges_total", kind=f"ocr_{kind}", outcome="charged")
     return row, None, None
 
+def _ocr_source(f) -> dict:
+    """Keep the scanned document so history can show it again (file_url for the OCR row)."""
+    if f is None:
+        return {"file_url": None, "blob": None}
+    sha = blob_put(f, owner=g.user.id)
+    return {"file_url": blob_url(sha, g.user.id), "blob": sha}
+
+
 @app.post("/vision/ocr/bill")
+@idempotent
 def vision_ocr_bill():
+    f = request_file()  # resolve upload_id before charging
     row, err_resp, err_code = _ocr_charge_and_payload("bill")
     if err_resp is not None:
         return err_resp, err_code
-    f = request.files.get("file")
     filename = getattr(f, "filename", None)
     fields = {
         "buyer_name_thai": "", "seller_name_thai": "", "doc_number": "",
@@ -1005,23 +3668,25 @@ def vision_ocr_bill():
         "total_due_amount": 0, "table": [],
     }
     # ✅ remove the stray "}" before the final ")"
-    return jsonify({"data": {"fields": fields, "filename": filename}, "credits": credits_payload(row)})
+    return jsonify({"data": {"fields": fields, "filename": filename, **_ocr_source(f)}, "credits": credits_payload(row)})
 
 @app.post("/vision/ocr/bank")
+@idempotent
 def vision_ocr_bank():
+    f = request_file()  # resolve upload_id before charging
     row, err_resp, err_code = _ocr_charge_and_payload("bank")
     if err_resp is not None:
         return err_resp, err_code
-    f = request.files.get("file")
     filename = getattr(f, "filename", None)
     fields = {
         "account_number": "", "statement_period": "", "currency": "THB",
         "opening_balance": 0, "closing_balance": 0, "table": [],
     }
-    return jsonify({"data": {"fields": fields, "filename": filename}, "credits": credits_payload(row)})
+    return jsonify({"data": {"fields": fields, "filename": filename, **_ocr_source(f)}, "credits": credits_payload(row)})
 
 # ---------- OCR: unified history ----------
 @app.get("/ocr/history")
+@conditional(user_validators)
 def ocr_history():
     current_user_required()
     bills = OCRBillExtract.query.filter_by(user_id=g.user.id).all()
@@ -1044,6 +3709,7 @@ def ocr_history():
 
 # ---------- Notifications (scoped + paginated) ----------
 @app.get("/notifications")
+@conditional(user_validators)
 def notifications_list():
     """List notifications for the current user with filters and pagination."""
     current_user_required()
@@ -1060,6 +3726,10 @@ def notifications_list():
 
     q = Notification.query.filter_by(user_id=g.user.id)
 
+    if status == "archived":
+        q = q.filter(Notification.archived_at.is_not(None))
+    else:
+        q = q.filter(Notification.archived_at.is_(None))
     if status == "unread":
         q = q.filter(Notification.read_at.is_(None))
     elif status == "read":
@@ -1070,21 +3740,104 @@ def notifications_list():
     return jsonify({"rows": [ser(r) for r in rows]})
 
 
+def _parse_ts(value):
+    """ISO-8601 string -> naive UTC datetime (the format stored in the DB), or None."""
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _notifications_selected(data: dict):
+    """
+    Build the user-scoped query for a bulk notification action.
+    Selectors (first match wins):
+      {"id": 5} | {"ids": [1,2,3]} | {"before": "2025-01-01T00:00:00Z"} | {"all": true}
+    Returns (query, None) or (None, error_response).
+    """
+    q = Notification.query.filter(Notification.user_id == g.user.id)
+    if data.get("id") is not None or data.get("ids") is not None:
+        raw = data.get("ids") if data.get("ids") is not None else [data.get("id")]
+        if not isinstance(raw, list):
+            raw = [raw]
+        try:
+            ids = [int(x) for x in raw]
+        except (TypeError, ValueError):
+            return None, (jsonify({"error": "invalid_ids"}), 400)
+        if not ids:
+            return None, (jsonify({"error": "missing_selector"}), 400)
+        return q.filter(Notification.id.in_(ids)), None
+    if data.get("before"):
+        before = _parse_ts(data.get("before"))
+        if before is None:
+            return None, (jsonify({"error": "invalid_before"}), 400)
+        return q.filter(Notification.created_at <= before), None
+    if data.get("all") is True:
+        return q, None
+    return None, (jsonify({"error": "missing_selector"}), 400)
+
+
+def _notifications_bulk_update(values: dict, only_if=None):
+    """Run one scoped UPDATE for the selected notifications and return the count."""
+    current_user_required()
+    data = request.get_json(silent=True) or {}
+    q, err = _notifications_selected(data)
+    if err is not None:
+        return err
+    if only_if is not None:
+        q = q.filter(only_if)
+    n = q.update(values, synchronize_session=False)
+    db.session.commit()
+    return jsonify({"ok": True, "updated": n})
+
+
 @app.post("/notifications/mark_read")
 def notifications_mark_read():
-    """Mark a notification as read for the current user."""
+    """Mark notifications as read (by id, ids, before timestamp or all)."""
+    return _notifications_bulk_update(
+        {Notification.read_at: datetime.utcnow()}, only_if=Notification.read_at.is_(None)
+    )
+
+
+@app.post("/notifications/mark_unread")
+def notifications_mark_unread():
+    """Mark notifications as unread (same selectors as mark_read)."""
+    return _notifications_bulk_update(
+        {Notification.read_at: None}, only_if=Notification.read_at.is_not(None)
+    )
+
+
+@app.post("/notifications/archive")
+def notifications_archive():
+    """Archive notifications; archived rows are hidden from the default list and counts."""
+    return _notifications_bulk_update(
+        {Notification.archived_at: datetime.utcnow()}, only_if=Notification.archived_at.is_(None)
+    )
+
+
+@app.post("/notifications/unarchive")
+def notifications_unarchive():
+    return _notifications_bulk_update(
+        {Notification.archived_at: None}, only_if=Notification.archived_at.is_not(None)
+    )
+
+
+@app.post("/notifications/delete")
+def notifications_delete():
+    """Delete notifications in one scoped DELETE; returns the deleted count."""
     current_user_required()
     data = request.get_json(silent=True) or {}
-    nid = data.get("id")
-    if not nid:
-        return jsonify({"error": "missing_id"}), 400
-    rec = db.session.get(Notification, int(nid))
-    if not rec or rec.user_id != g.user.id:
-        return jsonify({"error": "not_found"}), 404
-    if rec.read_at is None:
-        rec.read_at = datetime.utcnow()
-        db.session.commit()
-    return jsonify({"ok": True, "row": ser(rec)})
+    q, err = _notifications_selected(data)
+    if err is not None:
+        return err
+    n = q.delete(synchronize_session=False)
+    db.session.commit()
+    return jsonify({"ok": True, "deleted": n})
 
 
 # (Kept for compatibility) ---------- Notifications generic ----------
@@ -1120,6 +3873,7 @@ def _scope_query_to_user(Model, q):
     return q
 
 @app.get("/db/<table>")
+@conditional(lambda table: user_validators() if table in SYNC_TABLES else None)
 def table_select(table):
     Model = TABLES.get(table)
     if not Model: return jsonify({"error":"unknown_table"}), 400
@@ -1131,6 +3885,13 @@ def table_select(table):
         limit, offset = 0, 0
     order_col = args.pop("_order_col", None)
     order_asc = args.pop("_order_asc", "1") == "1"
+    if Model is Message and args.get("chat_id"):
+        current_user_required()
+        chat = db.session.get(Chat, int(args["chat_id"])) if str(args["chat_id"]).isdigit() else None
+        if chat is not None and chat.user_id == g.user.id and chat.archived_at is not None:
+            if not ARCHIVE_REHYDRATE_ON_READ:
+                return jsonify({"rows": archived_messages_select(chat, args, order_col, order_asc, offset, limit)})
+            rehydrate_chat(chat)
     q = _scope_query_to_user(Model, Model.query)
     for k, v in args.items():
         if hasattr(Model, k): q = q.filter(getattr(Model, k) == v)
@@ -1142,6 +3903,7 @@ def table_select(table):
     return jsonify({"rows": [ser(r) for r in rows]})
 
 @app.post("/db/<table>")
+@idempotent
 def table_insert(table):
     current_user_required()
     Model = TABLES.get(table)
@@ -1150,33 +3912,23 @@ def table_insert(table):
     values = body.get("values")
     if values is None: return jsonify({"error":"missing_values"}), 400
     if isinstance(values, dict): values = [values]
-    inserted=[]
+    inserted = []
     for row in values:
         clean = sanitize_row(Model, row)
         if _has_user_id(Model): clean["user_id"] = g.user.id
         if Model is Message:
-            chat_id = int(clean.get("chat_id") or 0)
-            chat = db.session.get(Chat, chat_id)
+            chat = db.session.get(Chat, int(clean.get("chat_id") or 0))  # identity map after the first
             if not chat or chat.user_id != g.user.id: abort(404)
-            cj = clean.get("content_json")
-            if isinstance(cj, str):
-                try: clean["content_json"] = json.loads(cj)
-                except Exception: clean["content_json"] = {"text": str(cj)}
+            if chat.archived_at is not None: rehydrate_chat(chat)
         m = Model(**clean)
         db.session.add(m); inserted.append(m)
+    db.session.flush()
+    rows = [ser(x) for x in inserted]  # before commit expires them (one SELECT each otherwise)
     db.session.commit()
     if Model is Message:
-        for m in inserted:
-          chat = db.session.get(Chat, m.chat_id)
-          if chat:
-            c = m.content_json; txt = (c.get("text") if isinstance(c, dict) else (c or "")) if c is not None else ""
-            chat.last_message = txt
-            chat.messages_count = (chat.messages_count or 0) + 1
-            chat.updated_at = datetime.utcnow()
-        db.session.commit()
-        for m in inserted:
-            socketio.emit("db_change", {"eventType":"INSERT","schema":"public","table":"messages","new":ser(m),"old":None})
-    return jsonify({"rows": [ser(x) for x in inserted]}), 201
+        for r in rows:
+            emit_db_change("INSERT", "messages", new=r)
+    return jsonify({"rows": rows}), 201
 
 @app.patch("/db/<table>")
 def table_update(table):
@@ -1192,7 +3944,8 @@ def table_update(table):
     rows = q.all()
     olds = [ser(r) for r in rows]
     cols = model_columns(Model)
-    values.pop("user_id", None)
+    for k in ("user_id", "shard", "shard_moving"):
+        values.pop(k, None)
     if "content" in values and "content_json" in cols: values["content_json"] = values.pop("content")
     if "metadata" in values and "metadata_json" in cols: values["metadata_json"] = values.pop("metadata")
     if "data" in values and "data_json" in cols: values["data_json"] = values.pop("data")
@@ -1202,8 +3955,12 @@ def table_update(table):
             if k in cols: setattr(r, k, v)
         if hasattr(r, "updated_at"): r.updated_at = datetime.utcnow()
     db.session.commit()
+    if Model in (Message, Chat):
+        context_cache_invalidate({r.chat_id if Model is Message else r.id for r in rows})
+    if Model is UserCredit:
+        credit_hint_clear(g.user.id)
     for old, r in zip(olds, rows):
-        socketio.emit("db_change", {"eventType":"UPDATE","schema":"public","table":table,"new":ser(r),"old":old})
+        emit_db_change("UPDATE", table, new=ser(r), old=old)
     return jsonify({"rows": [ser(r) for r in rows]})
 
 @app.delete("/db/<table>")
@@ -1217,13 +3974,1477 @@ def table_delete(table):
         if hasattr(Model, k): q = q.filter(getattr(Model, k) == v)
     rows = q.all()
     payload = [ser(r) for r in rows]
+    if Model in (Message, Chat):
+        # deleted ids can be reused by SQLite, so drop the summaries too
+        chat_ids = {r["chat_id"] if Model is Message else r["id"] for r in payload}
+        if chat_ids:
+            ChatSummary.query.filter(ChatSummary.id.in_(chat_ids)).delete(synchronize_session=False)
+        context_cache_invalidate(chat_ids)
     for r in rows: db.session.delete(r)
     db.session.commit()
+    if Model is Chat:
+        for r in payload:
+            if r.get("archive_file"):
+                try:
+                    os.remove(os.path.join(ARCHIVE_DIR, r["archive_file"]))
+                except OSError:
+                    pass
     for row in payload:
-        socketio.emit("db_change", {"eventType":"DELETE","schema":"public","table":table,"new":None,"old":row})
+        emit_db_change("DELETE", table, old=row)
     return jsonify({"rows": payload})
 
 
+# ---------- Chat aggregates ----------
+# chats.last_message / messages_count / updated_at are kept by triggers on
+# messages, so every write path (ORM, Core executemany, raw SQL) agrees and
+# nothing patches them by hand. Archived chats are skipped: archive_chat()
+# and rehydrate_chat() move rows while archived_at is set, so the sidebar keeps
+# the pre-archive preview and count. updated_at only moves forward, to the
+# message's created_at, which keeps imported history in its original order.
+# ix_chats_user_updated makes "my chats, most recent first" one index scan.
+_NOW_SQL = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+_LAST_TEXT_SQL = "(SELECT text FROM messages WHERE chat_id = {c} ORDER BY id DESC LIMIT 1)"
+
+CHAT_AGG_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_chats_user_updated ON chats (user_id, updated_at)",
+    f"""CREATE TRIGGER IF NOT EXISTS chats_agg_ai AFTER INSERT ON messages BEGIN
+        UPDATE chats SET messages_count = COALESCE(messages_count, 0) + 1, last_message = new.text,
+            updated_at = MAX(COALESCE(updated_at, ''), COALESCE(new.created_at, {_NOW_SQL}))
+        WHERE id = new.chat_id AND archived_at IS NULL;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS chats_agg_ad AFTER DELETE ON messages BEGIN
+        UPDATE chats SET messages_count = MAX(COALESCE(messages_count, 0) - 1, 0),
+            last_message = {_LAST_TEXT_SQL.format(c="old.chat_id")}
+        WHERE id = old.chat_id AND archived_at IS NULL;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS chats_agg_au AFTER UPDATE OF text, chat_id ON messages BEGIN
+        UPDATE chats SET messages_count = MAX(COALESCE(messages_count, 0) - 1, 0),
+            last_message = {_LAST_TEXT_SQL.format(c="old.chat_id")}
+        WHERE id = old.chat_id AND old.chat_id IS NOT new.chat_id AND archived_at IS NULL;
+        UPDATE chats SET messages_count = COALESCE(messages_count, 0) + (old.chat_id IS NOT new.chat_id),
+            last_message = {_LAST_TEXT_SQL.format(c="new.chat_id")}
+        WHERE id = new.chat_id AND archived_at IS NULL
+          AND (old.chat_id IS NOT new.chat_id
+               OR new.id = (SELECT MAX(id) FROM messages WHERE chat_id = new.chat_id));
+    END""",
+]
+
+# hot chats whose stored aggregates disagree with their messages (the drift
+# the hand-maintained counters left behind); rewritten once by migration 18
+CHAT_AGG_BACKFILL = f"""
+    UPDATE chats SET messages_count = (SELECT COUNT(*) FROM messages WHERE chat_id = chats.id),
+        last_message = {_LAST_TEXT_SQL.format(c="chats.id")}
+    WHERE id > :lo AND id <= :hi AND archived_at IS NULL
+      AND (COALESCE(messages_count, 0) != (SELECT COUNT(*) FROM messages WHERE chat_id = chats.id)
+           OR last_message IS NOT {_LAST_TEXT_SQL.format(c="chats.id")})
+"""
+
+
+# ---------- Chat views (eager-loaded composite reads) ----------
+# GET /chats: the user's chats, most recently updated first, each with its
+# newest message as a preview (2 queries: chats, then every preview at once
+# via selectinload). GET /chats/<id>: the chat, its summary and the first
+# page of messages (2 queries: chat + summary joined, then the page).
+CHAT_VIEW_PAGE = 50
+
+
+def _page_args(default: int, cap: int = 200):
+    try:
+        limit = max(1, min(cap, int(request.args.get("limit", default))))
+        offset = max(0, int(request.args.get("offset", 0)))
+    except ValueError:
+        limit, offset = default, 0
+    return limit, offset
+
+
+def _preview(m: Optional["Message"]) -> Optional[dict]:
+    if m is None:
+        return None
+    return {"id": m.id, "role": m.role, "text": (m.text or "")[:200],
+            "created_at": m.created_at.isoformat() if m.created_at else None}
+
+
+@app.get("/chats")
+@conditional(user_validators)
+def chats_view():
+    """?limit=50&offset=0 -> {"rows": [chat + "preview"]}"""
+    u = current_user_required()
+    limit, offset = _page_args(CHAT_VIEW_PAGE)
+    chats = db.session.execute(
+        select(Chat).where(Chat.user_id == u.id)
+        .order_by(Chat.updated_at.desc(), Chat.id.desc()).limit(limit).offset(offset)
+        .options(selectinload(Chat.latest_message))
+    ).scalars().all()
+    rows = []
+    for c in chats:
+        d = ser(c)
+        # archived chats keep no message rows; last_message is the preview then
+        d["preview"] = _preview(c.latest_message) or (
+            {"text": (c.last_message or "")[:200]} if c.last_message else None)
+        rows.append(d)
+    return jsonify({"rows": rows})
+
+
+@app.get("/chats/<int:chat_id>")
+@conditional(lambda chat_id: user_validators())
+def chat_view(chat_id):
+    """?limit=50 -> {"chat", "summary", "messages": [first page, oldest first], "has_more"}"""
+    u = current_user_required()
+    limit, _ = _page_args(CHAT_VIEW_PAGE)
+    first_ids = (select(Message.id).where(Message.chat_id == chat_id)
+                 .order_by(Message.id).limit(limit + 1))
+    c = db.session.execute(
+        select(Chat).where(Chat.id == chat_id, Chat.user_id == u.id)
+        .options(joinedload(Chat.summary), selectinload(Chat.messages.and_(Message.id.in_(first_ids))))
+    ).unique().scalar_one_or_none()
+    if c is None:
+        return jsonify({"error": "not_found"}), 404
+    if c.archived_at is not None:
+        messages = archived_messages_select(c, {}, "id", True, 0, limit + 1)
+    else:
+        messages = [ser(m) for m in c.messages]
+    return jsonify({
+        "chat": ser(c),
+        "summary": {"summary": c.summary.summary, "upto_message_id": c.summary.upto_message_id} if c.summary else None,
+        "messages": messages[:limit],
+        "has_more": len(messages) > limit,
+    })
+
+
+# ---------- Search (SQLite FTS5 over message text + chat titles) ----------
+# Triggers copy message text into the index on every write so /search never
+# scans messages. SEARCH_DDL is the schema as migration 8 created it, when text
+# still lived inside content_json; migration 11 swaps in SEARCH_MESSAGE_TRIGGERS.
+# Migration 20 rebuilds both tables as SEARCH_OWNER_DDL: the owner is an
+# indexed "u<id>" token, and every query is "owner : u<id> AND text : (...)".
+# FTS5 intersects the two posting lists, so only the user's own hits are
+# ranked however many users share the file (bm25 ignores the owner column).
+_MSG_TEXT_SQL = (
+    "CASE WHEN json_valid({r}.content_json) "
+    "THEN json_extract({r}.content_json, '$.text') ELSE {r}.content_json END"
+)
+
+SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "text, chat_id UNINDEXED, user_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5("
+    "title, user_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text, chat_id, user_id)
+        VALUES (new.id, {_MSG_TEXT_SQL.format(r="new")}, new.chat_id, new.user_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content_json, chat_id, user_id ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = old.id;
+        INSERT INTO messages_fts(rowid, text, chat_id, user_id)
+        VALUES (new.id, {_MSG_TEXT_SQL.format(r="new")}, new.chat_id, new.user_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chats_fts_ai AFTER INSERT ON chats BEGIN
+        INSERT INTO chats_fts(rowid, title, user_id) VALUES (new.id, new.title, new.user_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chats_fts_ad AFTER DELETE ON chats BEGIN
+        DELETE FROM chats_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chats_fts_au AFTER UPDATE OF title, user_id ON chats BEGIN
+        DELETE FROM chats_fts WHERE rowid = old.id;
+        INSERT INTO chats_fts(rowid, title, user_id) VALUES (new.id, new.title, new.user_id);
+    END""",
+]
+
+SEARCH_MESSAGE_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text, chat_id, user_id) VALUES (new.id, new.text, new.chat_id, new.user_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text, chat_id, user_id ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = old.id;
+        INSERT INTO messages_fts(rowid, text, chat_id, user_id) VALUES (new.id, new.text, new.chat_id, new.user_id);
+    END""",
+]
+
+SEARCH_OWNER_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "text, owner, chat_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')",
+    "INSERT INTO messages_fts(messages_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5("
+    "title, owner, tokenize='unicode61 remove_diacritics 2')",
+    "INSERT INTO chats_fts(chats_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text, owner, chat_id) VALUES (new.id, new.text, 'u' || new.user_id, new.chat_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text, chat_id, user_id ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = old.id;
+        INSERT INTO messages_fts(rowid, text, owner, chat_id) VALUES (new.id, new.text, 'u' || new.user_id, new.chat_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chats_fts_ai AFTER INSERT ON chats BEGIN
+        INSERT INTO chats_fts(rowid, title, owner) VALUES (new.id, new.title, 'u' || new.user_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chats_fts_ad AFTER DELETE ON chats BEGIN
+        DELETE FROM chats_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chats_fts_au AFTER UPDATE OF title, user_id ON chats BEGIN
+        DELETE FROM chats_fts WHERE rowid = old.id;
+        INSERT INTO chats_fts(rowid, title, owner) VALUES (new.id, new.title, 'u' || new.user_id);
+    END""",
+]
+
+# (table, fts table, fts columns, source expressions) per schema, for search_backfill()
+SEARCH_V1_SOURCES = (
+    ("messages", "messages_fts", "rowid, text, chat_id, user_id",
+     f"m.id, {_MSG_TEXT_SQL.format(r='m')}, m.chat_id, m.user_id"),
+    ("chats", "chats_fts", "rowid, title, user_id", "m.id, m.title, m.user_id"),
+)
+SEARCH_SOURCES = (
+    ("messages", "messages_fts", "rowid, text, owner, chat_id", "m.id, m.text, 'u' || m.user_id, m.chat_id"),
+    ("chats", "chats_fts", "rowid, title, owner", "m.id, m.title, 'u' || m.user_id"),
+)
+
+SEARCH_BACKFILL_BATCH = int(os.environ.get("OFFLINE_SEARCH_BACKFILL_BATCH", "5000"))
+
+
+def ensure_search_index():
+    """Create the FTS tables/triggers; backfill existing rows the first time."""
+    existed = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'")
+    ).first() is not None
+    for stmt in SEARCH_DDL:
+        db.session.execute(text(stmt))
+    db.session.commit()
+    if not existed:
+        search_backfill(sources=SEARCH_V1_SOURCES)
+
+
+def search_backfill(batch: int = SEARCH_BACKFILL_BATCH, sources=SEARCH_SOURCES):
+    """
+    Index rows written before the triggers existed, one id range per transaction
+    so the writer lock is never held for long. Idempotent and resumable: rows
+    already in the index are skipped.
+    """
+    total = 0
+    for table, fts, cols, sel in sources:
+        max_id = db.session.execute(text(f"SELECT COALESCE(MAX(id), 0) FROM {table}")).scalar()
+        lo = 0
+        while lo < max_id:
+            res = db.session.execute(
+                text(
+                    f"INSERT INTO {fts}({cols}) SELECT {sel} FROM {table} m "
+                    f"WHERE m.id > :lo AND m.id <= :hi "
+                    f"AND NOT EXISTS (SELECT 1 FROM {fts} f WHERE f.rowid = m.id)"
+                ),
+                {"lo": lo, "hi": lo + batch},
+            )
+            db.session.commit()
+            total += res.rowcount or 0
+            lo += batch
+    return total
+
+
+def _fts_query(raw: str) -> str:
+    """User text -> safe FTS5 query: every term quoted, last term prefix-matched."""
+    terms = [t.replace('"', '""') for t in raw.split() if t.strip()]
+    if not terms:
+        return ""
+    parts = [f'"{t}"' for t in terms]
+    parts[-1] += "*"
+    return " ".join(parts)
+
+
+@app.get("/search")
+def search():
+    """
+    Ranked full-text search over the current user's messages and chat titles.
+    Query: ?q=...&type=all|messages|chats&chat_id=&limit=20&offset=0
+    Matches are wrapped in <mark>…</mark>.
+    """
+    current_user_required()
+    q = _fts_query(request.args.get("q") or "")
+    if not q:
+        return jsonify({"error": "missing_q"}), 400
+    kind = (request.args.get("type") or "all").lower()
+    try:
+        limit = max(1, min(100, int(request.args.get("limit", 20))))
+    except Exception:
+        limit = 20
+    try:
+        offset = max(0, int(request.args.get("offset", 0)))
+    except Exception:
+        offset = 0
+    chat_id = request.args.get("chat_id")
+    if chat_id and not chat_id.isdigit():
+        return jsonify({"error": "bad_chat_id"}), 400
+
+    out = {"messages": [], "chats": []}
+    owner = f"owner : u{int(g.user.id)} AND "
+    params = {"limit": limit + 1, "offset": offset}
+    has_more = False
+
+    if kind in ("all", "messages"):
+        where = "messages_fts MATCH :q"
+        params["q"] = f"{owner}text : ({q})"
+        if chat_id:
+            where += " AND f.chat_id = :chat_id"
+            params["chat_id"] = int(chat_id)
+        rows = db.session.execute(text(
+            "SELECT f.rowid AS id, f.chat_id AS chat_id, m.created_at AS created_at, "
+            "snippet(messages_fts, 0, '<mark>', '</mark>', '…', 16) AS snippet, f.rank AS rank "
+            f"FROM messages_fts f JOIN messages m ON m.id = f.rowid WHERE {where} "
+            "ORDER BY f.rank LIMIT :limit OFFSET :offset"
+        ), params, bind_arguments={"bind": shard_engine()}).mappings().all()
+        has_more = has_more or len(rows) > limit
+        out["messages"] = [
+            dict(r, created_at=str(r["created_at"] or "").replace(" ", "T") or None) for r in rows[:limit]
+        ]
+
+    if kind in ("all", "chats") and not chat_id:
+        rows = db.session.execute(text(
+            "SELECT f.rowid AS id, highlight(chats_fts, 0, '<mark>', '</mark>') AS title, f.rank AS rank "
+            "FROM chats_fts f WHERE chats_fts MATCH :q "
+            "ORDER BY f.rank LIMIT :limit OFFSET :offset"
+        ), dict(params, q=f"{owner}title : ({q})"), bind_arguments={"bind": shard_engine()}).mappings().all()
+        has_more = has_more or len(rows) > limit
+        out["chats"] = [dict(r) for r in rows[:limit]]
+
+    out["next_offset"] = offset + limit if has_more else None
+    return jsonify(out)
+
+
+# ---------- Cold storage (idle chats -> compressed NDJSON segments) ----------
+# archive_chat() moves a chat's messages into ARCHIVE_DIR/<user>/<chat>.ndjson.gz
+# (or .zst when OFFLINE_ARCHIVE_CODEC=zstd and `zstandard` is installed) and
+# leaves the chat row as a stub. Reads of /db/messages?chat_id= stream from the
+# segment; any write to the chat rehydrates it first. Archived text drops out
+# of /search until the chat is rehydrated. Message ids are stable across the
+# round trip: messages is AUTOINCREMENT (migration 19), so an archived id is
+# never handed to a new row and rehydrate_chat() puts each message back
+# under the id clients already saw.
+ARCHIVE_DIR = os.environ.get("OFFLINE_ARCHIVE_DIR") or os.path.join(app.instance_path, "archive")
+ARCHIVE_IDLE_DAYS = int(os.environ.get("OFFLINE_ARCHIVE_IDLE_DAYS", "90"))
+ARCHIVE_MIN_MESSAGES = int(os.environ.get("OFFLINE_ARCHIVE_MIN_MESSAGES", "1"))
+ARCHIVE_CODEC = os.environ.get("OFFLINE_ARCHIVE_CODEC", "gzip").lower()
+ARCHIVE_REHYDRATE_ON_READ = os.environ.get("OFFLINE_ARCHIVE_REHYDRATE_ON_READ", "0") == "1"
+
+
+def _zstd():
+    try:
+        import zstandard
+    except Exception:  # optional dependency
+        return None
+    return zstandard
+
+
+def _segment_open(path: str, mode: str):
+    if path.endswith(".zst"):
+        zstd = _zstd()
+        if zstd is None:
+            raise RuntimeError("zstandard is required to read/write .zst segments")
+        return zstd.open(path, mode, encoding="utf-8")
+    return gzip.open(path, mode, encoding="utf-8", compresslevel=6)
+
+
+def _segment_rows(rel_path: str):
+    """Yield raw message rows (column dicts) from a segment, in id order."""
+    with _segment_open(os.path.join(ARCHIVE_DIR, rel_path), "rt") as fh:
+        for line in fh:
+            if line.strip():
+                r = json.loads(line)
+                r["created_at"] = _parse_ts(r.get("created_at"))
+                r.update(message_values(r))  # segments written before the split hold full content
+                yield r
+
+
+def archive_chat(chat: "Chat") -> int:
+    """Move one chat's messages to a segment file; returns messages archived (0 = skipped)."""
+    codec_ext = ".zst" if ARCHIVE_CODEC == "zstd" and _zstd() is not None else ".gz"
+    rel = os.path.join(str(chat.user_id or 0), f"{chat.id}.ndjson{codec_ext}")
+    path = os.path.join(ARCHIVE_DIR, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    n, max_id = 0, 0
+    q = Message.query.filter(Message.chat_id == chat.id).order_by(Message.id.asc())
+    with _segment_open(tmp, "wt") as fh:
+        for m in q.yield_per(500):
+            fh.write(json.dumps({
+                "id": m.id, "chat_id": m.chat_id, "user_id": m.user_id, "role": m.role, "text": m.text,
+                "version": m.version, "content_json": m.content_json,
+                "created_at": m.created_at.isoformat() if m.created_at else None,
+            }, default=str) + "\n")
+            n += 1; max_id = m.id
+    if n < max(1, ARCHIVE_MIN_MESSAGES):
+        os.remove(tmp)
+        return 0
+    with open(tmp, "rb") as fh:
+        os.fsync(fh.fileno())
+    os.replace(tmp, path)  # segment is durable before any row is deleted
+
+    chat.archived_at = datetime.utcnow()
+    chat.archive_file = rel
+    chat.archive_count = n
+    db.session.flush()  # archived before the delete, so the triggers keep its preview and count
+    Message.query.filter(Message.chat_id == chat.id, Message.id <= max_id).delete(synchronize_session=False)
+    if Message.query.filter(Message.chat_id == chat.id).first() is not None:
+        # a message arrived while we were writing: leave the chat hot
+        db.session.rollback()
+        os.remove(path)
+        return 0
+    ChatSummary.query.filter(ChatSummary.id == chat.id).delete(synchronize_session=False)
+    db.session.commit()
+    context_cache_invalidate([chat.id])
+    METRICS.inc("archive_chats_total", outcome="archived")
+    METRICS.inc("archive_messages_total", n, direction="out")
+    return n
+
+
+def rehydrate_chat(chat: "Chat") -> int:
+    """Load an archived chat's messages back into the hot table and drop the segment."""
+    if chat.archived_at is None or not chat.archive_file:
+        return 0
+    rows = list(_segment_rows(chat.archive_file))
+    # original ids; only a row whose id was reused before migration 19 gets a fresh one
+    taken = set()
+    for i in range(0, len(rows), 500):
+        taken.update(db.session.execute(select(Message.id).where(
+            Message.id.in_([r["id"] for r in rows[i:i + 500] if r.get("id") is not None]))).scalars())
+    keep = [r for r in rows if r.get("id") is not None and r["id"] not in taken]
+    fresh = [r for r in rows if r.get("id") is None or r["id"] in taken]
+    for batch, with_id in ((keep, True), (fresh, False)):
+        for i in range(0, len(batch), 500):
+            db.session.execute(Message.__table__.insert(), [
+                dict({"id": r["id"]} if with_id else {},
+                     chat_id=chat.id, user_id=r["user_id"], role=r["role"], text=r["text"],
+                     version=r["version"], content_json=r["content_json"], created_at=r["created_at"])
+                for r in batch[i:i + 500]
+            ])
+    rel = chat.archive_file
+    chat.archived_at = None
+    chat.archive_file = None
+    chat.archive_count = None
+    db.session.commit()
+    try:
+        os.remove(os.path.join(ARCHIVE_DIR, rel))
+    except OSError:
+        pass
+    context_cache_invalidate([chat.id])
+    METRICS.inc("archive_chats_total", outcome="rehydrated")
+    METRICS.inc("archive_messages_total", len(rows), direction="in")
+    return len(rows)
+
+
+def archived_messages_select(chat: "Chat", filters: dict, order_col, order_asc: bool, offset: int, limit: int):
+    """table_select() for an archived chat, served straight from its segment."""
+    cols = model_columns(Message)
+    flt = {k: str(v) for k, v in filters.items() if k in cols and k != "chat_id"}
+    simple = (not flt and order_asc and order_col in (None, "id", "created_at"))
+    out = []
+    for i, r in enumerate(_segment_rows(chat.archive_file)):
+        if flt and any(str(r.get(k)) != v for k, v in flt.items()):
+            continue
+        out.append(r)
+        if simple and limit and len(out) >= offset + limit:
+            break  # ascending id order on disk: stop reading early
+    if order_col in cols:
+        out.sort(key=lambda r: (r.get(order_col) is None, r.get(order_col) or 0), reverse=not order_asc)
+    out = out[offset:offset + limit] if limit else out[offset:]
+    return [ser(Message(**r)) for r in out]
+
+
+def archive_idle_chats(idle_days: Optional[int] = None, limit: int = 100, dry_run: bool = False):
+    """Archive up to `limit` chats idle for more than `idle_days` (oldest first within each shard)."""
+    idle_days = ARCHIVE_IDLE_DAYS if idle_days is None else idle_days
+    cutoff = datetime.utcnow() - timedelta(days=idle_days)
+    candidates, archived, moved = [], 0, 0
+    for shard in range(SHARD_COUNT):
+        if len(candidates) >= limit:
+            break
+        with shard_scope(shard):
+            chats = (Chat.query.filter(Chat.archived_at.is_(None), Chat.updated_at < cutoff)
+                     .order_by(Chat.updated_at.asc()).limit(limit - len(candidates)).all())
+            candidates += [c.id for c in chats]
+            for c in ([] if dry_run else chats):
+                n = archive_chat(c)
+                archived += 1 if n else 0
+                moved += n
+    if dry_run:
+        return {"candidates": candidates, "archived": 0, "messages": 0}
+    return {"candidates": len(candidates), "archived": archived, "messages": moved}
+
+
+def archive_stats():
+    hot, cold = [0, 0], [0, 0]
+    for shard in range(SHARD_COUNT):
+        with shard_scope(shard, pin=True):
+            h = db.session.execute(text(
+                "SELECT COUNT(*), COALESCE(SUM(COALESCE(LENGTH(text), 0) + LENGTH(content_json)), 0) "
+                "FROM messages")).one()
+            c = db.session.execute(text(
+                "SELECT COUNT(*), COALESCE(SUM(archive_count), 0) FROM chats WHERE archived_at IS NOT NULL")).one()
+        hot = [hot[0] + h[0], hot[1] + h[1]]
+        cold = [cold[0] + c[0], cold[1] + c[1]]
+    cold_bytes = 0
+    for root, _dirs, files in os.walk(ARCHIVE_DIR):
+        cold_bytes += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return {
+        "hot": {"messages": hot[0], "content_bytes": hot[1]},
+        "cold": {"chats": cold[0], "messages": cold[1], "file_bytes": cold_bytes},
+        "policy": {"idle_days": ARCHIVE_IDLE_DAYS, "min_messages": ARCHIVE_MIN_MESSAGES,
+                   "codec": ARCHIVE_CODEC, "rehydrate_on_read": ARCHIVE_REHYDRATE_ON_READ},
+    }
+
+
+@app.get("/admin/archive")
+def admin_archive_stats():
+    _require_admin()
+    return jsonify(archive_stats())
+
+
+@app.post("/admin/archive/run")
+def admin_archive_run():
+    """Body: {"idle_days": 90, "limit": 100, "dry_run": false}"""
+    _require_admin()
+    data = request.get_json(silent=True) or {}
+    res = archive_idle_chats(
+        idle_days=int(data["idle_days"]) if data.get("idle_days") is not None else None,
+        limit=max(1, min(10_000, int(data.get("limit") or 100))),
+        dry_run=bool(data.get("dry_run")),
+    )
+    return jsonify(res)
+
+
+@app.post("/chats/<int:chat_id>/rehydrate")
+def chat_rehydrate(chat_id):
+    current_user_required()
+    c = db.session.get(Chat, chat_id)
+    if not c or c.user_id != g.user.id:
+        abort(404)
+    return jsonify({"ok": True, "messages": rehydrate_chat(c)})
+
+
+# ---------- Export / import (per-user NDJSON or zip) ----------
+# GET /export streams everything a user owns as NDJSON lines of
+# {"table": ..., "row": ...} (rows in the /db/<table> shape) between a "meta"
+# header and an "end" trailer, or as a zip with one <table>.ndjson member per
+# table plus manifest.json. Rows are read with yield_per and flushed in
+# EXPORT_CHUNK pieces, so memory stays flat however large the account is.
+# POST /import takes either format and inserts IMPORT_BATCH rows per
+# executemany; ids are reassigned and messages follow their chat.
+EXPORT_TABLES = ("chats", "messages", "ocr_bill_extractions", "ocr_bank_extractions", "notifications")
+EXPORT_VERSION = 1
+EXPORT_YIELD = int(os.environ.get("OFFLINE_EXPORT_YIELD", "1000"))
+EXPORT_CHUNK = 64 * 1024
+IMPORT_BATCH = int(os.environ.get("OFFLINE_IMPORT_BATCH", "1000"))
+IMPORT_SPOOL = 8 * 1024 * 1024  # request bodies above this spool to disk
+# last_message / messages_count are rebuilt by the chat aggregate triggers as messages land
+_IMPORT_SKIP = {"id", "user_id", "archived_at", "archive_file", "archive_count", "last_message", "messages_count"}
+
+
+class ImportFormatError(ValueError):
+    """Malformed import file; `line` is 1-based within the stream or zip member."""
+
+    def __init__(self, message: str, line: int = 0):
+        super().__init__(message)
+        self.line = line
+
+
+def export_rows(user_id: int, tables=EXPORT_TABLES):
+    """Yield (table, row) for every row `user_id` owns, in EXPORT_TABLES order."""
+    for table in EXPORT_TABLES:
+        if table not in tables:
+            continue
+        Model = TABLES[table]
+        if Model is Message:
+            q = (Message.query.join(Chat, Chat.id == Message.chat_id)
+                 .filter(Chat.user_id == user_id).order_by(Message.id.asc()))
+        else:
+            q = Model.query.filter(Model.user_id == user_id).order_by(Model.id.asc())
+        for o in q.yield_per(EXPORT_YIELD):
+            yield table, ser(o)
+        if Model is Message:
+            segments = (db.session.query(Chat.archive_file)
+                        .filter(Chat.user_id == user_id, Chat.archived_at.isnot(None))
+                        .order_by(Chat.id.asc()).all())
+            for (rel,) in segments:
+                for r in _segment_rows(rel):
+                    yield table, ser(Message(**r))
+
+
+def _export_meta(user_id: int, tables) -> dict:
+    return {"format": "offline-export", "version": EXPORT_VERSION, "user_id": user_id,
+            "exported_at": datetime.utcnow().isoformat(), "tables": list(tables)}
+
+
+def _export_ndjson(user_id: int, tables):
+    buf, counts = [json.dumps({"meta": _export_meta(user_id, tables)})], {t: 0 for t in tables}
+    size = 0
+    for table, row in export_rows(user_id, tables):
+        line = json.dumps({"table": table, "row": row}, default=str)
+        buf.append(line); size += len(line)
+        counts[table] += 1
+        if size >= EXPORT_CHUNK:
+            yield "\n".join(buf) + "\n"
+            buf, size = [], 0
+    buf.append(json.dumps({"end": {"counts": counts}}))
+    yield "\n".join(buf) + "\n"
+    for t, n in counts.items():
+        METRICS.inc("export_rows_total", n, table=t)
+
+
+class _ZipSink(io.RawIOBase):
+    """Write-only, unseekable target: zipfile falls back to data descriptors."""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buf += b
+        return len(b)
+
+    def drain(self) -> bytes:
+        out = bytes(self.buf)
+        self.buf.clear()
+        return out
+
+
+def _export_zip(user_id: int, tables):
+    sink, counts = _ZipSink(), {t: 0 for t in tables}
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        current, fh = None, None
+        for table, row in export_rows(user_id, tables):
+            if table != current:
+                if fh is not None:
+                    fh.close()
+                fh = zf.open(f"{table}.ndjson", "w", force_zip64=True)
+                current = table
+            fh.write((json.dumps(row, default=str) + "\n").encode())
+            counts[table] += 1
+            if len(sink.buf) >= EXPORT_CHUNK:
+                yield sink.drain()
+        if fh is not None:
+            fh.close()
+        zf.writestr("manifest.json", json.dumps(dict(_export_meta(user_id, tables), counts=counts)))
+    yield sink.drain()
+    for t, n in counts.items():
+        METRICS.inc("export_rows_total", n, table=t)
+
+
+def _import_records(fh):
+    """(table, row) pairs from an uploaded export, zip or NDJSON."""
+    head = fh.read(4)
+    fh.seek(0)
+    if head == b"PK\x03\x04":
+        with zipfile.ZipFile(fh) as zf:
+            names = set(zf.namelist())
+            for table in EXPORT_TABLES:
+                if f"{table}.ndjson" not in names:
+                    continue
+                with zf.open(f"{table}.ndjson") as member:
+                    for n, line in enumerate(member, 1):
+                        if line.strip():
+                            yield table, _import_json(line, n)
+        return
+    for n, line in enumerate(fh, 1):
+        if not line.strip():
+            continue
+        obj = _import_json(line, n)
+        if "meta" in obj:
+            if (obj["meta"] or {}).get("version", EXPORT_VERSION) > EXPORT_VERSION:
+                raise ImportFormatError("unsupported_version", n)
+            continue
+        if "end" in obj:
+            continue
+        if obj.get("table") not in EXPORT_TABLES or not isinstance(obj.get("row"), dict):
+            raise ImportFormatError("bad_record", n)
+        yield obj["table"], obj["row"]
+
+
+def _import_json(line: bytes, n: int) -> dict:
+    try:
+        obj = json.loads(line)
+    except ValueError:
+        raise ImportFormatError("bad_json", n)
+    if not isinstance(obj, dict):
+        raise ImportFormatError("bad_record", n)
+    return obj
+
+
+def _import_clean(Model, row: dict, now: datetime) -> dict:
+    """Exported row -> full column dict for a Core executemany (every key present)."""
+    clean = sanitize_row(Model, row)
+    out = {}
+    for c in Model.__table__.columns:
+        if c.name in _IMPORT_SKIP:
+            continue
+        v = clean.get(c.name)
+        if v is None and c.default is not None:
+            v = c.default.arg if c.default.is_scalar else (now if isinstance(c.type, db.DateTime) else None)
+        elif isinstance(c.type, db.DateTime) and isinstance(v, str):
+            v = _parse_ts(v) or now
+        out[c.name] = v
+    if "approved" in out:
+        out["approved"] = 1 if out["approved"] else 0
+    if Model is Message:
+        out.update(message_values(out))
+    return out
+
+
+def import_records(user_id: int, records) -> dict:
+    """Insert exported rows for `user_id` in IMPORT_BATCH chunks; returns per-table counts."""
+    counts = {t: 0 for t in EXPORT_TABLES}
+    counts["skipped"] = 0
+    chat_map = {}    # exported chat id -> new id
+    owned = None     # existing chat id -> archived?, loaded on first orphan message
+    touched = set()  # existing chats that got messages
+    batch, batch_ids, current = [], [], None
+    now = datetime.utcnow()
+
+    def flush():
+        if not batch:
+            return
+        Model = TABLES[current]
+        if Model is Chat:
+            stmt = insert(Chat.__table__).returning(Chat.__table__.c.id, sort_by_parameter_order=True)
+            new_ids = db.session.execute(stmt, batch).scalars().all()
+            chat_map.update({old: new for old, new in zip(batch_ids, new_ids) if old is not None})
+        else:
+            db.session.execute(insert(Model.__table__), batch)
+        db.session.commit()  # one short write transaction per chunk
+        counts[current] += len(batch)
+        batch.clear(); batch_ids.clear()
+
+    for table, row in records:
+        if table != current or len(batch) >= IMPORT_BATCH:
+            flush()
+            current = table
+        Model = TABLES[table]
+        clean = _import_clean(Model, row, now)
+        if "user_id" in model_columns(Model):
+            clean["user_id"] = user_id
+        if Model is Message:
+            old = row.get("chat_id")
+            chat_id = chat_map.get(old)
+            if chat_id is None:
+                if owned is None:
+                    owned = {cid: arch is not None for cid, arch in db.session.query(Chat.id, Chat.archived_at)
+                             .filter(Chat.user_id == user_id).all()}
+                chat_id = old if isinstance(old, int) and old in owned else None
+                if chat_id is None:
+                    counts["skipped"] += 1
+                    continue
+                if owned[chat_id]:
+                    flush()
+                    rehydrate_chat(db.session.get(Chat, chat_id))
+                    owned[chat_id] = False
+                touched.add(chat_id)
+            clean["chat_id"] = chat_id
+        batch.append(clean)
+        batch_ids.append(row.get("id"))
+    flush()
+    context_cache_invalidate(list(touched))
+    for t in EXPORT_TABLES:
+        METRICS.inc("import_rows_total", counts[t], table=t)
+    return counts
+
+
+@app.get("/export")
+def export_data():
+    """?format=ndjson|zip&tables=chats,messages,... (default: all)"""
+    u = current_user_required()
+    fmt = (request.args.get("format") or "ndjson").lower()
+    if fmt not in ("ndjson", "zip"):
+        return jsonify({"error": "unknown_format"}), 400
+    wanted = [t for t in (request.args.get("tables") or ",".join(EXPORT_TABLES)).split(",") if t]
+    unknown = [t for t in wanted if t not in EXPORT_TABLES]
+    if unknown:
+        return jsonify({"error": "unknown_table", "tables": unknown}), 400
+    tables = [t for t in EXPORT_TABLES if t in wanted]
+    gen = _export_zip(u.id, tables) if fmt == "zip" else _export_ndjson(u.id, tables)
+    resp = Response(stream_with_context(gen), mimetype="application/zip" if fmt == "zip" else "application/x-ndjson")
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    resp.headers["Content-Disposition"] = f'attachment; filename="offline-export-{u.id}-{stamp}.{fmt}"'
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.post("/import")
+def import_data():
+    """Body: an /export file, raw or as multipart `file` (NDJSON or zip)."""
+    u = current_user_required()
+    up = request.files.get("file")
+    if up is not None:
+        fh = up.stream
+    else:
+        fh = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL)
+        while True:
+            chunk = request.stream.read(EXPORT_CHUNK)
+            if not chunk:
+                break
+            fh.write(chunk)
+        fh.seek(0)
+    try:
+        for _ in _import_records(fh):
+            pass  # validate the whole file first: chunks commit as they go
+        fh.seek(0)
+        counts = import_records(u.id, _import_records(fh))
+    except (ImportFormatError, zipfile.BadZipFile) as e:
+        db.session.rollback()
+        return jsonify({"error": "bad_import", "reason": str(e), "line": getattr(e, "line", 0)}), 400
+    finally:
+        fh.close()
+    return jsonify({"ok": True, "imported": counts})
+
+
+# ---------- Delta sync (change log) ----------
+# SQLite triggers append (seq, user, table, row id, op) to change_log for
+# every write to a user-scoped table, in the same transaction as the write, so
+# bulk paths (import, archive, maintenance) are covered too. GET /sync?since=
+# compacts that to the latest state per row: live rows come back as UPSERT with
+# their current /db/<table> shape, rows that no longer exist as DELETE. A
+# client keeps `next` as an opaque cursor; a missing or pruned cursor gets
+# {"reset": true} and must re-list. Entries older than CHANGELOG_RETENTION_DAYS
+# (or beyond CHANGELOG_MAX_ROWS) are pruned by the "changelog" maintenance job.
+CHANGELOG_RETENTION_DAYS = int(os.environ.get("OFFLINE_CHANGELOG_RETENTION_DAYS", "14"))
+CHANGELOG_MAX_ROWS = int(os.environ.get("OFFLINE_CHANGELOG_MAX_ROWS", "2000000"))
+SYNC_PAGE = 500
+
+# table -> SQL for the owning user id, given the trigger row alias
+SYNC_TABLES = {
+    "chats": "{r}.user_id",
+    "messages": "COALESCE({r}.user_id, (SELECT user_id FROM chats WHERE id = {r}.chat_id))",
+    "notifications": "{r}.user_id",
+    "ocr_bill_extractions": "{r}.user_id",
+    "ocr_bank_extractions": "{r}.user_id",
+    "user_credits": "{r}.id",
+    "profiles": "{r}.id",
+}
+
+
+def _changelog_triggers():
+    out = []
+    for table, owner in SYNC_TABLES.items():
+        for event_, r, op in (("INSERT", "new", "I"), ("UPDATE", "new", "U"), ("DELETE", "old", "D")):
+            out.append(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_chg_{op.lower()} AFTER {event_} ON {table} "
+                f"WHEN {owner.format(r=r)} IS NOT NULL BEGIN "
+                f"INSERT INTO change_log(user_id, tbl, row_id, op) "
+                f"VALUES ({owner.format(r=r)}, '{table}', {r}.id, '{op}'); END"
+            )
+    return out
+
+
+CHANGELOG_DDL = [
+    "CREATE TABLE IF NOT EXISTS change_log ("
+    "seq INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, tbl TEXT NOT NULL, "
+    "row_id INTEGER NOT NULL, op TEXT NOT NULL, at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)",
+    "CREATE INDEX IF NOT EXISTS ix_change_log_user_seq ON change_log (user_id, seq)",
+    # seq below which entries may have been pruned
+    "CREATE TABLE IF NOT EXISTS change_log_horizon (id INTEGER PRIMARY KEY CHECK (id = 1), seq INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO change_log_horizon (id, seq) VALUES (1, 0)",
+] + _changelog_triggers()
+
+
+# a sharded user's own rows log to their shard's change_log; these stay in the main one
+CENTRAL_SYNC_TABLES = tuple(t for t in SYNC_TABLES if t not in SHARDED_TABLES)
+
+
+def changelog_head(bind=None) -> int:
+    # sqlite_sequence keeps the high-water mark even after pruning empties the table
+    return db.session.execute(text(
+        "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'change_log'), 0)"),
+        bind_arguments={"bind": bind} if bind is not None else None).scalar()
+
+
+def _changelog_page(bind, user_id: int, since: int, limit: int, tables=None):
+    """(refs, has_more, next) from one DB file's change_log, or None if `since` was pruned."""
+    horizon = db.session.execute(text("SELECT seq FROM change_log_horizon WHERE id = 1"),
+                                 bind_arguments={"bind": bind}).scalar() or 0
+    if since < horizon:
+        return None
+    # head first, and refs bounded by it: each SELECT is its own read (pysqlite
+    # sends no BEGIN), so a row committed between the two would otherwise sit
+    # below the returned cursor without ever being delivered
+    head = changelog_head(bind)
+    only = f" AND tbl IN ({', '.join(repr(t) for t in tables)})" if tables else ""
+    refs = db.session.execute(text(
+        f"SELECT tbl, row_id, MAX(seq) AS seq FROM change_log "
+        f"WHERE user_id = :uid AND seq > :since AND seq <= :head{only} "
+        "GROUP BY tbl, row_id ORDER BY seq LIMIT :limit"
+    ), {"uid": user_id, "since": since, "head": head, "limit": limit + 1}, bind_arguments={"bind": bind}).all()
+    has_more = len(refs) > limit
+    refs = refs[:limit]
+    return refs, has_more, refs[-1][2] if has_more else max(since, head)
+
+
+def parse_sync_cursor(raw):
+    """
+    Cursor -> (shard, seq, central seq), or None if malformed. Users on the main
+    DB get a plain seq; sharded users get "<shard>.<shard seq>.<main seq>".
+    """
+    raw = str(raw).strip()
+    if raw.isdigit():
+        return 0, int(raw), int(raw)
+    parts = raw.split(".")
+    if len(parts) == 3 and all(p.isdigit() for p in parts):
+        return tuple(int(p) for p in parts)
+    return None
+
+
+def _sync_cursor(shard: int, seqs):
+    return seqs[0] if shard == 0 else f"{shard}.{seqs[0]}.{seqs[1]}"
+
+
+def sync_changes(user_id: int, since, limit: int = SYNC_PAGE) -> dict:
+    """Compacted changes for `user_id` after cursor `since`, oldest first, at most `limit` rows per log."""
+    shard = db.session.get(User, user_id).shard or 0
+    logs = [(shard_engine(shard), None)]
+    if shard != 0:
+        logs.append((db.engine, CENTRAL_SYNC_TABLES))
+    cur = parse_sync_cursor(since) if since not in (None, "") else None
+    pages = None
+    if cur is not None and cur[0] == shard:  # a cursor from before a move is useless
+        pages = [_changelog_page(bind, user_id, seq, limit, tables)
+                 for (bind, tables), seq in zip(logs, cur[1:])]
+    if pages is None or None in pages:
+        METRICS.inc("sync_requests_total", outcome="reset")
+        return {"reset": True, "changes": [], "has_more": False,
+                "next": _sync_cursor(shard, [changelog_head(bind) for bind, _ in logs])}
+    refs = [r for p in pages for r in p[0]]
+
+    live = {}
+    by_table = {}
+    for tbl, row_id, _seq in refs:
+        by_table.setdefault(tbl, []).append(row_id)
+    with shard_scope(shard):
+        for tbl, ids in by_table.items():
+            Model = TABLES[tbl]
+            q = Model.query.filter(Model.id.in_(ids))
+            if "user_id" in model_columns(Model):
+                q = q.filter(Model.user_id == user_id)
+            live.update({(tbl, o.id): ser(o) for o in q.all()})
+
+    changes = []
+    for tbl, row_id, seq in refs:
+        row = live.get((tbl, row_id))
+        changes.append({"seq": seq, "table": tbl, "id": row_id,
+                        "op": "UPSERT" if row is not None else "DELETE", "row": row})
+    METRICS.inc("sync_requests_total", outcome="delta")
+    return {"reset": False, "changes": changes, "next": _sync_cursor(shard, [p[2] for p in pages]),
+            "has_more": any(p[1] for p in pages)}
+
+
+def changelog_prune() -> int:
+    """Drop entries past retention and advance the horizon; chunked like other jobs."""
+    cutoff_at = (datetime.utcnow() - timedelta(days=CHANGELOG_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    by_age = db.session.execute(
+        text("SELECT seq FROM change_log WHERE at >= :at ORDER BY seq LIMIT 1"), {"at": cutoff_at}
+    ).scalar()
+    head = changelog_head()
+    cutoff = (by_age - 1) if by_age is not None else head
+    cutoff = max(cutoff, head - CHANGELOG_MAX_ROWS)
+    db.session.commit()
+    if cutoff <= 0:
+        return 0
+    db.session.execute(text("UPDATE change_log_horizon SET seq = MAX(seq, :s) WHERE id = 1"), {"s": cutoff})
+    db.session.commit()  # horizon first: a reader never sees a gap it can't detect
+    return _chunked_delete("SELECT seq FROM change_log WHERE seq <= :cutoff LIMIT :n", "change_log",
+                           {"cutoff": cutoff})
+
+
+@app.get("/sync")
+def sync():
+    """?since=<cursor>&limit=500 -> {"changes": [...], "next": cursor, "has_more", "reset"}"""
+    u = current_user_required()
+    since = request.args.get("since")
+    try:
+        if since not in (None, "") and parse_sync_cursor(since) is None:
+            raise ValueError(since)
+        limit = max(1, min(5000, int(request.args.get("limit", SYNC_PAGE))))
+    except ValueError:
+        return jsonify({"error": "bad_cursor"}), 400
+    return jsonify(sync_changes(u.id, since, limit))
+
+
+@socketio.on("resume")
+def ws_resume(data=None):
+    """Client -> {"token": bearer, "since": seq}; replies with a "sync" event (same body as /sync)."""
+    data = data if isinstance(data, dict) else {}
+    u = user_for_token(str(data.get("token") or ""))
+    if u is None:
+        emit("sync", {"error": "unauthorized"})
+        return
+    since = str(data.get("since", ""))
+    emit("sync", sync_changes(u.id, since if parse_sync_cursor(since) else None))
+
+
+# ---------- Shard rebalancing ----------
+# move_user() copies a user's sharded rows through the export/import path
+# (fresh ids on the target, archived chats come back hot), repoints
+# users.shard, then drops the old copies. While it runs, users.shard_moving
+# is set and that user's new writes get 503 + Retry-After (a write already in
+# flight when the move starts can miss the copy: rebalance in a quiet window).
+# Chat summaries are not copied; they rebuild on the next turn. Clients see a sync
+# reset afterwards (their cursor names the old shard) and re-list. Anything a
+# crash leaves behind is owned by a user placed elsewhere, which the
+# "orphans" maintenance job removes.
+#   python app.py rebalance [count]   move users to user_id % count (default OFFLINE_SHARDS)
+# To grow, raise OFFLINE_SHARDS, restart, then rebalance. To shrink, rebalance
+# to the smaller count first, then lower OFFLINE_SHARDS.
+def _drop_user_rows(user_id: int):
+    """Delete every sharded row `user_id` owns in the current shard."""
+    chat_ids = select(Chat.id).where(Chat.user_id == user_id)
+    Message.query.filter(Message.chat_id.in_(chat_ids)).delete(synchronize_session=False)
+    ChatSummary.query.filter(ChatSummary.id.in_(chat_ids)).delete(synchronize_session=False)
+    for Model in (Chat, Notification, OCRBillExtract, OCRBankExtract):
+        Model.query.filter(Model.user_id == user_id).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def move_user(user_id: int, target: int) -> dict:
+    """Move one user's sharded rows to shard `target`; returns the imported counts."""
+    u = db.session.get(User, user_id)
+    source = (u.shard or 0) if u is not None else target
+    if source == target:
+        return {"user_id": user_id, "moved": False}
+    shard_engine(target)  # fail before touching anything if it isn't configured
+    u.shard_moving = target
+    db.session.commit()
+    try:
+        with tempfile.TemporaryFile() as fh:
+            with shard_scope(source):
+                segments = [rel for (rel,) in db.session.query(Chat.archive_file)
+                            .filter(Chat.user_id == user_id, Chat.archive_file.isnot(None))]
+                for table, row in export_rows(user_id):
+                    fh.write((json.dumps({"table": table, "row": row}, default=str) + "\n").encode())
+            fh.seek(0)
+            with shard_scope(target):
+                _drop_user_rows(user_id)  # leftovers of an earlier, interrupted move
+                counts = import_records(user_id, _import_records(fh))
+    except Exception:
+        db.session.rollback()
+        u.shard_moving = None
+        db.session.commit()
+        raise
+    u.shard, u.shard_moving = target, None
+    db.session.commit()
+    with shard_scope(source):
+        _drop_user_rows(user_id)
+    for rel in segments:
+        try:
+            os.remove(os.path.join(ARCHIVE_DIR, rel))
+        except OSError:
+            pass
+    context_cache_invalidate()
+    METRICS.inc("shard_moves_total")
+    return {"user_id": user_id, "moved": True, "from": source, "to": target, "rows": counts}
+
+
+def rebalance(count: Optional[int] = None, limit: Optional[int] = None, dry_run: bool = False) -> dict:
+    """Move users whose shard isn't user_id % count (default SHARD_COUNT)."""
+    count = count or SHARD_COUNT
+    if not 1 <= count <= SHARD_COUNT:
+        raise ValueError(f"count must be 1..{SHARD_COUNT} (the shards configured now)")
+    q = (db.session.query(User.id).filter(User.shard != User.id % count, User.shard_moving.is_(None))
+         .order_by(User.id))
+    ids = [uid for (uid,) in (q.limit(limit) if limit else q)]
+    if dry_run:
+        return {"count": count, "planned": len(ids), "moved": 0}
+    moved = [move_user(uid, uid % count) for uid in ids]
+    return {"count": count, "planned": len(ids), "moved": sum(1 for m in moved if m["moved"])}
+
+
+def shard_stats() -> dict:
+    placed = dict(db.session.query(User.shard, db.func.count(User.id)).group_by(User.shard).all())
+    moving = db.session.query(db.func.count(User.id)).filter(User.shard_moving.isnot(None)).scalar()
+    shards = []
+    for n in range(SHARD_COUNT):
+        path = shard_engine(n).url.database
+        shards.append({"shard": n, "users": placed.get(n, 0), "file": path,
+                       "bytes": os.path.getsize(path) if path and os.path.exists(path) else None})
+    return {"count": SHARD_COUNT, "moving": moving, "shards": shards,
+            "misplaced": sum(v for k, v in placed.items() if k >= SHARD_COUNT)}
+
+
+@app.get("/admin/shards")
+def admin_shards():
+    _require_admin()
+    return jsonify(shard_stats())
+
+
+# ---------- Background maintenance ----------
+# One worker (whoever holds the flock on MAINT_LOCK) runs these on a timer.
+# Heavy jobs wait for a quiet window: fewer than MAINT_QUIET_RPM requests in
+# the last tick, or inside OFFLINE_MAINT_HOURS (UTC, e.g. "2-5"). Every job
+# works in small chunks with a pause between them and stops at its time budget.
+# With several workers the owner sees only its own share of traffic, so each
+# worker appends its request count to MAINT_TRAFFIC at most once a second and
+# the owner counts the whole server from that file.
+MAINT_ENABLED = os.environ.get("OFFLINE_MAINTENANCE", "1") != "0"
+MAINT_TICK = float(os.environ.get("OFFLINE_MAINT_TICK", "60"))
+MAINT_QUIET_RPM = int(os.environ.get("OFFLINE_MAINT_QUIET_RPM", "30"))
+MAINT_HOURS = os.environ.get("OFFLINE_MAINT_HOURS", "")
+MAINT_CHUNK = int(os.environ.get("OFFLINE_MAINT_CHUNK", "500"))
+MAINT_PAUSE = float(os.environ.get("OFFLINE_MAINT_PAUSE", "0.05"))
+MAINT_BUDGET = float(os.environ.get("OFFLINE_MAINT_BUDGET", "10"))
+MAINT_LOCK = os.environ.get("OFFLINE_MAINT_LOCK") or os.path.join(app.instance_path, "maintenance.lock")
+MAINT_TRAFFIC = MAINT_LOCK + ".traffic"
+_traffic = {"flushed": 0, "at": 0.0}
+
+
+def traffic_flush(force: bool = False):
+    """Append this worker's requests since the last flush to MAINT_TRAFFIC."""
+    now = time.monotonic()
+    if not force and now - _traffic["at"] < 1.0:
+        return
+    seen = REQUESTS_SEEN
+    delta, _traffic["flushed"], _traffic["at"] = seen - _traffic["flushed"], seen, now
+    if delta:
+        with contextlib.suppress(OSError), open(MAINT_TRAFFIC, "a") as fh:
+            fh.write(f"{delta}\n")  # one short O_APPEND write: lines never interleave
+
+
+def traffic_take() -> int:
+    """Requests every worker reported since the last call (the file is swapped out, then read)."""
+    taken = MAINT_TRAFFIC + ".tick"
+    try:
+        os.replace(MAINT_TRAFFIC, taken)
+    except OSError:
+        return 0  # nothing reported
+    with open(taken) as fh:
+        return sum(int(x) for x in fh.read().split() if x.isdigit())
+
+
+def _chunked_delete(select_ids_sql: str, table: str, params: Optional[dict] = None, budget: float = MAINT_BUDGET):
+    """DELETE rows picked by `select_ids_sql` (must end with LIMIT :n) chunk by chunk."""
+    deadline = time.monotonic() + budget
+    total = 0
+    while time.monotonic() < deadline:
+        res = db.session.execute(
+            text(f"DELETE FROM {table} WHERE rowid IN ({select_ids_sql})"),
+            dict(params or {}, n=MAINT_CHUNK),
+        )
+        db.session.commit()
+        total += res.rowcount or 0
+        if (res.rowcount or 0) < MAINT_CHUNK:
+            break
+        time.sleep(MAINT_PAUSE)
+    return total
+
+
+def per_shard(fn):
+    """Maintenance job run once against each DB file (pinned shard_scope); row counts are summed."""
+    @functools.wraps(fn)
+    def run():
+        return for_each_shard(fn)
+    return run
+
+
+def _owners_not_here(tables) -> list:
+    """user_ids owning rows in this shard that are deleted or placed on another shard."""
+    shard = current_shard()
+    owners = set()
+    for t in tables:
+        owners.update(r[0] for r in db.session.execute(
+            text(f"SELECT DISTINCT user_id FROM {t} WHERE user_id IS NOT NULL")))
+    owners = sorted(owners)
+    kept = set()
+    for i in range(0, len(owners), 500):
+        kept.update(uid for uid, placed, moving in db.session.execute(  # users live in the main DB
+            select(User.id, User.shard, User.shard_moving).where(User.id.in_(owners[i:i + 500])),
+            bind_arguments={"bind": db.engine}) if shard in (placed, moving))
+    return [uid for uid in owners if uid not in kept]
+
+
+@per_shard
+def job_orphans():
+    """Messages/summaries of deleted chats, rows of deleted users (or users moved off this shard)."""
+    n = _chunked_delete(
+        "SELECT m.id FROM messages m LEFT JOIN chats c ON c.id = m.chat_id WHERE c.id IS NULL LIMIT :n",
+        "messages")
+    n += _chunked_delete(
+        "SELECT s.id FROM chat_summaries s LEFT JOIN chats c ON c.id = s.id WHERE c.id IS NULL LIMIT :n",
+        "chat_summaries")
+    tables = ("chats", "notifications", "ocr_bill_extractions", "ocr_bank_extractions")
+    gone = _owners_not_here(tables)
+    for i in range(0, len(gone), 500):
+        ids = ", ".join(str(int(uid)) for uid in gone[i:i + 500])
+        for t in tables:
+            n += _chunked_delete(f"SELECT rowid FROM {t} WHERE user_id IN ({ids}) LIMIT :n", t)
+    return n
+
+
+def job_sessions():
+    """Sessions older than SESSION_TTL_DAYS or belonging to deleted users."""
+    cutoff = datetime.utcnow() - timedelta(days=SESSION_TTL_DAYS)
+    return _chunked_delete(
+        "SELECT s.rowid FROM sessions s LEFT JOIN users u ON u.id = s.user_id "
+        "WHERE s.created_at < :cutoff OR u.id IS NULL LIMIT :n", "sessions", {"cutoff": cutoff})
+
+
+@per_shard
+def job_optimize():
+    """Refresh planner statistics (bounded ANALYZE via PRAGMA optimize)."""
+    db.session.execute(text("PRAGMA analysis_limit=1000"))
+    db.session.execute(text("PRAGMA optimize"))
+    db.session.commit()
+    return 0
+
+
+@per_shard
+def job_vacuum():
+    """Return free pages to the OS a few hundred at a time."""
+    mode = db.session.execute(text("PRAGMA auto_vacuum")).scalar()
+    if mode != 2:
+        db.session.commit()
+        return None  # not in incremental mode (see migration 10)
+    deadline = time.monotonic() + MAINT_BUDGET
+    freed = 0
+    while time.monotonic() < deadline:
+        free = db.session.execute(text("PRAGMA freelist_count")).scalar()
+        if not free:
+            break
+        db.session.commit()
+        # the sqlite3 driver steps a pragma once (one page); executescript runs it to completion
+        raw = db.session.connection().connection.dbapi_connection
+        raw.executescript(f"PRAGMA incremental_vacuum({int(min(free, MAINT_CHUNK))});")
+        db.session.commit()
+        freed += free - (db.session.execute(text("PRAGMA freelist_count")).scalar() or 0)
+        time.sleep(MAINT_PAUSE)
+    db.session.commit()
+    return freed
+
+
+@per_shard
+def job_checkpoint():
+    """Fold the WAL back into the main file; TRUNCATE only when quiet."""
+    mode = "TRUNCATE" if _maintenance.quiet else "PASSIVE"
+    busy, log, ckpt = db.session.execute(text(f"PRAGMA wal_checkpoint({mode})")).one()
+    db.session.commit()
+    return ckpt if ckpt is not None and ckpt >= 0 else 0
+
+
+@per_shard
+def job_changelog():
+    return changelog_prune()
+
+
+def job_uploads():
+    """Upload sessions (finished or not) idle for UPLOAD_TTL_HOURS, and their files."""
+    cutoff = datetime.utcnow() - timedelta(hours=UPLOAD_TTL_HOURS)
+    total = 0
+    while True:
+        ids = [r[0] for r in db.session.execute(
+            text("SELECT id FROM uploads WHERE updated_at < :cutoff LIMIT :n"),
+            {"cutoff": cutoff, "n": MAINT_CHUNK})]
+        for upload_id in ids:
+            try:
+                os.remove(_upload_path(upload_id))
+            except OSError:
+                pass
+        if ids:
+            Upload.query.filter(Upload.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        total += len(ids)
+        if len(ids) < MAINT_CHUNK:
+            return total
+        time.sleep(MAINT_PAUSE)
+
+
+def job_idempotency():
+    """Idempotency keys past IDEM_TTL_HOURS, then the oldest beyond IDEM_MAX_KEYS."""
+    cutoff = datetime.utcnow() - timedelta(hours=IDEM_TTL_HOURS)
+    n = _chunked_delete("SELECT rowid FROM idempotency_keys WHERE created_at < :cutoff LIMIT :n",
+                        "idempotency_keys", {"cutoff": cutoff})
+    over = (db.session.execute(text("SELECT COUNT(*) FROM idempotency_keys")).scalar() or 0) - IDEM_MAX_KEYS
+    db.session.commit()
+    if over > 0:
+        oldest_kept = db.session.execute(text(
+            "SELECT created_at FROM idempotency_keys ORDER BY created_at LIMIT 1 OFFSET :over"),
+            {"over": over}).scalar()
+        n += _chunked_delete("SELECT rowid FROM idempotency_keys WHERE created_at < :cutoff LIMIT :n",
+                             "idempotency_keys", {"cutoff": oldest_kept})
+    return n
+
+
+def job_blobs():
+    """Blobs stored more than BLOB_GRACE_HOURS ago that no OCR row or avatar points at."""
+    refs = set()
+
+    def scan():
+        for t in ("ocr_bill_extractions", "ocr_bank_extractions"):
+            for (url,) in db.session.execute(text(f"SELECT file_url FROM {t} WHERE file_url LIKE '%/blobs/%'")):
+                refs.update(BLOB_REF_RE.findall(url))
+        db.session.commit()
+
+    for_each_shard(scan)
+    for (url,) in db.session.execute(text("SELECT avatar_url FROM profiles WHERE avatar_url LIKE '%/blobs/%'")):
+        refs.update(BLOB_REF_RE.findall(url))
+    cutoff = datetime.utcnow() - timedelta(hours=BLOB_GRACE_HOURS)
+    stale = [sha for (sha,) in db.session.execute(
+        text("SELECT sha256 FROM blobs WHERE stored_at < :cutoff"), {"cutoff": cutoff}) if sha not in refs]
+    db.session.commit()
+    deadline = time.monotonic() + MAINT_BUDGET
+    total = 0
+    for i in range(0, len(stale), MAINT_CHUNK):
+        chunk = stale[i:i + MAINT_CHUNK]
+        Blob.query.filter(Blob.sha256.in_(chunk), Blob.stored_at < cutoff).delete(synchronize_session=False)
+        kept = {sha for (sha,) in db.session.execute(select(Blob.sha256).where(Blob.sha256.in_(chunk)))}
+        BlobOwner.query.filter(BlobOwner.sha256.in_(set(chunk) - kept)).delete(synchronize_session=False)
+        db.session.commit()
+        for sha in chunk:
+            if sha not in kept:  # re-put since we looked; blob_put would have refreshed stored_at
+                with contextlib.suppress(OSError):
+                    os.remove(_blob_path(sha))
+                total += 1
+        if time.monotonic() > deadline:
+            break
+        time.sleep(MAINT_PAUSE)
+    return total
+
+
+def job_usage():
+    return usage_fold() + usage_prune()
+
+
+def job_archive():
+    return archive_idle_chats(limit=100)["messages"]
+
+
+# name -> (fn, interval seconds, needs quiet window)
+MAINT_JOBS = {
+    "checkpoint": (job_checkpoint, 600, False),
+    "sessions": (job_sessions, 3600, True),
+    "orphans": (job_orphans, 6 * 3600, True),
+    "optimize": (job_optimize, 24 * 3600, True),
+    "vacuum": (job_vacuum, 24 * 3600, True),
+    "archive": (job_archive, 24 * 3600, True),
+    "changelog": (job_changelog, 3600, False),
+    "uploads": (job_uploads, 3600, False),
+    "idempotency": (job_idempotency, 600, False),
+    "blobs": (job_blobs, 24 * 3600, True),
+    "usage": (job_usage, 300, False),
+}
+
+
+class _Maintenance:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reports = {}  # job -> last report
+        self.next_due = {}
+        self.quiet = False
+        self.owner = False
+        self.started = False
+        self.last_seen = 0
+
+    def in_quiet_hours(self) -> bool:
+        if not MAINT_HOURS:
+            return False
+        try:
+            lo, hi = (int(x) for x in MAINT_HOURS.split("-"))
+        except ValueError:
+            return False
+        h = datetime.utcnow().hour
+        return lo <= h < hi if lo <= hi else (h >= lo or h < hi)
+
+    def run(self, name: str):
+        fn = MAINT_JOBS[name][0]
+        t0 = time.perf_counter()
+        report = {"job": name, "started_at": datetime.utcnow().isoformat(), "status": "ok", "rows": 0}
+        try:
+            with app.app_context():
+                rows = fn()
+            if rows is None:
+                report["status"] = "skipped"
+            else:
+                report["rows"] = rows
+        except Exception as e:  # a failing job must not kill the scheduler
+            report["status"] = "error"
+            report["error"] = f"{type(e).__name__}: {e}"
+        report["duration_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        with self.lock:
+            self.reports[name] = report
+        METRICS.inc("maintenance_runs_total", job=name, status=report["status"])
+        METRICS.inc("maintenance_rows_total", report["rows"], job=name)
+        return report
+
+    def tick(self):
+        if SERVE_WORKERS > 1:
+            traffic_flush(force=True)
+            rpm = traffic_take() * 60.0 / MAINT_TICK
+        else:
+            seen = REQUESTS_SEEN
+            rpm = (seen - self.last_seen) * 60.0 / MAINT_TICK
+            self.last_seen = seen
+        self.quiet = rpm < MAINT_QUIET_RPM or self.in_quiet_hours()
+        now = time.monotonic()
+        for name, (_fn, interval, needs_quiet) in MAINT_JOBS.items():
+            if now < self.next_due.get(name, 0):
+                continue
+            if needs_quiet and not self.quiet:
+                continue
+            self.run(name)
+            self.next_due[name] = time.monotonic() + interval
+
+    def loop(self):
+        while True:
+            socketio.sleep(MAINT_TICK)
+            self.tick()
+
+
+_maintenance = _Maintenance()
+
+
+def start_maintenance_scheduler():
+    """Start the scheduler in this process if no other worker already owns it."""
+    if not MAINT_ENABLED or _maintenance.started:
+        return False
+    os.makedirs(os.path.dirname(MAINT_LOCK), exist_ok=True)
+    fh = open(MAINT_LOCK, "a")
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fh.close()
+        return False
+    _maintenance.lock_fh = fh  # held for the life of the process
+    _maintenance.owner = _maintenance.started = True
+    # spread first runs over the first few ticks instead of all at once
+    for i, name in enumerate(MAINT_JOBS):
+        _maintenance.next_due[name] = time.monotonic() + MAINT_TICK * i
+    socketio.start_background_task(_maintenance.loop)
+    return True
+
+
+@app.get("/admin/maintenance")
+def admin_maintenance():
+    _require_admin()
+    with _maintenance.lock:
+        reports = dict(_maintenance.reports)
+    now = time.monotonic()
+    return jsonify({
+        "enabled": MAINT_ENABLED, "scheduler_here": _maintenance.owner, "quiet": _maintenance.quiet,
+        "jobs": {
+            name: {"interval_s": interval, "needs_quiet": needs_quiet,
+                   "next_in_s": round(max(0.0, _maintenance.next_due.get(name, now) - now), 1)
+                   if _maintenance.owner else None,
+                   "last": reports.get(name)}
+            for name, (_fn, interval, needs_quiet) in MAINT_JOBS.items()
+        },
+    })
+
+
+@app.post("/admin/maintenance/run")
+def admin_maintenance_run():
+    """Run one job now. Body: {"job": "orphans"}"""
+    _require_admin()
+    name = (request.get_json(silent=True) or {}).get("job")
+    if name not in MAINT_JOBS:
+        return jsonify({"error": "unknown_job", "jobs": list(MAINT_JOBS)}), 400
+    return jsonify(_maintenance.run(name))
+
+
 # ---------- Billing / Sales ----------
 @app.post("/billing/upgrade-request")
 def billing_upgrade_request():
@@ -1250,12 +5471,38 @@ def billing_upgrade_request():
 # ---------- WebSocket ----------
 @socketio.on("connect")
 def ws_connect():
+    METRICS.inc("socket_connections_total")
+    METRICS.gauge_add("socket_connected", 1)
     emit("connected", {"ok": True})
 
 
+@socketio.on("disconnect")
+def ws_disconnect(*_args):
+    METRICS.gauge_add("socket_connected", -1)
+
+
 # ---------- Main ----------
+# python app.py              migrate, then run the dev server
+# python app.py migrate      apply pending schema migrations and exit
+# python app.py seed-demo    migrate + create the demo accounts and exit
+# (OFFLINE_SEED_DEMO=1 also seeds the demo accounts before serving)
+# python app.py archive      move chats idle > OFFLINE_ARCHIVE_IDLE_DAYS to cold storage
+# python app.py rebalance [count]   move users to shard user_id % count (see move_user)
 if __name__ == "__main__":
+    import sys
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "serve"
     with app.app_context():
-        seed()
-    print(f"Starting SocketIO server on http://localhost:{PORT} ...")
-    socketio.run(app, host="0.0.0.0", port=PORT, debug=True, use_reloader=False)
+        n = migrate()
+        if n:
+            print(f"Applied {n} migration(s)")
+        if cmd == "seed-demo" or os.environ.get("OFFLINE_SEED_DEMO") == "1":
+            seed_demo()
+            print("Demo accounts ready")
+        if cmd == "archive":
+            print(archive_idle_chats(limit=10_000))
+        if cmd == "rebalance":
+            print(rebalance(int(sys.argv[2]) if len(sys.argv) > 2 else None))
+    if cmd == "serve":
+        start_maintenance_scheduler()
+        print(f"Starting SocketIO server on http://localhost:{PORT} ...")
+        socketio.run(app, host="0.0.0.0", port=PORT, debug=True, use_reloader=False)
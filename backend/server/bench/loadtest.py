@@ -0,0 +1,368 @@
+# backend/server/bench/loadtest.py
+"""
+Self-contained load generator for the offline backend.
+
+Boots app.py in-process on a throwaway SQLite file, seeds N users with M
+messages each, then drives a weighted mix of API calls from asyncio virtual
+users (one keep-alive connection each) plus a few Socket.IO subscribers.
+Prints throughput and p50/p95/p99 per endpoint and can compare the run
+against a committed baseline.
+
+    python bench/loadtest.py                         # default run, print table
+    python bench/loadtest.py --compare bench/baseline.json --threshold 0.25
+    python bench/loadtest.py --write-baseline bench/baseline.json
+
+Exit status is 1 when --compare finds a regression beyond the threshold.
+Baselines are machine-specific: regenerate them on the box that runs the check.
+"""
+import argparse, asyncio, json, os, random, statistics, sys, tempfile, threading, time
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# endpoint -> weight in the request mix
+DEFAULT_MIX = {
+    "login": 2,
+    "chat_turn": 10,
+    "list_chats": 15,
+    "list_messages": 25,
+    "notifications_poll": 30,
+    "ocr_upload": 5,
+}
+
+
+# ---------- server ----------
+def boot_server(db_path: str):
+    os.environ["OFFLINE_DB_URL"] = f"sqlite:///{db_path}"
+    os.environ.setdefault("OFFLINE_ADMISSION", "0")  # measure the handlers, not the limiter
+    sys.path.insert(0, os.path.dirname(HERE))
+    import app as A
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class Handler(WSGIRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def log_request(self, *a, **k):
+            pass
+
+    with A.app.app_context():
+        A.migrate()
+    srv = make_server("127.0.0.1", 0, A.app, threaded=True, request_handler=Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return A, srv
+
+
+def seed_load(A, users: int, messages: int, chats_per_user: int = 2):
+    """Bulk-insert users/chats/messages directly (one shared password hash)."""
+    from werkzeug.security import generate_password_hash
+    pw_hash = generate_password_hash("bench123")
+    creds = []
+    with A.app.app_context():
+        s = A.db.session
+        for i in range(users):
+            email = f"bench{i}@example.com"
+            u = A.User(email=email, name=f"Bench {i}", password_hash=pw_hash)
+            s.add(u); s.flush()
+            u.shard = A.place_user(u.id)
+            s.add(A.Profile(id=u.id, full_name=u.name))
+            s.add(A.UserCredit(id=u.id, plan="business", last_reset_at=A.now_ym()))
+            chat_ids = []
+            with A.shard_scope(u.shard):
+                for j in range(chats_per_user):
+                    c = A.Chat(user_id=u.id, title=f"Bench chat {j}", messages_count=0)
+                    s.add(c); s.flush(); chat_ids.append(c.id)
+                rows = []
+                for k in range(messages):
+                    role = "user" if k % 2 == 0 else "assistant"
+                    rows.append({"chat_id": chat_ids[k % len(chat_ids)], "user_id": u.id, "role": role,
+                                 "text": f"bench message {k} " * 8, "version": "V2", "content_json": {"meta": {}}})
+                if rows:
+                    s.execute(A.Message.__table__.insert(), rows)
+            creds.append({"email": email, "password": "bench123", "chat_ids": chat_ids})
+        s.commit()
+    return creds
+
+
+# ---------- minimal asyncio HTTP/1.1 client ----------
+class Conn:
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def _open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+        self.reader = self.writer = None
+
+    async def request(self, method, path, headers=None, body=b""):
+        for attempt in (0, 1):
+            if self.writer is None:
+                await self._open()
+            try:
+                return await self._roundtrip(method, path, headers or {}, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                await self.close()
+                if attempt:
+                    raise
+
+    async def _roundtrip(self, method, path, headers, body):
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                f"Content-Length: {len(body)}"]
+        head += [f"{k}: {v}" for k, v in headers.items()]
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("closed")
+        status = int(status_line.split()[1])
+        resp_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = line.decode("latin-1").partition(":")
+            resp_headers[k.strip().lower()] = v.strip()
+        if "content-length" in resp_headers:
+            data = await self.reader.readexactly(int(resp_headers["content-length"]))
+        else:
+            data = await self.reader.read()
+            await self.close()
+        if resp_headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status, resp_headers, data
+
+
+def _multipart(field, filename, payload, ctype="image/png"):
+    boundary = "benchboundary" + str(random.randrange(1 << 30))
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; "
+            f"filename=\"{filename}\"\r\nContent-Type: {ctype}\r\n\r\n").encode()
+    body += payload + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+# ---------- virtual user ----------
+class VirtualUser:
+    def __init__(self, cred, host, port, record):
+        self.cred = cred
+        self.conn = Conn(host, port)
+        self.record = record
+        self.token = None
+
+    def _auth(self, extra=None):
+        h = {"Authorization": f"Bearer {self.token}"}
+        h.update(extra or {})
+        return h
+
+    async def call(self, name, method, path, headers=None, body=b""):
+        t0 = time.perf_counter()
+        status, _, data = await self.conn.request(method, path, headers, body)
+        self.record(name, time.perf_counter() - t0, status)
+        return status, data
+
+    async def login(self):
+        body = json.dumps({"email": self.cred["email"], "password": self.cred["password"]}).encode()
+        status, data = await self.call("login", "POST", "/auth/login",
+                                       {"Content-Type": "application/json"}, body)
+        if status == 200:
+            self.token = json.loads(data)["token"]
+
+    async def chat_turn(self):
+        body = json.dumps({"chat_id": random.choice(self.cred["chat_ids"]), "version": "V2",
+                           "text": "how is the load test going?"}).encode()
+        await self.call("chat_turn", "POST", "/functions/v1/chat-router",
+                        self._auth({"Content-Type": "application/json"}), body)
+
+    async def list_chats(self):
+        await self.call("list_chats", "GET", "/db/chats?_order_col=updated_at&_order_asc=0", self._auth())
+
+    async def list_messages(self):
+        cid = random.choice(self.cred["chat_ids"])
+        await self.call("list_messages", "GET",
+                        f"/db/messages?chat_id={cid}&_order_col=created_at&_order_asc=0&_limit=50",
+                        self._auth())
+
+    async def notifications_poll(self):
+        await self.call("notifications_poll", "GET", "/notifications/count", self._auth())
+
+    async def ocr_upload(self):
+        body, ctype = _multipart("file", "bill.png", os.urandom(64 * 1024))
+        await self.call("ocr_upload", "POST", "/vision/ocr/bill", self._auth({"Content-Type": ctype}), body)
+
+
+async def run_users(creds, host, port, mix, duration, concurrency, record):
+    names, weights = zip(*mix.items())
+    deadline = time.perf_counter() + duration
+
+    async def worker(i):
+        vu = VirtualUser(creds[i % len(creds)], host, port, record)
+        await vu.login()
+        while time.perf_counter() < deadline:
+            name = random.choices(names, weights)[0]
+            await getattr(vu, name)()
+        await vu.conn.close()
+
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+
+
+# ---------- socket subscribers ----------
+def start_subscribers(url, count, record):
+    """Connect Socket.IO clients (sync client in threads); returns (clients, event counter)."""
+    try:
+        import socketio as sio_mod
+    except ImportError:
+        return [], [0]
+    received = [0]
+    lock = threading.Lock()
+    clients = []
+    for _ in range(count):
+        cl = sio_mod.Client(reconnection=False)
+
+        @cl.on("db_change")
+        def _on_change(_data):
+            with lock:
+                received[0] += 1
+
+        t0 = time.perf_counter()
+        try:
+            cl.connect(url, transports=["polling"], wait_timeout=5)
+            record("socket_connect", time.perf_counter() - t0, 200)
+            clients.append(cl)
+        except Exception:
+            record("socket_connect", time.perf_counter() - t0, 599)
+    return clients, received
+
+
+# ---------- reporting ----------
+def _pct(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+def summarize(samples, wall):
+    out = {}
+    for name, rows in sorted(samples.items()):
+        lat = sorted(r[0] for r in rows)
+        errors = sum(1 for r in rows if r[1] >= 400)
+        out[name] = {
+            "count": len(rows),
+            "errors": errors,
+            "rps": round(len(rows) / wall, 2),
+            "p50_ms": round(_pct(lat, 50) * 1000, 2),
+            "p95_ms": round(_pct(lat, 95) * 1000, 2),
+            "p99_ms": round(_pct(lat, 99) * 1000, 2),
+            "mean_ms": round(statistics.fmean(lat) * 1000, 2) if lat else 0.0,
+        }
+    return out
+
+
+def print_table(summary, wall, total):
+    print(f"\n{total} requests in {wall:.1f}s = {total / wall:.1f} req/s\n")
+    print(f"{'endpoint':<20}{'count':>8}{'err':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, r in summary.items():
+        print(f"{name:<20}{r['count']:>8}{r['errors']:>6}{r['rps']:>9}{r['p50_ms']:>10}"
+              f"{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+
+def compare(summary, baseline, threshold):
+    """Flag endpoints whose p95 grew or throughput fell by more than `threshold`."""
+    regressions = []
+    for name, base in baseline.get("endpoints", {}).items():
+        cur = summary.get(name)
+        if cur is None:
+            continue
+        if base["p95_ms"] > 0 and cur["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {base['p95_ms']}ms -> {cur['p95_ms']}ms")
+        # socket_connect happens once per subscriber, so its rate is not a throughput
+        if name != "socket_connect" and base["rps"] > 0 and cur["rps"] < base["rps"] * (1 - threshold):
+            regressions.append(f"{name}: rps {base['rps']} -> {cur['rps']}")
+    return regressions
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--messages", type=int, default=200, help="messages seeded per user")
+    ap.add_argument("--concurrency", type=int, default=16, help="virtual users")
+    ap.add_argument("--duration", type=float, default=15.0, help="seconds")
+    ap.add_argument("--sockets", type=int, default=4, help="Socket.IO subscribers")
+    ap.add_argument("--mix", type=str, default=None, help='JSON weights, e.g. \'{"chat_turn": 1}\'')
+    ap.add_argument("--seed", type=int, default=1234)
+    ap.add_argument("--compare", type=str, default=None, help="baseline JSON to compare against")
+    ap.add_argument("--threshold", type=float, default=0.25, help="allowed relative regression")
+    ap.add_argument("--write-baseline", type=str, default=None)
+    ap.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = ap.parse_args(argv)
+
+    random.seed(args.seed)
+    mix = json.loads(args.mix) if args.mix else DEFAULT_MIX
+    tmp = tempfile.mkdtemp(prefix="offline-bench-")
+    A, srv = boot_server(os.path.join(tmp, "bench.db"))
+    host, port = srv.server_address[:2]
+    t_seed = time.perf_counter()
+    creds = seed_load(A, args.users, args.messages)
+    print(f"seeded {args.users} users x {args.messages} messages in {time.perf_counter() - t_seed:.1f}s")
+
+    samples = {}
+    lock = threading.Lock()
+
+    def record(name, elapsed, status):
+        with lock:
+            samples.setdefault(name, []).append((elapsed, status))
+
+    clients, received = start_subscribers(f"http://{host}:{port}", args.sockets, record)
+    t0 = time.perf_counter()
+    asyncio.run(run_users(creds, host, port, mix, args.duration, args.concurrency, record))
+    wall = time.perf_counter() - t0
+    for cl in clients:
+        try:
+            cl.disconnect()
+        except Exception:
+            pass
+    srv.shutdown()
+
+    samples_http = {k: v for k, v in samples.items() if k != "socket_connect"}
+    total = sum(len(v) for v in samples_http.values())
+    summary = summarize(samples, wall)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_table(summary, wall, total)
+        if clients:
+            print(f"\nsocket subscribers: {len(clients)}, db_change events received: {received[0]}")
+
+    if args.write_baseline:
+        with open(args.write_baseline, "w") as fh:
+            json.dump({
+                "generated_at": datetime.utcnow().isoformat(timespec="seconds"),
+                "params": {k: getattr(args, k) for k in ("users", "messages", "concurrency", "duration", "sockets")},
+                "mix": mix,
+                "total_rps": round(total / wall, 2),
+                "endpoints": summary,
+            }, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+        print(f"baseline written to {args.write_baseline}")
+
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        regressions = compare(summary, baseline, args.threshold)
+        if regressions:
+            print(f"\nREGRESSIONS (threshold {args.threshold:.0%}):")
+            for r in regressions:
+                print("  " + r)
+            return 1
+        print(f"\nno regressions vs {args.compare} (threshold {args.threshold:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+# backend/server/bench/shards.py
+"""
+Write-throughput benchmark for per-user shards (OFFLINE_SHARDS).
+
+Sharding is experimental: the recorded results (bench/shards.json) come from
+a one-CPU host and show no gain at synchronous=NORMAL, so OFFLINE_SHARDS
+stays at 1 until a multi-core run here shows writers scaling.
+
+For each shard count, a throwaway database is created with --writers users
+(placed user_id % count, as at signup), then one process per user commits
+single-message transactions into that user's chat for --duration seconds,
+all at once. Reports committed messages/second per shard count; with one
+file every writer queues on the same SQLite lock, with N files only the
+writers that share a shard do.
+
+The app runs synchronous=NORMAL, where a WAL commit is a memory copy: the
+lock is held for microseconds and the run measures Python CPU, so it only
+scales with cores (os.cpu_count() is recorded with the results).
+--synchronous full makes each commit fsync while holding the lock, which is
+the contention shards remove, and shows it even on one core.
+
+    python bench/shards.py --shards 1,2,4 --writers 8 --duration 5
+    python bench/shards.py --synchronous normal,full --write-results bench/shards.json
+"""
+import argparse, json, os, platform, subprocess, sys, tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(HERE)
+
+SETUP = r"""
+import sys
+sys.path.insert(0, {server_dir!r})
+import app as A
+with A.app.app_context():
+    A.migrate()
+    for i in range({writers}):
+        u = A.User(email=f"w{{i}}@example.com", name=f"W{{i}}", password_hash="x")
+        A.db.session.add(u); A.db.session.commit()
+        u.shard = A.place_user(u.id)
+        with A.shard_scope(u.shard):
+            A.db.session.add(A.Chat(user_id=u.id, title="bench"))
+            A.db.session.commit()
+"""
+
+WRITER = r"""
+import json, sys, time
+sys.path.insert(0, {server_dir!r})
+import app as A
+
+@A.event.listens_for(A.Engine, "connect")
+def _sync(dbapi_conn, _record):  # runs after the app's own pragmas
+    dbapi_conn.execute("PRAGMA synchronous={synchronous}")
+
+with A.app.app_context():
+    u = A.User.query.filter_by(email="w{index}@example.com").one()
+    shard = u.shard
+    with A.shard_scope(shard):
+        chat_id = A.Chat.query.filter_by(user_id=u.id).one().id
+        print("ready", flush=True)
+        sys.stdin.readline()  # "go" once every writer is ready
+        n, end = 0, time.time() + {duration}
+        while time.time() < end:
+            A.db.session.add(A.Message(chat_id=chat_id, user_id=u.id, role="user",
+                                       text="bench message " * 8, version="V2"))
+            A.db.session.commit()
+            n += 1
+print(json.dumps({{"shard": shard, "messages": n}}))
+"""
+
+
+def run(count: int, writers: int, duration: float, synchronous: str = "normal") -> dict:
+    tmp = tempfile.mkdtemp(prefix="offline-shards-")
+    env = dict(os.environ, OFFLINE_DB_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+               OFFLINE_SHARDS=str(count), OFFLINE_MAINTENANCE="0", PYTHONWARNINGS="ignore")
+    subprocess.run([sys.executable, "-c", SETUP.format(server_dir=SERVER_DIR, writers=writers)],
+                   env=env, check=True)
+    procs = [subprocess.Popen([sys.executable, "-c", WRITER.format(
+        server_dir=SERVER_DIR, index=i, duration=duration, synchronous=synchronous.upper())],
+        env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True) for i in range(writers)]
+    for p in procs:  # start the clock only after every writer has imported app
+        p.stdout.readline()
+    for p in procs:
+        p.stdin.write("go\n")
+        p.stdin.flush()
+    results = [json.loads(p.communicate()[0].strip().splitlines()[-1]) for p in procs]
+    total = sum(r["messages"] for r in results)
+    per_shard = {}
+    for r in results:
+        per_shard[r["shard"]] = per_shard.get(r["shard"], 0) + r["messages"]
+    return {"shards": count, "writers": writers, "synchronous": synchronous, "messages": total,
+            "per_second": round(total / duration, 1), "per_shard": dict(sorted(per_shard.items()))}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--shards", default="1,2,4", help="comma-separated shard counts")
+    ap.add_argument("--writers", type=int, default=8, help="concurrent writer processes (one user each)")
+    ap.add_argument("--duration", type=float, default=5.0, help="seconds per shard count")
+    ap.add_argument("--synchronous", default="normal",
+                    help="comma-separated PRAGMA synchronous modes, normal and/or full "
+                         "(full: every commit fsyncs under the lock)")
+    ap.add_argument("--json", action="store_true")
+    ap.add_argument("--write-results", metavar="PATH", help="also save the results (with host info) as JSON")
+    args = ap.parse_args(argv)
+
+    modes = [m.strip().lower() for m in args.synchronous.split(",") if m.strip()]
+    if not modes or any(m not in ("normal", "full") for m in modes):
+        ap.error("--synchronous takes normal and/or full")
+    rows = [run(int(n), args.writers, args.duration, m)
+            for m in modes for n in args.shards.split(",") if n.strip()]
+    if args.write_results:
+        doc = {"host": {"cpus": os.cpu_count(), "platform": platform.platform(),
+                        "python": platform.python_version()}, "runs": rows}
+        with open(args.write_results, "w") as fh:
+            json.dump(doc, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return 0
+    print(f"{args.writers} writers, {args.duration}s each, {os.cpu_count()} cpus")
+    for m in modes:
+        mine = [r for r in rows if r["synchronous"] == m]
+        base = mine[0]["per_second"] or 1
+        print(f"  synchronous={m}")
+        print(f"  {'shards':<8}{'msgs/s':>10}{'speedup':>10}")
+        for r in mine:
+            print(f"  {r['shards']:<8}{r['per_second']:>10}{r['per_second'] / base:>9.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+# backend/server/bench/startup.py
+"""
+Startup-time benchmark: how long a worker takes from `python` to ready.
+
+Each phase runs in a fresh interpreter (so import caches don't help) against
+a throwaway SQLite file, `--runs` times, and the median is reported:
+
+    import        import app (module-level setup only)
+    migrate_cold  migrate() on an empty database
+    migrate_warm  migrate() on an up-to-date database (the common boot)
+    seed_demo     seed_demo() on an up-to-date database
+
+    python bench/startup.py --runs 5
+"""
+import argparse, json, os, statistics, subprocess, sys, tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(HERE)
+
+PROBE = r"""
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {server_dir!r})
+import app as A
+out = {{"import": time.perf_counter() - t0}}
+phase = {phase!r}
+if phase != "import":
+    with A.app.app_context():
+        t1 = time.perf_counter()
+        if phase.startswith("migrate"):
+            A.migrate()
+        else:
+            A.seed_demo()
+        out[phase] = time.perf_counter() - t1
+print(json.dumps(out))
+"""
+
+
+def _probe(phase: str, db_path: str) -> dict:
+    env = dict(os.environ, OFFLINE_DB_URL=f"sqlite:///{db_path}", PYTHONWARNINGS="ignore")
+    code = PROBE.format(server_dir=SERVER_DIR, phase=phase)
+    res = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    return json.loads(res.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args(argv)
+
+    results = {"import": [], "migrate_cold": [], "migrate_warm": [], "seed_demo": []}
+    for _ in range(args.runs):
+        tmp = tempfile.mkdtemp(prefix="offline-startup-")
+        db_path = os.path.join(tmp, "startup.db")
+        results["import"].append(_probe("import", os.path.join(tmp, "unused.db"))["import"])
+        results["migrate_cold"].append(_probe("migrate_cold", db_path)["migrate_cold"])
+        results["migrate_warm"].append(_probe("migrate_warm", db_path)["migrate_warm"])
+        results["seed_demo"].append(_probe("seed_demo", db_path)["seed_demo"])
+
+    summary = {k: round(statistics.median(v) * 1000, 2) for k, v in results.items()}
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"median of {args.runs} runs (ms)")
+        for k, v in summary.items():
+            print(f"  {k:<14}{v:>10}")
+        print(f"  {'worker boot':<14}{round(summary['import'] + summary['migrate_warm'], 2):>10}"
+              "   (import + migrate_warm)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+# backend/server/serve.py
+"""
+Production entry point: N eventlet worker processes sharing one listening
+socket, plus a realtime hub so Socket.IO events reach clients on every worker.
+
+    python serve.py --workers 4 --port 5001
+
+The master process binds the port, runs migrations once, starts the event
+hub on a UNIX socket, then spawns workers that inherit the listening fd.
+Each worker runs app.py under eventlet with OFFLINE_BUS=unix:<hub>, so
+emit_db_change() in any worker is relayed to the others. Dead workers are
+restarted; SIGTERM/SIGINT stop everything.
+
+Everything app.py keeps in memory is per worker. Context-cache
+invalidations are relayed over the hub like events. Concurrency caps and
+LLM semaphores are divided by the worker count (OFFLINE_WORKERS), so the
+configured values stay server-wide. The maintenance scheduler sums the
+traffic of all workers through a file next to its lock. Admission rate
+buckets and /metrics stay per worker: a scrape answers for one worker,
+named by its worker_info pid label.
+
+Per-user shards (OFFLINE_SHARDS) are experimental and off by default; see
+bench/shards.py before raising it.
+
+Socket.IO clients must use the websocket transport (the SPA already does):
+long-polling would need sticky sessions, which a shared socket can't give.
+"""
+import argparse, json, os, signal, socket, struct, subprocess, sys, tempfile, threading, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# ---------- hub (master) ----------
+class Hub:
+    """Relays frames from each worker's publisher connection to all other workers."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.subs = {}  # conn -> worker pid
+        self.lock = threading.Lock()
+        self.relayed = 0
+
+    def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        srv.bind(self.path)
+        srv.listen(128)
+        threading.Thread(target=self._accept, args=(srv,), daemon=True).start()
+
+    def _accept(self, srv):
+        while True:
+            conn, _ = srv.accept()
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        try:
+            while True:
+                head = _recv_exact(conn, 4)
+                frame = _recv_exact(conn, struct.unpack("!I", head)[0])
+                msg = json.loads(frame)
+                if "sub" in msg:
+                    with self.lock:
+                        self.subs[conn] = msg["sub"]
+                    continue
+                self._fanout(msg.get("w"), head + frame)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                self.subs.pop(conn, None)
+            conn.close()
+
+    def _fanout(self, origin, data: bytes):
+        with self.lock:
+            targets = [c for c, pid in self.subs.items() if pid != origin]
+        for c in targets:
+            try:
+                c.sendall(data)
+                self.relayed += 1
+            except OSError:
+                with self.lock:
+                    self.subs.pop(c, None)
+
+
+def _recv_exact(conn, n: int) -> bytes:
+    buf = b""
+    while len(buf) < n:
+        chunk = conn.recv(n - len(buf))
+        if not chunk:
+            raise OSError("closed")
+        buf += chunk
+    return buf
+
+
+# ---------- worker ----------
+def run_worker(fd: int):
+    import eventlet
+    eventlet.monkey_patch()
+    import eventlet.wsgi
+    sys.path.insert(0, HERE)
+    import app as A
+
+    A.CHANGE_BUS.start()
+    A.start_maintenance_scheduler()  # only the worker that wins the lock runs it
+    sock = socket.socket(fileno=fd)
+    sock.setblocking(False)
+    print(f"[worker {os.getpid()}] serving", flush=True)
+    eventlet.wsgi.server(eventlet.greenio.GreenSocket(sock), A.app, log_output=False,
+                         max_size=int(os.environ.get("OFFLINE_WORKER_CONNECTIONS", "1000")))
+
+
+# ---------- master ----------
+def run_master(args):
+    sys.path.insert(0, HERE)
+    if not args.skip_migrate:
+        # run schema setup once here instead of in every worker
+        import app as A
+        with A.app.app_context():
+            A.migrate()
+            A.db.engine.dispose()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(args.backlog)
+    listener.set_inheritable(True)
+
+    hub_path = args.hub or os.path.join(tempfile.gettempdir(), f"offline-hub-{args.port}.sock")
+    Hub(hub_path).serve()
+
+    env = dict(os.environ, OFFLINE_ASYNC_MODE="eventlet", OFFLINE_BUS=f"unix:{hub_path}",
+               OFFLINE_WORKERS=str(args.workers))
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker-fd", str(listener.fileno())]
+    workers = {}
+    stopping = threading.Event()
+
+    def spawn():
+        p = subprocess.Popen(cmd, env=env, pass_fds=[listener.fileno()])
+        workers[p.pid] = p
+
+    def stop(_sig=None, _frm=None):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(args.workers):
+        spawn()
+    print(f"Serving on http://{args.host}:{args.port} with {args.workers} workers (hub {hub_path})", flush=True)
+
+    while not stopping.is_set():
+        for pid, p in list(workers.items()):
+            if p.poll() is not None:
+                del workers[pid]
+                if not stopping.is_set():
+                    print(f"[master] worker {pid} exited ({p.returncode}); restarting", flush=True)
+                    time.sleep(0.5)
+                    spawn()
+        stopping.wait(1.0)
+
+    for p in workers.values():
+        p.terminate()
+    for p in workers.values():
+        try:
+            p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+    listener.close()
+    if os.path.exists(hub_path):
+        os.unlink(hub_path)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=int(os.environ.get("PORT", "5001")))
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    ap.add_argument("--backlog", type=int, default=1024)
+    ap.add_argument("--hub", default=None, help="UNIX socket path for the event hub")
+    ap.add_argument("--skip-migrate", action="store_true")
+    ap.add_argument("--worker-fd", type=int, default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+    if args.worker_fd is not None:
+        run_worker(args.worker_fd)
+    else:
+        run_master(args)
+
+
+if __name__ == "__main__":
+    main()
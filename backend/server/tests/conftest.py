@@ -0,0 +1,57 @@
+"""
+Shared setup: one temp database for the session, configured before `app` is
+imported (the module reads its env once, so every test module sees the same app).
+"""
+import os, secrets, sys, tempfile
+
+_tmp = tempfile.mkdtemp(prefix="offline-tests-")
+os.environ["OFFLINE_DB_URL"] = f"sqlite:///{os.path.join(_tmp, 'test.db')}"
+os.environ["OFFLINE_ADMISSION"] = "0"
+os.environ["OFFLINE_MAINTENANCE"] = "0"
+os.environ["OFFLINE_ARCHIVE_DIR"] = os.path.join(_tmp, "archive")
+os.environ["OFFLINE_UPLOAD_DIR"] = os.path.join(_tmp, "uploads")
+os.environ["OFFLINE_BLOB_DIR"] = os.path.join(_tmp, "blobs")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import app as A
+
+
+@pytest.fixture(scope="session")
+def client():
+    with A.app.app_context():
+        A.seed()
+    return A.app.test_client()
+
+
+@pytest.fixture(scope="session")
+def login(client):
+    """login(email, password) -> Authorization headers for that demo user."""
+    def _login(email, password):
+        r = client.post("/auth/login", json={"email": email, "password": password})
+        assert r.status_code == 200, r.get_json()
+        return {"Authorization": "Bearer " + r.get_json()["token"]}
+    return _login
+
+
+@pytest.fixture(scope="session")
+def auth(login):
+    return login("free@example.com", "free123")
+
+
+@pytest.fixture(scope="session")
+def auth_b(login):
+    return login("plus@example.com", "plus123")
+
+
+@pytest.fixture(scope="session")
+def signup(client):
+    """signup() -> (user id, Authorization headers) for a fresh account."""
+    def _signup():
+        email = f"t-{secrets.token_hex(4)}@example.com"
+        r = client.post("/auth/signup", json={"email": email, "password": "test123"})
+        assert r.status_code in (200, 201), r.get_json()
+        body = r.get_json()
+        return body["user"]["id"], {"Authorization": "Bearer " + body["session"]["access_token"]}
+    return _signup
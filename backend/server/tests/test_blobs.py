@@ -0,0 +1,96 @@
+"""
+Blob store reads (see "Blob store" in app.py): only the user who stored a blob
+can fetch it, and declared types that could run script never render inline.
+"""
+import io
+from urllib.parse import urlsplit
+
+import app as A
+
+
+def _store(client, headers, data, filename, mimetype):
+    r = client.post("/vision/ocr/bank", headers=headers, content_type="multipart/form-data",
+                    data={"file": (io.BytesIO(data), filename, mimetype)})
+    assert r.status_code == 200, r.get_json()
+    return r.get_json()["data"]
+
+
+def _path(url):
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+
+def test_script_types_are_attachments_with_nosniff(client, auth_b):
+    for data, name, mimetype in ((b"<script>alert(1)</script>", "page.html", "text/html"),
+                                 (b'<svg xmlns="http://www.w3.org/2000/svg" onload="alert(1)"/>', "img.svg",
+                                  "image/svg+xml")):
+        src = _store(client, auth_b, data, name, mimetype)
+        r = client.get(_path(src["file_url"]))
+        assert r.status_code == 200
+        assert r.mimetype == "application/octet-stream"
+        assert r.headers["Content-Disposition"].startswith("attachment")
+        assert r.headers["X-Content-Type-Options"] == "nosniff"
+        assert r.get_data() == data
+
+
+def test_images_are_inline(client, auth_b):
+    src = _store(client, auth_b, b"\x89PNG\r\n\x1a\n not really", "scan.png", "image/png")
+    r = client.get(_path(src["file_url"]))
+    assert r.status_code == 200
+    assert r.mimetype == "image/png"
+    assert "attachment" not in r.headers.get("Content-Disposition", "")
+    assert r.headers["X-Content-Type-Options"] == "nosniff"
+
+
+def test_owner_reads_by_signed_url_or_bearer(client, auth_b):
+    src = _store(client, auth_b, b"owner only", "statement.pdf", "application/pdf")
+    assert client.get(_path(src["file_url"])).status_code == 200  # no Authorization header, like an <img>
+    assert client.get(f"/blobs/{src['blob']}", headers=auth_b).status_code == 200
+
+
+def test_other_users_hash_is_404(client, auth, auth_b):
+    src = _store(client, auth_b, b"someone else's statement", "statement.pdf", "application/pdf")
+    sha = src["blob"]
+    assert client.get(f"/blobs/{sha}").status_code == 404
+    assert client.get(f"/blobs/{sha}", headers=auth).status_code == 404
+    assert client.get(f"/blobs/{sha}?w=128", headers=auth).status_code == 404
+    with A.app.app_context():
+        free_id = A.User.query.filter_by(email="free@example.com").one().id
+    forged = _path(src["file_url"]).replace("?u=", f"?u={free_id}&x=")
+    assert client.get(forged, headers=auth).status_code == 404
+    assert client.get(f"/blobs/{sha}?u={free_id}&sig={'0' * 32}").status_code == 404
+
+
+def test_same_bytes_stored_by_two_users_are_readable_by_both(client, auth, auth_b):
+    a = _store(client, auth_b, b"shared bytes", "a.pdf", "application/pdf")
+    with A.app.app_context():
+        assert A.db.session.get(A.BlobOwner, (a["blob"], A.User.query.filter_by(
+            email="free@example.com").one().id)) is None
+    b = _store(client, auth, b"shared bytes", "b.pdf", "application/pdf")
+    assert a["blob"] == b["blob"] and a["file_url"] != b["file_url"]
+    assert client.get(f"/blobs/{a['blob']}", headers=auth).status_code == 200
+    assert client.get(f"/blobs/{a['blob']}", headers=auth_b).status_code == 200
+
+
+def test_migration_backfills_owners_and_signs_stored_urls(client, auth_b):
+    src = _store(client, auth_b, b"from before owners", "old.pdf", "application/pdf")
+    sha, bare = src["blob"], src["file_url"].split("?")[0]  # as file_url was stored before migration 21
+    r = client.post("/db/ocr_bank_extractions", headers=auth_b,
+                    json={"values": {"filename": "old.pdf", "file_url": bare}})
+    assert r.status_code == 201
+    row_id = r.get_json()["rows"][0]["id"]
+    with A.app.app_context():
+        A.BlobOwner.query.filter_by(sha256=sha).delete()
+        A.db.session.commit()
+    assert client.get(f"/blobs/{sha}", headers=auth_b).status_code == 404
+
+    with A.app.app_context():
+        for n in range(A.SHARD_COUNT):
+            with A.shard_scope(n, pin=True):
+                A._m021_blob_owners()
+                A.db.session.commit()
+    rows = client.get(f"/db/ocr_bank_extractions?id={row_id}", headers=auth_b).get_json()["rows"]
+    url = rows[0]["file_url"]
+    assert url.startswith(bare + "?u=")
+    assert client.get(_path(url)).status_code == 200
+    assert client.get(f"/blobs/{sha}", headers=auth_b).status_code == 200
@@ -0,0 +1,81 @@
+"""
+chats.messages_count / last_message / updated_at are kept by triggers on
+messages (see CHAT_AGG_DDL in app.py), through every write path including
+cold storage: archiving leaves them as they were and rehydrating matches them.
+"""
+import app as A
+
+
+def _get_chat(client, headers, chat_id):
+    return client.get(f"/db/chats?id={chat_id}", headers=headers).get_json()["rows"][0]
+
+
+def _new_chat(client, headers, texts):
+    r = client.post("/db/chats", headers=headers, json={"values": {"title": "aggregates"}})
+    chat_id = r.get_json()["rows"][0]["id"]
+    r = client.post("/db/messages", headers=headers, json={"values": [
+        {"chat_id": chat_id, "content": {"role": "user", "text": t}} for t in texts]})
+    assert r.status_code == 201
+    return chat_id, [m["id"] for m in r.get_json()["rows"]]
+
+
+def _actual(chat_id, user_id):
+    with A.app.app_context():
+        with A.shard_scope(A.db.session.get(A.User, user_id).shard or 0):
+            msgs = A.Message.query.filter_by(chat_id=chat_id).order_by(A.Message.id).all()
+            return len(msgs), (msgs[-1].text if msgs else None)
+
+
+def _user_id(client, headers):
+    return client.get("/me", headers=headers).get_json()["id"]
+
+
+def test_insert_updates_count_and_preview(client, auth):
+    chat_id, _ = _new_chat(client, auth, ["one", "two", "three"])
+    chat = _get_chat(client, auth, chat_id)
+    assert (chat["messages_count"], chat["last_message"]) == (3, "three")
+    assert (chat["messages_count"], chat["last_message"]) == _actual(chat_id, _user_id(client, auth))
+
+    before = chat["updated_at"]
+    client.post("/db/messages", headers=auth, json={"values": {"chat_id": chat_id, "content": {"text": "four"}}})
+    chat = _get_chat(client, auth, chat_id)
+    assert (chat["messages_count"], chat["last_message"]) == (4, "four")
+    assert chat["updated_at"] >= before
+
+
+def test_delete_updates_count_and_preview(client, auth):
+    chat_id, ids = _new_chat(client, auth, ["first", "second", "third"])
+    assert client.delete(f"/db/messages?id={ids[-1]}", headers=auth).status_code == 200
+    chat = _get_chat(client, auth, chat_id)
+    assert (chat["messages_count"], chat["last_message"]) == (2, "second")
+    assert client.delete(f"/db/messages?id={ids[0]}", headers=auth).status_code == 200
+    chat = _get_chat(client, auth, chat_id)
+    assert (chat["messages_count"], chat["last_message"]) == (1, "second")
+    assert (chat["messages_count"], chat["last_message"]) == _actual(chat_id, _user_id(client, auth))
+
+
+def test_archive_and_rehydrate_keep_aggregates(client, auth, monkeypatch):
+    monkeypatch.setattr(A, "ARCHIVE_MIN_MESSAGES", 1)
+    uid = _user_id(client, auth)
+    chat_id, _ = _new_chat(client, auth, ["cold one", "cold two", "cold three"])
+    hot = _get_chat(client, auth, chat_id)
+
+    with A.app.app_context():
+        with A.shard_scope(A.db.session.get(A.User, uid).shard or 0):
+            assert A.archive_chat(A.db.session.get(A.Chat, chat_id)) == 3
+    cold = _get_chat(client, auth, chat_id)
+    assert cold["archived_at"] is not None
+    assert (cold["messages_count"], cold["last_message"]) == (3, "cold three")
+    assert _actual(chat_id, uid) == (0, None)  # rows live in the segment now
+
+    r = client.post(f"/chats/{chat_id}/rehydrate", headers=auth)
+    assert r.get_json() == {"ok": True, "messages": 3}
+    warm = _get_chat(client, auth, chat_id)
+    assert warm["archived_at"] is None
+    assert (warm["messages_count"], warm["last_message"]) == (hot["messages_count"], hot["last_message"])
+    assert (warm["messages_count"], warm["last_message"]) == _actual(chat_id, uid)
+
+    client.post("/db/messages", headers=auth, json={"values": {"chat_id": chat_id, "content": {"text": "warm"}}})
+    assert (4, "warm") == _actual(chat_id, uid)
+    warm = _get_chat(client, auth, chat_id)
+    assert (warm["messages_count"], warm["last_message"]) == (4, "warm")
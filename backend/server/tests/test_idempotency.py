@@ -0,0 +1,67 @@
+"""
+Idempotency-Key handling (see "Idempotency keys" in app.py): a retried POST is
+answered from the stored response without running (or charging) again.
+"""
+import io
+
+import app as A
+
+
+def _bank_used(client, headers):
+    return client.post("/rpc/get_credits", headers=headers).get_json()["data"]["credits"]["ocr_bank"]["used"]
+
+
+def _scan(client, headers, key, data=b"statement"):
+    return client.post("/vision/ocr/bank", headers=dict(headers, **{"Idempotency-Key": key}),
+                       data={"file": (io.BytesIO(data), "statement.png")}, content_type="multipart/form-data")
+
+
+def test_retry_is_replayed_and_charged_once(client, auth_b):
+    before = _bank_used(client, auth_b)
+    first = _scan(client, auth_b, "replay-1")
+    second = _scan(client, auth_b, "replay-1")
+    assert first.status_code == second.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert second.get_data() == first.get_data()
+    assert _bank_used(client, auth_b) == before + 1
+
+
+def test_key_reused_with_different_body_is_rejected(client, auth_b):
+    assert _scan(client, auth_b, "reuse-1", b"page one").status_code == 200
+    before = _bank_used(client, auth_b)
+    r = _scan(client, auth_b, "reuse-1", b"page two")  # same field and file name, other bytes
+    assert r.status_code == 422
+    assert r.get_json()["error"] == "idempotency_key_reused"
+    assert _bank_used(client, auth_b) == before
+
+
+def test_json_body_mismatch_is_rejected(client, auth):
+    chat_id = client.get("/db/chats", headers=auth).get_json()["rows"][0]["id"]
+    headers = dict(auth, **{"Idempotency-Key": "insert-1"})
+    a = client.post("/db/messages", headers=headers, json={"values": {"chat_id": chat_id, "content": {"text": "a"}}})
+    b = client.post("/db/messages", headers=headers, json={"values": {"chat_id": chat_id, "content": {"text": "b"}}})
+    assert a.status_code == 201
+    assert b.status_code == 422
+
+
+def test_claim_is_exclusive_and_in_flight_key_answers_409(client, auth, monkeypatch):
+    chat_id = client.get("/db/chats", headers=auth).get_json()["rows"][0]["id"]
+    body = {"values": {"chat_id": chat_id, "content": {"text": "in flight"}}}
+    with A.app.test_request_context("/db/messages", method="POST", json=body):
+        fp = A._idem_fingerprint()
+    with A.app.app_context():
+        uid = A.User.query.filter_by(email="free@example.com").one().id
+        assert A._idem_claim(uid, "flight-1", fp)
+        assert not A._idem_claim(uid, "flight-1", fp)
+
+    monkeypatch.setattr(A, "IDEM_WAIT", 0.2)
+    headers = dict(auth, **{"Idempotency-Key": "flight-1"})
+    r = client.post("/db/messages", headers=headers, json=body)
+    assert r.status_code == 409
+    assert r.get_json()["error"] == "idempotency_in_flight"
+    assert r.headers["Retry-After"] == "1"
+
+    with A.app.app_context():
+        A._idem_release(uid, "flight-1")  # the holder failed; the next attempt runs
+    assert client.post("/db/messages", headers=headers, json=body).status_code == 201
@@ -0,0 +1,119 @@
+"""
+Bulk notification actions (see "Notifications" in app.py): one scoped UPDATE
+or DELETE per request, selected by id, ids, before or all (first match wins).
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as A
+
+T0 = datetime(2020, 1, 1, 12, 0, 0)
+
+
+@pytest.fixture
+def user(signup):
+    """A fresh user with three notifications an hour apart, starting at T0."""
+    uid, headers = signup()
+    with A.app.app_context():
+        with A.shard_scope(A.db.session.get(A.User, uid).shard or 0):
+            rows = [A.Notification(user_id=uid, title=f"n{i}", created_at=T0 + timedelta(hours=i)) for i in range(3)]
+            A.db.session.add_all(rows)
+            A.db.session.commit()
+            ids = [n.id for n in rows]
+    return uid, headers, ids
+
+
+def _state(uid, ids):
+    """id -> (read, archived) for the given notifications, read straight from the DB."""
+    with A.app.app_context():
+        with A.shard_scope(A.db.session.get(A.User, uid).shard or 0):
+            rows = A.Notification.query.filter(A.Notification.id.in_(ids)).all()
+            return {n.id: (n.read_at is not None, n.archived_at is not None) for n in rows}
+
+
+def _post(client, headers, action, body):
+    return client.post(f"/notifications/{action}", headers=headers, json=body)
+
+
+def test_id_and_ids_selectors(client, user):
+    uid, headers, ids = user
+    assert _post(client, headers, "mark_read", {"id": ids[0]}).get_json() == {"ok": True, "updated": 1}
+    assert _post(client, headers, "mark_read", {"ids": ids}).get_json()["updated"] == 2  # ids[0] already read
+    assert _post(client, headers, "mark_read", {"ids": ids}).get_json()["updated"] == 0
+    assert _state(uid, ids) == {i: (True, False) for i in ids}
+    assert _post(client, headers, "mark_unread", {"ids": ids[1:]}).get_json()["updated"] == 2
+    assert _state(uid, ids)[ids[1]] == (False, False)
+
+
+def test_before_selector(client, user):
+    uid, headers, ids = user
+    r = _post(client, headers, "mark_read", {"before": (T0 + timedelta(hours=1)).isoformat() + "Z"})
+    assert r.get_json()["updated"] == 2
+    assert [_state(uid, ids)[i][0] for i in ids] == [True, True, False]
+
+
+def test_all_selector(client, user):
+    uid, headers, ids = user
+    client.get("/notifications", headers=headers)  # adds the baseline welcome rows too
+    with A.app.app_context():
+        with A.shard_scope(A.db.session.get(A.User, uid).shard or 0):
+            total = A.Notification.query.filter_by(user_id=uid).count()
+    assert total > len(ids)
+    assert _post(client, headers, "mark_read", {"all": True}).get_json()["updated"] == total
+    r = client.get("/notifications?status=unread", headers=headers)
+    assert r.get_json()["rows"] == []
+
+
+def test_first_selector_wins(client, user):
+    uid, headers, ids = user
+    assert _post(client, headers, "mark_read", {"id": ids[0], "all": True}).get_json()["updated"] == 1
+    assert _post(client, headers, "mark_read", {"ids": [ids[1]], "before": "2999-01-01"}).get_json()["updated"] == 1
+    assert _state(uid, ids)[ids[2]] == (False, False)
+
+
+@pytest.mark.parametrize("body, error", [
+    ({}, "missing_selector"),
+    ({"ids": []}, "missing_selector"),
+    ({"all": "yes"}, "missing_selector"),
+    ({"ids": ["x"]}, "invalid_ids"),
+    ({"before": "not a date"}, "invalid_before"),
+])
+def test_bad_selectors_are_400(client, user, body, error):
+    _, headers, _ = user
+    r = _post(client, headers, "mark_read", body)
+    assert r.status_code == 400
+    assert r.get_json() == {"error": error}
+
+
+def test_other_users_rows_are_untouched(client, user, signup):
+    uid, _, ids = user
+    _, intruder = signup()
+    for action in ("mark_read", "archive"):
+        assert _post(client, intruder, action, {"id": ids[0]}).get_json()["updated"] == 0
+        assert _post(client, intruder, action, {"ids": ids}).get_json()["updated"] == 0
+    assert _post(client, intruder, "delete", {"ids": ids}).get_json()["deleted"] == 0
+    _post(client, intruder, "mark_read", {"all": True})
+    assert _state(uid, ids) == {i: (False, False) for i in ids}
+
+
+def test_archived_rows_hidden_unless_requested(client, user):
+    uid, headers, ids = user
+    assert _post(client, headers, "archive", {"id": ids[0]}).get_json()["updated"] == 1
+
+    def listed(status=None):
+        url = "/notifications?limit=100" + (f"&status={status}" if status else "")
+        return {n["id"] for n in client.get(url, headers=headers).get_json()["rows"]}
+
+    for status in (None, "all", "unread"):
+        assert ids[0] not in listed(status) and ids[1] in listed(status)
+    assert listed("archived") == {ids[0]}
+
+    assert _post(client, headers, "unarchive", {"id": ids[0]}).get_json()["updated"] == 1
+    assert ids[0] in listed() and listed("archived") == set()
+
+
+def test_delete_is_scoped_by_selector(client, user):
+    uid, headers, ids = user
+    assert _post(client, headers, "delete", {"ids": ids[:2]}).get_json() == {"ok": True, "deleted": 2}
+    assert set(_state(uid, ids)) == {ids[2]}
@@ -0,0 +1,84 @@
+"""
+Statement counts for the eager-loaded views (see "Chat views" in app.py).
+
+Counts are taken inside the view only (auth in before_request is excluded);
+each conditional view adds VALIDATOR statements for its ETag lookup.
+"""
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import app as A
+
+VALIDATOR = 1  # change_log head for the user's DB file (main DB users)
+
+
+@contextmanager
+def counting(endpoint):
+    """Record every statement run while the `endpoint` view executes."""
+    statements, active = [], [False]
+    view = A.app.view_functions[endpoint]
+
+    def wrapped(*args, **kwargs):
+        active[0] = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            active[0] = False
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        if active[0]:
+            statements.append(statement)
+
+    A.app.view_functions[endpoint] = wrapped
+    event.listen(Engine, "before_cursor_execute", on_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "before_cursor_execute", on_execute)
+        A.app.view_functions[endpoint] = view
+
+
+def _chat_with_messages(client, auth, n=5):
+    chat_id = client.get("/db/chats", headers=auth).get_json()["rows"][0]["id"]
+    r = client.post("/db/messages", headers=auth, json={"values": [
+        {"chat_id": chat_id, "content": {"role": "user", "text": f"message {i}"}} for i in range(n)]})
+    assert r.status_code == 201
+    return chat_id
+
+
+def test_me_is_one_query(client, auth):
+    with counting("get_me") as sql:
+        r = client.get("/me", headers=auth)
+    assert r.status_code == 200
+    assert len(sql) == 1 + VALIDATOR, sql
+
+
+def test_chats_list_is_two_queries(client, auth):
+    _chat_with_messages(client, auth)
+    with counting("chats_view") as sql:
+        r = client.get("/chats", headers=auth)
+    assert r.status_code == 200
+    assert r.get_json()["rows"][0]["preview"] is not None
+    assert len(sql) == 2 + VALIDATOR, sql
+
+
+def test_chat_view_is_two_queries(client, auth):
+    chat_id = _chat_with_messages(client, auth)
+    with counting("chat_view") as sql:
+        r = client.get(f"/chats/{chat_id}?limit=3", headers=auth)
+    body = r.get_json()
+    assert r.status_code == 200
+    assert len(body["messages"]) == 3 and body["has_more"]
+    assert len(sql) == 2 + VALIDATOR, sql
+
+
+def test_bulk_message_insert_loads_chat_once(client, auth):
+    chat_id = client.get("/db/chats", headers=auth).get_json()["rows"][0]["id"]
+    with counting("table_insert") as sql:
+        r = client.post("/db/messages", headers=auth, json={"values": [
+            {"chat_id": chat_id, "content": {"role": "user", "text": f"bulk {i}"}} for i in range(10)]})
+    assert r.status_code == 201
+    chat_loads = [s for s in sql if s.lstrip().upper().startswith("SELECT") and "FROM chats" in s]
+    assert len(chat_loads) == 1, chat_loads
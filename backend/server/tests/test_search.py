@@ -0,0 +1,46 @@
+"""
+/search (see "Search" in app.py): every FTS query is scoped by the caller's
+owner token, so users sharing a DB file never see each other's hits.
+"""
+import secrets
+
+
+def _chat_with_message(client, headers, title, text):
+    r = client.post("/db/chats", headers=headers, json={"values": {"title": title}})
+    assert r.status_code == 201
+    chat_id = r.get_json()["rows"][0]["id"]
+    r = client.post("/db/messages", headers=headers, json={"values": {
+        "chat_id": chat_id, "content": {"role": "user", "text": text}}})
+    assert r.status_code == 201
+    return chat_id
+
+
+def test_search_does_not_return_other_users_messages(client, auth, auth_b):
+    word = "zq" + secrets.token_hex(4)
+    mine = _chat_with_message(client, auth, f"{word} mine", f"a note about {word}")
+    theirs = _chat_with_message(client, auth_b, f"{word} theirs", f"another note about {word}")
+
+    for headers, own in ((auth, mine), (auth_b, theirs)):
+        r = client.get(f"/search?q={word}", headers=headers)
+        assert r.status_code == 200
+        body = r.get_json()
+        assert [m["chat_id"] for m in body["messages"]] == [own]
+        assert [c["id"] for c in body["chats"]] == [own]
+        assert "<mark>" in body["messages"][0]["snippet"]
+
+
+def test_search_in_another_users_chat_finds_nothing(client, auth, auth_b):
+    word = "zq" + secrets.token_hex(4)
+    theirs = _chat_with_message(client, auth_b, "private", f"secret {word}")
+    body = client.get(f"/search?q={word}&chat_id={theirs}", headers=auth).get_json()
+    assert body["messages"] == []
+
+
+def test_bad_chat_id_is_400(client, auth):
+    r = client.get("/search?q=hello&chat_id=1%20OR%201", headers=auth)
+    assert r.status_code == 400
+    assert r.get_json()["error"] == "bad_chat_id"
+
+
+def test_missing_query_is_400(client, auth):
+    assert client.get("/search?q=%20", headers=auth).status_code == 400
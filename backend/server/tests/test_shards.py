@@ -0,0 +1,70 @@
+"""
+Shard routing with OFFLINE_SHARDS=2 (see "Shards" in app.py).
+
+app.py reads OFFLINE_SHARDS once at import and the session's app runs with
+one shard, so the checks run in a child process: this file executed as a
+script with its own database and two shards.
+"""
+import os, subprocess, sys, tempfile
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_two_shard_routing():
+    tmp = tempfile.mkdtemp(prefix="offline-shards-")
+    env = dict(os.environ, OFFLINE_SHARDS="2", OFFLINE_DB_URL=f"sqlite:///{os.path.join(tmp, 'test.db')}",
+               OFFLINE_ADMISSION="0", OFFLINE_MAINTENANCE="0", OFFLINE_ARCHIVE_DIR=os.path.join(tmp, "archive"),
+               OFFLINE_UPLOAD_DIR=os.path.join(tmp, "uploads"), OFFLINE_BLOB_DIR=os.path.join(tmp, "blobs"))
+    r = subprocess.run([sys.executable, os.path.abspath(__file__)], cwd=SERVER_DIR, env=env,
+                       capture_output=True, text=True, timeout=120)
+    assert r.returncode == 0, r.stdout + r.stderr
+
+
+def _check_routing():
+    sys.path.insert(0, SERVER_DIR)
+    from sqlalchemy import text
+    import app as A
+
+    assert A.SHARD_COUNT == 2
+    with A.app.app_context():
+        A.seed()
+    client = A.app.test_client()
+    users = {}
+    for email, password, word in (("free@example.com", "free123", "aubergine"),
+                                  ("plus@example.com", "plus123", "kohlrabi")):
+        body = client.post("/auth/login", json={"email": email, "password": password}).get_json()
+        headers = {"Authorization": "Bearer " + body["token"]}
+        r = client.post("/db/chats", headers=headers, json={"values": {"title": f"{word} notes"}})
+        assert r.status_code == 201, r.get_json()
+        chat_id = r.get_json()["rows"][0]["id"]
+        r = client.post("/db/messages", headers=headers, json={"values": {
+            "chat_id": chat_id, "content": {"role": "user", "text": f"about {word}"}}})
+        assert r.status_code == 201, r.get_json()
+        users[email] = {"id": body["user"]["id"], "headers": headers, "word": word, "chat_id": chat_id}
+
+    with A.app.app_context():
+        shards = {u["word"]: A.db.session.get(A.User, u["id"]).shard for u in users.values()}
+        assert sorted(shards.values()) == [0, 1], shards
+        assert A.shard_engine(0).url.database != A.shard_engine(1).url.database
+        for u in users.values():
+            for n in (0, 1):
+                found = A.db.session.execute(
+                    text("SELECT COUNT(*) FROM chats WHERE user_id = :u AND title = :t"),
+                    {"u": u["id"], "t": f"{u['word']} notes"}, bind_arguments={"bind": A.shard_engine(n)}).scalar()
+                assert found == (1 if n == shards[u["word"]] else 0), (u["word"], n, found)
+
+    for u in users.values():
+        other = next(o for o in users.values() if o is not u)
+        rows = client.get("/db/chats", headers=u["headers"]).get_json()["rows"]
+        assert {row["user_id"] for row in rows} == {u["id"]}
+        assert u["chat_id"] in {row["id"] for row in rows}
+
+        hits = client.get(f"/search?q={u['word']}", headers=u["headers"]).get_json()
+        assert [m["chat_id"] for m in hits["messages"]] == [u["chat_id"]], hits
+        assert [c["id"] for c in hits["chats"]] == [u["chat_id"]], hits
+        miss = client.get(f"/search?q={other['word']}", headers=u["headers"]).get_json()
+        assert miss["messages"] == [] and miss["chats"] == [], miss
+
+
+if __name__ == "__main__":
+    _check_routing()
@@ -0,0 +1,76 @@
+"""
+Delta sync (see "Delta sync (change log)" in app.py): triggers log every write,
+GET /sync pages through them, and a pruned cursor is told to re-list.
+"""
+from sqlalchemy import text
+
+import app as A
+
+
+def _new_chat(client, headers, title):
+    r = client.post("/db/chats", headers=headers, json={"values": {"title": title}})
+    assert r.status_code == 201
+    return r.get_json()["rows"][0]["id"]
+
+
+def _head(client, headers):
+    r = client.get("/sync", headers=headers)
+    assert r.get_json()["reset"] is True  # no cursor yet
+    return r.get_json()["next"]
+
+
+def test_write_appends_change_log_row(client, signup):
+    uid, headers = signup()
+    chat_id = _new_chat(client, headers, "logged")
+    with A.app.app_context():
+        shard = A.db.session.get(A.User, uid).shard or 0
+        rows = A.db.session.execute(text(
+            "SELECT op FROM change_log WHERE user_id = :u AND tbl = 'chats' AND row_id = :id"),
+            {"u": uid, "id": chat_id}, bind_arguments={"bind": A.shard_engine(shard)}).scalars().all()
+    assert rows == ["I"]
+
+
+def test_since_pages_with_next(client, signup):
+    _, headers = signup()
+    cursor = _head(client, headers)
+    created = [_new_chat(client, headers, f"page {i}") for i in range(3)]
+
+    first = client.get(f"/sync?since={cursor}&limit=2", headers=headers).get_json()
+    assert first["reset"] is False and first["has_more"] is True
+    assert [c["id"] for c in first["changes"]] == created[:2]
+    second = client.get(f"/sync?since={first['next']}&limit=2", headers=headers).get_json()
+    assert second["has_more"] is False
+    assert [c["id"] for c in second["changes"]] == created[2:]
+    assert all(c["op"] == "UPSERT" and c["row"]["title"].startswith("page") for c in first["changes"] + second["changes"])
+
+    idle = client.get(f"/sync?since={second['next']}", headers=headers).get_json()
+    assert idle["changes"] == [] and idle["next"] == second["next"]
+
+
+def test_deleted_row_is_reported_as_delete(client, signup):
+    _, headers = signup()
+    chat_id = _new_chat(client, headers, "short-lived")
+    cursor = _head(client, headers)
+    assert client.delete(f"/db/chats?id={chat_id}", headers=headers).status_code == 200
+
+    body = client.get(f"/sync?since={cursor}", headers=headers).get_json()
+    gone = [c for c in body["changes"] if c["table"] == "chats" and c["id"] == chat_id]
+    assert gone == [dict(gone[0], op="DELETE", row=None)]
+
+
+def test_cursor_behind_prune_horizon_resets(client, signup, monkeypatch):
+    _, headers = signup()
+    cursor = _head(client, headers)
+    _new_chat(client, headers, "before prune")
+    monkeypatch.setattr(A, "CHANGELOG_MAX_ROWS", 0)
+    with A.app.app_context():
+        A.job_changelog()  # every DB file, as the maintenance scheduler runs it
+
+    body = client.get(f"/sync?since={cursor}", headers=headers).get_json()
+    assert body["reset"] is True and body["changes"] == []
+    fresh = client.get(f"/sync?since={body['next']}", headers=headers).get_json()
+    assert fresh["reset"] is False
+
+
+def test_bad_cursor_is_400(client, auth):
+    assert client.get("/sync?since=not-a-cursor", headers=auth).status_code == 400
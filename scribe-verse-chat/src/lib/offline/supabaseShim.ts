@@ -46,6 +46,17 @@ async function deleteJSON(url: string, params: Record<string, any> = {}) {
   return res.json();
 }
 
+// change-log cursor for /sync, one per signed-in user
+const cursorKey = (uid: string) => `offline_sync_seq:${uid}`;
+async function currentUserId(): Promise<string | null> {
+  let uid = localStorage.getItem("offline_user_id");
+  if (!uid && localStorage.getItem("offline_token")) {
+    const me = await getJSON("/auth/me").catch(() => null);
+    if (me?.user?.id != null) { uid = String(me.user.id); localStorage.setItem("offline_user_id", uid); }
+  }
+  return uid;
+}
+
 // auth event bus
 type Handler = (payload: any) => void;
 const listeners = new Set<Handler>();
@@ -72,6 +83,7 @@ export function createClient(_url?: string, _key?: string) {
       const data = await postJSON("/auth/signup", { email, password, name });
       if (data?.session?.access_token && data?.user) {
         localStorage.setItem("offline_token", data.session.access_token);
+        localStorage.setItem("offline_user_id", String(data.user.id));
         emitAuth("SIGNED_IN", { user: data.user, access_token: data.session.access_token });
         return { data: { user: data.user, session: data.session }, error: null };
       }
@@ -81,6 +93,7 @@ export function createClient(_url?: string, _key?: string) {
       const data = await postJSON("/auth/login", { email, password });
       if (data?.token) {
         localStorage.setItem("offline_token", data.token);
+        localStorage.setItem("offline_user_id", String(data.user.id));
         const session = { access_token: data.token, user: data.user };
         emitAuth("SIGNED_IN", session);
         return { data: { user: data.user, session }, error: null };
@@ -89,6 +102,10 @@ export function createClient(_url?: string, _key?: string) {
     },
     async signOut() {
       await postJSON("/auth/logout", {});
+      const uid = localStorage.getItem("offline_user_id");
+      if (uid) localStorage.removeItem(cursorKey(uid));
+      localStorage.removeItem("offline_sync_seq"); // pre-per-user cursor
+      localStorage.removeItem("offline_user_id");
       localStorage.removeItem("offline_token");
       emitAuth("SIGNED_OUT", null);
       return { error: null };
@@ -187,14 +204,63 @@ export function createClient(_url?: string, _key?: string) {
   }
 
   // --- realtime (db_change socket) ---
+  // On every (re)connect the socket asks for changes since the user's last
+  // seen change-log cursor, so events missed while offline are replayed
+  // instead of lost. If the cursor has expired ({reset: true}) the subscribed
+  // tables are re-listed and every row is delivered as an UPDATE; rows deleted
+  // in the gap are not reported, so handlers also get a RESET event per table.
   function channel(_name: string) {
     const socket: Socket = io(WS_ORIGIN, { transports: ["websocket"] });
     const handlers: Array<(payload: any) => void> = [];
-    socket.on("db_change", (data: any) => {
-      handlers.forEach((h) => h({ event: "postgres_changes", payload: data }));
+    const tables = new Map<string, Record<string, string>>(); // table -> eq filters
+    const deliver = (data: any) => handlers.forEach((h) => h({ event: "postgres_changes", payload: data }));
+    let uid: string | null = null;
+    const resume = async () => {
+      const token = localStorage.getItem("offline_token");
+      uid = await currentUserId();
+      if (!token || !uid) return;
+      const since = localStorage.getItem(cursorKey(uid));
+      socket.emit("resume", { token, since: since ?? undefined });
+    };
+    const relist = async () => {
+      if (!tables.size) deliver({ eventType: "RESET", schema: "public", table: "*", new: null, old: null });
+      for (const [table, filters] of tables) {
+        const res = await getJSON(`/db/${table}`, filters).catch(() => null);
+        const rows = Array.isArray(res?.rows) ? res.rows : [];
+        deliver({ eventType: "RESET", schema: "public", table, new: rows, old: null });
+        for (const row of rows) deliver({ eventType: "UPDATE", schema: "public", table, new: row, old: { id: row.id } });
+      }
+    };
+    socket.on("connect", resume);
+    socket.on("sync", async (res: any) => {
+      if (!res || res.error || !uid) return;
+      const key = cursorKey(uid);
+      if (res.reset) {
+        if (localStorage.getItem(key) != null) await relist();
+      } else {
+        for (const c of res.changes || []) {
+          deliver(c.op === "DELETE"
+            ? { eventType: "DELETE", schema: "public", table: c.table, new: null, old: { id: c.id } }
+            : { eventType: "UPDATE", schema: "public", table: c.table, new: c.row, old: { id: c.id } });
+        }
+      }
+      localStorage.setItem(key, String(res.next));
+      if (res.has_more) resume();
     });
+    socket.on("db_change", deliver);
     return {
-      on(_evt: any, cb: (data: any) => void) { handlers.push(cb); return this; },
+      // supabase-style on("postgres_changes", { table, filter: "col=eq.val" }, cb); on(evt, cb) still works
+      on(_evt: any, opts: any, cb?: (data: any) => void) {
+        if (typeof opts === "function") { cb = opts; opts = null; }
+        if (opts?.table && opts.table !== "*") {
+          const filters: Record<string, string> = {};
+          const m = /^(\w+)=eq\.(.*)$/.exec(opts.filter || "");
+          if (m) filters[m[1]] = m[2];
+          tables.set(opts.table, filters);
+        }
+        if (cb) handlers.push(cb);
+        return this;
+      },
       subscribe() { return { data: { subscription: this }, error: null }; },
       unsubscribe() { socket.disconnect(); },
     };
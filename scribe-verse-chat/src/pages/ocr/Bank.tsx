@@ -99,7 +99,7 @@ export default function OCRBank() {
 
       const created = await service.createOcr("bank", {
         filename: file.name ?? null,
-        file_url: null,
+        file_url: data?.data?.file_url ?? null,
         data: fx,
         approved: false,
       });
@@ -141,7 +141,7 @@ export default function OCRBill() {
 
       const created = await service.createOcr("bill", {
         filename: file.name ?? null,
-        file_url: null,
+        file_url: data?.data?.file_url ?? null,
         data: fx,
         approved: false,
       });